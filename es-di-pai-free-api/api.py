@@ -1,85 +1,1571 @@
 import json
 import os
+import sys
 import requests
 import time
 import base64
 import argparse
-from flask import Flask, request, jsonify, Response, stream_with_context
+import socket
+import threading
+import hashlib
+import io
+import zlib
+import queue
+import atexit
+import sqlite3
+import random
+import secrets
+import signal
+import heapq
+import weakref
+import contextvars
+from contextlib import contextmanager
+from email import policy
+from email.parser import BytesParser
+from functools import lru_cache
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.response import HTTPResponse as UpstreamResponse
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 import re
 
+# Streams are relayed with HTTPResponse.read1, urllib3 1.x would buffer 64 KB before each chunk
+if not hasattr(UpstreamResponse, "read1"):
+    raise ImportError("The gateway needs urllib3 2 or newer, run pip install -r requirements.txt")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# Optional response codecs, gzip (zlib) is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)
 
 # Constants
 LOG_FILE = "logs.txt"
-models_data = []
-tokens_data = {}
+MODELS_FILE = "models.json"
+TOKENS_FILE = "tokens.json"
+
+# Tokens are refreshed this many seconds before their JWT exp, and treated as expired TOKEN_EXPIRY_SKEW early
+DEFAULT_TOKEN_REFRESH_MARGIN = 300
+TOKEN_EXPIRY_SKEW = 30
+TOKEN_REFRESH_CHECK_INTERVAL = 15
+TOKEN_PERSIST_DELAY = 0.5
+# Failed logins are shared with every caller of the same credentials for this long
+TOKEN_FAILURE_TTL = 5
+
+# --workers share tokens, the cache file tier and limiter state through one SQLite file in WAL mode
+DEFAULT_STATE_FILE = "state.db"
+SHARED_STATE_TIMEOUT = 5
+# Only the worker holding an account's login lease logs in, the others poll for its token
+TOKEN_LOGIN_LEASE = 30
+SHARED_POLL_INTERVAL = 0.05
+# Circuit breakers look for a breaker opened by another worker at most this often
+SHARED_SYNC_INTERVAL = 1.0
+WORKER_RESPAWN_DELAY = 1.0
+
+# Upstream hosts, each one gets its own long-lived pooled session
+PROVIDER_HOSTS = {
+    "ES": "https://api.evalsone.com",
+    "DI": "https://api.deepinfra.com",
+    "PAI": "https://text.pollinations.ai",
+}
+# (host, port) -> provider, to label metrics of upstream connections
+UPSTREAM_PROVIDERS = {}
+DEFAULT_POOL_SIZE = 32
+upstream_sessions = {}
+upstream_sessions_lock = threading.Lock()
+
+# Upstream deadlines in seconds: connect, first byte, idle gap between stream chunks, whole request
+DEFAULT_TIMEOUTS = {
+    "ES": {"connect": 10, "first_byte": 60, "idle": 60, "total": 600},
+    "DI": {"connect": 10, "first_byte": 120, "idle": 120, "total": 900},
+    "PAI": {"connect": 10, "first_byte": 120, "idle": 60, "total": 600},
+}
+# Fastest available JSON codec for the stream hot path
+if orjson:
+    json_loads = orjson.loads
+    json_dumps_bytes = orjson.dumps
+else:
+    json_loads = json.loads
+    def json_dumps_bytes(value):
+        return json.dumps(value).encode("utf-8")
+STREAM_READ_SIZE = 65536
+# Response codecs by preference when the client weighs them equally, and their levels (tuned for latency)
+RESPONSE_CODECS = tuple(codec for codec, module in (("zstd", zstandard), ("br", brotli), ("gzip", zlib)) if module)
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/event-stream", "text/plain")
+DEFAULT_COMPRESS_MIN_BYTES = 1024
+# Cap on a decompressed request body, against compression bombs
+MAX_REQUEST_BODY_BYTES = 32 * 1024 * 1024
+# Compressed input fed to the brotli decompressor at a time, bounding how far one step can overshoot the cap
+BROTLI_INPUT_CHUNK = 1024
+DECODE_ERRORS = (zlib.error,) + ((brotli.error,) if brotli else ()) + ((zstandard.ZstdError,) if zstandard else ())
+FINISH_REASON_JSON = {None: b"null", "stop": b'"stop"', "length": b'"length"'}
+# Token estimate of a prompt: ~4 bytes of UTF-8 per token plus the role framing of each message
+BYTES_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4
+CONTEXT_STRATEGIES = ("reject", "drop_oldest", "truncate_middle")
+TRUNCATION_MARKER = "\n\n[... truncated ...]\n\n"
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+GAP_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# name -> (type, help, label names, histogram buckets)
+METRICS = {
+    "gateway_requests_total": ("counter", "Chat completion requests by response status", ("provider", "model", "status"), None),
+    "gateway_errors_total": ("counter", "Failed chat completion requests by error class", ("provider", "class"), None),
+    "gateway_request_duration_seconds": ("histogram", "Total chat completion time, until the last chunk for streams", ("provider", "model"), LATENCY_BUCKETS),
+    "gateway_upstream_connect_seconds": ("histogram", "Time to open a new upstream connection, TLS included", ("provider",), LATENCY_BUCKETS),
+    "gateway_time_to_first_token_seconds": ("histogram", "Time from request start to the first streamed chunk", ("provider", "model"), LATENCY_BUCKETS),
+    "gateway_stream_chunk_gap_seconds": ("histogram", "Gap between consecutive streamed chunks", ("provider", "model"), GAP_BUCKETS),
+    "gateway_relayed_bytes_total": ("counter", "Streamed bytes sent to clients", ("provider", "model"), None),
+    "gateway_relayed_chunks_total": ("counter", "Streamed chunks sent to clients", ("provider", "model"), None),
+    "gateway_token_refreshes_total": ("counter", "Evalsone logins by result", ("result",), None),
+    "gateway_upstream_retries_total": ("counter", "Upstream calls repeated after a failure before the first byte", ("provider", "reason"), None),
+    "gateway_context_fits_total": ("counter", "Requests over the model context window by outcome (dropped, truncated, rejected)", ("provider", "model", "outcome"), None),
+    "gateway_batch_requests_total": ("counter", "Batch requests run by response status", ("provider", "status"), None),
+    "gateway_queue_wait_seconds": ("histogram", "Time a request waited for its concurrency slots, per fair queuing tenant class", ("tenant_class",), LATENCY_BUCKETS),
+}
+# Error class of a failed response status, other 4xx/5xx are client_error/server_error
+ERROR_CLASSES = {400: "invalid_request", 401: "auth", 504: "timeout"}
+
+DEADLINE_HEADER = "X-Request-Deadline"
+TRACE_HEADER = "X-Trace-Id"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+# Operational endpoints, only for clients that pass is_admin_request
+ADMIN_PATHS = frozenset(("/metrics", "/v1/profile", "/v1/pools", "/v1/streams", "/v1/cache", "/v1/limits", "/v1/breakers", "/v1/conversations"))
+# Adaptive concurrency: multiplicative backoff on overload (at most once per interval), slow drift of the latency baseline
+CONCURRENCY_BACKOFF = 0.7
+CONCURRENCY_LATENCY_BACKOFF = 0.95
+CONCURRENCY_DECREASE_INTERVAL = 1.0
+LATENCY_BASELINE_DRIFT = 0.01
+UPSTREAM_STATUS_PATTERN = re.compile(r"^(?:HTTP )?(\d{3})\b")
+# Fair queuing weight per tenant (Evalsone account email or client IP), "default" for everyone else
+TENANT_WEIGHTS = {"default": 1.0}
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+DEFAULT_PROFILE_INTERVAL_MS = 10
+PROFILE_MAX_STACKS = 20000
+PROFILE_MAX_DEPTH = 128
+TRACE_ID_PATTERN = re.compile(r"^[0-9a-fA-F]{16,32}$")
+CACHE_STATUS_HEADER = "X-Cache"
+CACHE_BYPASS_HEADER = "X-Cache-Bypass"
+COALESCED_HEADER = "X-Coalesced"
+DEFAULT_CACHE_TTL = 3600
+# Balances are fresh for --balance-ttl seconds, then served stale for --balance-stale more while refreshed
+DEFAULT_BALANCE_TTL = 30
+DEFAULT_BALANCE_STALE = 300
+DEFAULT_BALANCE_MIN_INTERVAL = 5
+CACHE_FILE_EVICT_EVERY = 100
+# Clients continue a server-side conversation with this header, "new" starts one
+CONVERSATION_HEADER = "X-Conversation-Id"
+NEW_CONVERSATION = "new"
+DEFAULT_CONVERSATION_TTL = 3600
+# OpenAI batch API limits, and how the batch runner paces itself
+BATCH_ENDPOINTS = ("/v1/chat/completions",)
+BATCH_COMPLETION_WINDOWS = {"24h": 24 * 3600}
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_FILE_BYTES = 200 * 1024 * 1024
+BATCH_MAX_ERRORS = 100
+BATCH_ACTIVE_STATES = ("validating", "in_progress", "finalizing", "cancelling")
+BATCH_TENANT = "batch"
+BATCH_ID_PATTERN = re.compile(r"^batch_[0-9a-f]{24}$")
+FILE_ID_PATTERN = re.compile(r"^file-[0-9a-f]{24}$")
+BATCH_CHECK_INTERVAL = 1.0
+BATCH_LEASE_TTL = 30
+BATCH_SCAN_INTERVAL = 10
+BATCH_OVERLOAD_RETRIES = 5
+UPSTREAM_TIMEOUT = "upstream_timeout"
+CIRCUIT_OPEN = "circuit_open"
+# Prefix of the error of a failed connection, which never reached the upstream and may be retried
+CONNECT_ERROR_PREFIX = "Connection failed: "
+# Upstream statuses retried before the first byte, with full-jitter backoff doubling from --retry-backoff
+RETRY_STATUSES = (429, 502, 503)
+RETRY_BACKOFF_MAX = 4.0
 
-def parse_args():
+config = None
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description='API Server')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
     parser.add_argument('--proxy', help='Proxy URL')
     parser.add_argument('--disable-log', action='store_true', help='Disable logging to file')
     parser.add_argument('--port', type=int, default=None, help='Port to run the server on')
-    return parser.parse_args()
+    parser.add_argument('--log-json', action='store_true', help='Write logs.txt as JSON lines')
+    parser.add_argument('--log-max-bytes', type=int, default=10 * 1024 * 1024, help='Rotate logs.txt once it reaches this size, 0 disables')
+    parser.add_argument('--log-rotate-interval', type=float, default=0, help='Rotate logs.txt every N seconds, 0 disables')
+    parser.add_argument('--log-backups', type=int, default=5, help='Number of rotated log files to keep')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='Max pooled connections per upstream provider')
+    parser.add_argument('--no-keepalive', action='store_true', help='Disable TCP keep-alive probes on upstream connections')
+    parser.add_argument('--preconnect', action='store_true', help='Open upstream connections at startup')
+    parser.add_argument('--connect-timeout', type=float, default=None, help='Upstream connect timeout in seconds (all providers)')
+    parser.add_argument('--first-byte-timeout', type=float, default=None, help='Upstream time to first byte in seconds (all providers)')
+    parser.add_argument('--idle-timeout', type=float, default=None, help='Max gap between upstream stream chunks in seconds (all providers)')
+    parser.add_argument('--total-timeout', type=float, default=None, help='Max total upstream request time in seconds (all providers)')
+    parser.add_argument('--models-reload-interval', type=float, default=2.0, help='Seconds between models.json change checks, 0 disables hot reload')
+    parser.add_argument('--token-refresh-margin', type=float, default=DEFAULT_TOKEN_REFRESH_MARGIN, help='Refresh Evalsone tokens this many seconds before they expire')
+    parser.add_argument('--rewrite-model-name', action='store_true', help='Report the gateway model name instead of the upstream id in DeepInfra/Pollinations responses')
+    parser.add_argument('--cache', action='store_true', help='Cache completions of identical requests')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_CACHE_TTL, help='Seconds a cached completion stays valid')
+    parser.add_argument('--cache-memory-mb', type=float, default=64, help='Size of the in-memory completion cache in MB')
+    parser.add_argument('--cache-file', default=None, help='SQLite file for a second, persistent completion cache tier')
+    parser.add_argument('--cache-file-mb', type=float, default=512, help='Size of the SQLite completion cache in MB')
+    parser.add_argument('--balance-ttl', type=float, default=DEFAULT_BALANCE_TTL, help='Seconds a cached /v1/balance answer is fresh, 0 disables the cache')
+    parser.add_argument('--balance-stale', type=float, default=DEFAULT_BALANCE_STALE, help='Seconds a stale balance is still served while it is refreshed in the background')
+    parser.add_argument('--balance-min-interval', type=float, default=DEFAULT_BALANCE_MIN_INTERVAL, help='Min seconds between upstream balance queries per account')
+    parser.add_argument('--coalesce', action='store_true', help='Let identical concurrent completions share one upstream call')
+    parser.add_argument('--trace-file', default=None, help='Write sampled per-request traces to this JSONL file')
+    parser.add_argument('--trace-sample-rate', type=float, default=0.01, help='Fraction of requests traced to --trace-file')
+    parser.add_argument('--trace-slow-ms', type=float, default=5000, help='Always trace requests slower than this many ms, 0 disables')
+    parser.add_argument('--profile', action='store_true', help='Start the sampling profiler at startup (toggle at runtime with POST /v1/profile)')
+    parser.add_argument('--profile-interval', type=float, default=DEFAULT_PROFILE_INTERVAL_MS, help='Milliseconds between profiler samples')
+    parser.add_argument('--profile-mode', choices=('cpu', 'wall'), default='cpu', help='cpu only counts threads that used CPU since the last sample')
+    parser.add_argument('--admin-token', default=None, help='Token required in X-Admin-Token for admin endpoints, otherwise only local clients may use them')
+    parser.add_argument('--adaptive-concurrency', action='store_true', help='Limit concurrent upstream calls per provider and model, adapting to latency and overload')
+    parser.add_argument('--concurrency-initial', type=float, default=16, help='Starting concurrency limit of each provider and model')
+    parser.add_argument('--concurrency-max', type=float, default=256, help='Upper bound of an adaptive concurrency limit')
+    parser.add_argument('--queue-size', type=int, default=64, help='Requests that may wait for a slot per provider and model, the rest get 503')
+    parser.add_argument('--queue-timeout', type=float, default=10, help='Max seconds a request waits for a slot')
+    parser.add_argument('--latency-tolerance', type=float, default=2.0, help='Shrink the limit when latency exceeds this multiple of the baseline')
+    parser.add_argument('--breaker-failures', type=int, default=5, help='Consecutive upstream failures that open the circuit breaker of a provider or model (0 disables)')
+    parser.add_argument('--breaker-cooldown', type=float, default=30, help='Seconds an open circuit fails fast before a probe request is let through')
+    parser.add_argument('--upstream-retries', type=int, default=2, help='Retries of connection failures and 429/502/503 answers before the first byte (0 disables)')
+    parser.add_argument('--retry-backoff', type=float, default=0.25, help='Base delay in seconds of the jittered exponential retry backoff')
+    parser.add_argument('--fair-queuing', action='store_true', help='Queue requests per tenant (Evalsone account or client IP) with weighted fair queuing, implies --adaptive-concurrency')
+    parser.add_argument('--tenant-weight', action='append', default=[], metavar='TENANT=WEIGHT', help='Fair queuing weight of an Evalsone account email or client IP, "default" for all others (repeatable, default 1)')
+    parser.add_argument('--upstream-url', action='append', default=[], metavar='PROVIDER=URL', help='Send a provider (ES, DI or PAI) to another base URL, e.g. a local stub')
+    parser.add_argument('--asgi', action='store_true', help='Serve with the native asyncio gateway (needs uvicorn and httpx)')
+    parser.add_argument('--no-compression', action='store_true', help='Never compress responses, even for clients sending Accept-Encoding')
+    parser.add_argument('--compress-min-bytes', type=int, default=DEFAULT_COMPRESS_MIN_BYTES, help='Smallest response body that is compressed')
+    parser.add_argument('--no-stream-compression', action='store_true', help='Send SSE streams uncompressed')
+    parser.add_argument('--conversations', action='store_true', help=f'Keep conversation histories server-side so {CONVERSATION_HEADER} clients only send the new messages of a turn')
+    parser.add_argument('--conversation-max', type=int, default=1024, help='Conversations kept in memory, the least recently used are evicted')
+    parser.add_argument('--conversation-memory-mb', type=float, default=256, help='Total size of the conversations kept in memory in MB')
+    parser.add_argument('--conversation-ttl', type=float, default=DEFAULT_CONVERSATION_TTL, help='Seconds an idle conversation is kept')
+    parser.add_argument('--batches', action='store_true', help='Serve the OpenAI-style /v1/files and /v1/batches API for offline jobs')
+    parser.add_argument('--batch-dir', default='batches', help='Directory of batch records, input and output files')
+    parser.add_argument('--batch-parallel', type=int, default=4, help='Concurrent batch requests per provider, shared by all batches')
+    parser.add_argument('--context-strategy', choices=CONTEXT_STRATEGIES, default='reject', help='What to do with a prompt over the model context window: reject it, drop the oldest turns or truncate the middle of the conversation')
+    parser.add_argument('--default-context-window', type=int, default=0, help='Context window in tokens of models without "context_window" in models.json, 0 leaves them unchecked')
+    parser.add_argument('--workers', type=int, default=1, help='Pre-forked worker processes sharing one listening socket (Unix only)')
+    parser.add_argument('--state-file', default=None, help=f'SQLite file sharing tokens, cache and limiter state between workers (default {DEFAULT_STATE_FILE} with --workers)')
+    return parser.parse_args(argv)
+
+def configure(args):
+    """Install the configuration parsed once at startup"""
+    global config
+    # The fair queues are the limiter queues, there is nothing to order without limits
+    if args.fair_queuing:
+        args.adaptive_concurrency = True
+    config = args
+    return config
+
+def upstream_address(url):
+    """(host, port) of an upstream base URL"""
+    parts = urlsplit(url)
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+def set_upstream_hosts(overrides=()):
+    """Apply --upstream-url PROVIDER=URL overrides to PROVIDER_HOSTS"""
+    for override in overrides:
+        provider, _, url = override.partition("=")
+        provider = provider.strip().upper()
+        if provider not in PROVIDER_HOSTS or not url:
+            raise ValueError(f"Invalid --upstream-url {override!r}, expected ES=URL, DI=URL or PAI=URL")
+        PROVIDER_HOSTS[provider] = url.rstrip("/")
+    UPSTREAM_PROVIDERS.clear()
+    UPSTREAM_PROVIDERS.update({upstream_address(url): provider for provider, url in PROVIDER_HOSTS.items()})
+
+set_upstream_hosts()
+
+def set_tenant_weights(overrides=()):
+    """Apply --tenant-weight TENANT=WEIGHT overrides to TENANT_WEIGHTS"""
+    for override in overrides:
+        tenant, _, weight = override.rpartition("=")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = 0
+        if not tenant or weight <= 0:
+            raise ValueError(f"Invalid --tenant-weight {override!r}, expected TENANT=WEIGHT with a positive weight")
+        TENANT_WEIGHTS[tenant.strip()] = weight
+
+def get_config():
+    """Configuration used by handlers and providers, defaults when api.py is imported"""
+    if config is None:
+        return configure(parse_args([]))
+    return config
+
+class LogWriter:
+    """Background thread that batches log lines to the console and LOG_FILE, with rotation"""
+
+    def __init__(self, args):
+        self.args = args
+        self.queue = queue.SimpleQueue()
+        self.log_file = None
+        self.opened_at = 0.0
+        self.checked_at = 0.0
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, console_line, file_line):
+        self.queue.put((console_line, file_line))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Drain whatever else is pending so one write covers the whole burst
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            batch = [entry for entry in batch if entry is not None]
+            console_lines = [console_line for console_line, _ in batch if console_line is not None]
+            file_lines = [file_line for _, file_line in batch if file_line is not None]
+            if console_lines:
+                print("\n".join(console_lines), flush=True)
+            if file_lines:
+                try:
+                    self.write_file("".join(file_lines))
+                except OSError as e:
+                    print(f"Error writing {LOG_FILE}: {e}", flush=True)
+            if stop:
+                if self.log_file:
+                    self.log_file.close()
+                return
+
+    def write_file(self, data):
+        if self.log_file is None:
+            self.log_file = open(LOG_FILE, "a")
+            self.opened_at = time.time()
+        elif not log_rotation:
+            # Only one process rotates, the others reopen logs.txt once it was moved away
+            if self.rotated_away():
+                self.log_file.close()
+                self.log_file = open(LOG_FILE, "a")
+                self.opened_at = time.time()
+        elif self.should_rotate():
+            self.rotate()
+        self.log_file.write(data)
+        self.log_file.flush()
+
+    def should_rotate(self):
+        if self.args.log_max_bytes and self.log_file.tell() >= self.args.log_max_bytes:
+            return True
+        return bool(self.args.log_rotate_interval) and time.time() - self.opened_at >= self.args.log_rotate_interval
+
+    def rotated_away(self):
+        now = time.time()
+        if now - self.checked_at < SHARED_SYNC_INTERVAL:
+            return False
+        self.checked_at = now
+        try:
+            return os.stat(LOG_FILE).st_ino != os.fstat(self.log_file.fileno()).st_ino
+        except OSError:
+            return True
+
+    def rotate(self):
+        """Shift logs.txt -> logs.txt.1 -> ... -> logs.txt.N and start a fresh file"""
+        self.log_file.close()
+        for index in range(self.args.log_backups - 1, 0, -1):
+            if os.path.exists(f"{LOG_FILE}.{index}"):
+                os.replace(f"{LOG_FILE}.{index}", f"{LOG_FILE}.{index + 1}")
+        if self.args.log_backups > 0:
+            os.replace(LOG_FILE, f"{LOG_FILE}.1")
+        else:
+            os.remove(LOG_FILE)
+        self.log_file = open(LOG_FILE, "a")
+        self.opened_at = time.time()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+log_writer = None
+log_writer_lock = threading.Lock()
+# Index of this process among the --workers, None when serving from a single process
+worker_index = None
+# Whether this process rotates LOG_FILE, with --workers only worker 0 does
+log_rotation = True
+
+def get_log_writer(args):
+    """Start the background log writer on first use"""
+    global log_writer
+    if log_writer is None:
+        with log_writer_lock:
+            if log_writer is None:
+                log_writer = LogWriter(args)
+                atexit.register(log_writer.close)
+    return log_writer
+
+def stop_log_writer():
+    """Flush and stop the background log writer, the next log line starts a new one"""
+    global log_writer
+    with log_writer_lock:
+        writer, log_writer = log_writer, None
+    if writer is not None:
+        atexit.unregister(writer.close)
+        writer.close()
 
 def log_message(message, level="info", args=None):
     """
     Log messages to both console and log file.
     """
     if args is None:
-        args = parse_args()  # Only parse args if not already passed in
+        args = get_config()
     
-    timestamp = time.strftime("[%Y-%m-%d %H:%M:%S]")
-    log_entry = f"{timestamp} [{level.upper()}] {message}\n"
+    console_line = None
+    file_line = None
 
     # Always log errors and general info, but only log debug info if verbose is enabled
     if level in ["info", "error"] or (args.verbose and level == "debug"):
-        print(log_entry.strip())  # Output to console
+        console_line = f"{time.strftime('[%Y-%m-%d %H:%M:%S]')} [{level.upper()}] {message}"
 
     if not args.disable_log:
-        with open(LOG_FILE, "a") as log_file:
-            log_file.write(log_entry)
+        if args.log_json:
+            file_line = json.dumps({"time": time.time(), "level": level, "message": str(message)}) + "\n"
+        else:
+            file_line = f"{time.strftime('[%Y-%m-%d %H:%M:%S]')} [{level.upper()}] {message}\n"
+
+    if console_line is not None or file_line is not None:
+        get_log_writer(args).write(console_line, file_line)
+
+class MetricsShard:
+    """Counters and histograms written by a single thread"""
+
+    def __init__(self):
+        # (name, label values) -> number
+        self.counters = {}
+        # (name, label values) -> [bucket counts..., +Inf count, sum, count]
+        self.histograms = {}
+
+    def merge(self, other):
+        # dict() and list() copies are atomic under the GIL, the owner may keep writing
+        for key, value in dict(other.counters).items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in dict(other.histograms).items():
+            values = list(values)
+            merged = self.histograms.get(key)
+            if merged is None:
+                self.histograms[key] = values
+            else:
+                for index, value in enumerate(values):
+                    merged[index] += value
+
+class ShardOwner:
+    """Kept only in the thread-local, its finalizer runs when the thread exits"""
+
+class Metrics:
+    """
+    Prometheus-style counters and histograms. Every thread writes to its own
+    shard without locking, /metrics merges the shards when it is scraped.
+    A thread's shard is folded into one retired shard as soon as the thread
+    exits, so a thread per connection doesn't pile up shards.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = set()
+        self.retired = MetricsShard()
+        self.lock = threading.Lock()
+        # Callables returning extra (name, type, help, [(labels dict, value)]) families at scrape time
+        self.collectors = []
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = MetricsShard()
+            # set.add is atomic under the GIL, a new thread takes no lock
+            self.shards.add(shard)
+            owner = self.local.owner = ShardOwner()
+            weakref.finalize(owner, self.retire, shard)
+        return shard
+
+    def retire(self, shard):
+        """Fold the shard of an exited thread into the retired totals"""
+        with self.lock:
+            self.retired.merge(shard)
+            self.shards.discard(shard)
+
+    def inc(self, name, labels=(), value=1):
+        counters = self.shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self.shard().histograms
+        key = (name, labels)
+        buckets = METRICS[name][3]
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 3)
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self):
+        """One shard with the totals of every thread"""
+        total = MetricsShard()
+        # Under the lock a shard is either still live or already retired, never both or neither
+        with self.lock:
+            live = list(self.shards)
+            total.merge(self.retired)
+        for shard in live:
+            total.merge(shard)
+        return total
+
+    def render(self):
+        """Prometheus text exposition format"""
+        total = self.collect()
+        by_name = {}
+        for (name, labels), value in total.counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in total.histograms.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in METRICS.items():
+            samples = by_name.get(name)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples):
+                label_text = format_metric_labels(dict(zip(label_names, labels)))
+                if kind != "histogram":
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), value):
+                    cumulative += count
+                    bucket_labels = format_metric_labels(dict(zip(label_names, labels), le=str(bound)))
+                    lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+                lines.append(f"{name}_sum{{{label_text}}} {value[-2]}")
+                lines.append(f"{name}_count{{{label_text}}} {value[-1]}")
+
+        for collector in self.collectors:
+            for name, kind, help_text, samples in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{{{format_metric_labels(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_metric_labels(labels):
+    """key="value" pairs with Prometheus escaping"""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return ",".join(pairs)
+
+metrics = Metrics()
+
+def record_request_metrics(provider, model, status, duration=None):
+    """Count a finished chat completion request, duration is None for streams (the relay records it)"""
+    labels = (provider or "unknown", model or "unknown")
+    metrics.inc("gateway_requests_total", labels + (str(status),))
+    if status >= 400:
+        error_class = ERROR_CLASSES.get(status, "server_error" if status >= 500 else "client_error")
+        metrics.inc("gateway_errors_total", (labels[0], error_class))
+    if duration is not None:
+        metrics.observe("gateway_request_duration_seconds", labels, duration)
+
+class Trace:
+    """
+    Timed spans of one chat completion. A streamed request finishes its trace
+    when the relay ends, every other request when its response is sent.
+    """
+
+    def __init__(self, trace_id=None, sampled=False):
+        self.trace_id = trace_id or os.urandom(8).hex()
+        self.sampled = sampled
+        self.started_at = time.monotonic()
+        self.started_wall = time.time()
+        self.spans = []
+        self.attributes = {}
+        self.streaming = False
+        self.finished = False
+
+    def add_span(self, name, started_at, ended_at=None, **attributes):
+        ended_at = time.monotonic() if ended_at is None else ended_at
+        span = {
+            "name": name,
+            "start_ms": round((started_at - self.started_at) * 1000, 3),
+            "duration_ms": round((ended_at - started_at) * 1000, 3),
+        }
+        if attributes:
+            span.update(attributes)
+        self.spans.append(span)
+
+    def finish(self, status=None):
+        """Export the trace if it was sampled or ran longer than --trace-slow-ms"""
+        if self.finished:
+            return
+        self.finished = True
+        duration_ms = (time.monotonic() - self.started_at) * 1000
+        slow_ms = trace_sink.slow_ms if trace_sink else 0
+        slow = bool(slow_ms) and duration_ms >= slow_ms
+        if trace_sink and (self.sampled or slow):
+            trace_sink.write(dict(
+                self.attributes,
+                trace_id=self.trace_id,
+                time=self.started_wall,
+                duration_ms=round(duration_ms, 3),
+                status=status,
+                reason="slow" if slow else "sampled",
+                spans=self.spans,
+            ))
+
+class TraceSink:
+    """Background thread that batches finished traces to a JSONL file"""
+
+    def __init__(self, path, sample_rate, slow_ms):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="trace-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def run(self):
+        with open(self.path, "a") as trace_file:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < 1000:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                lines = [json.dumps(record) + "\n" for record in batch if record is not None]
+                try:
+                    trace_file.write("".join(lines))
+                    trace_file.flush()
+                except OSError as e:
+                    print(f"Error writing {self.path}: {e}", flush=True)
+                if stop:
+                    return
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+trace_sink = None
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def init_tracing(args):
+    """Start the trace writer when --trace-file is set"""
+    global trace_sink
+    if args.trace_file:
+        trace_sink = TraceSink(args.trace_file, args.trace_sample_rate, args.trace_slow_ms)
+        atexit.register(trace_sink.close)
+        log_message(f"Tracing to {args.trace_file} (sample rate {args.trace_sample_rate}, slow {args.trace_slow_ms} ms)", "info", args)
+
+def start_trace(header_value=None):
+    """Trace of a new request, None when tracing is off. A valid client trace ID is kept."""
+    if trace_sink is None:
+        return None
+    trace_id = header_value if header_value and TRACE_ID_PATTERN.match(header_value) else None
+    trace = Trace(trace_id, random.random() < trace_sink.sample_rate)
+    current_trace.set(trace)
+    return trace
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the request threads. A background thread reads
+    sys._current_frames() every interval and counts collapsed stacks (root
+    first, ';' separated) per thread label, e.g. "chat_completions/ES".
+    Unlabeled threads are counted under their thread name. In cpu mode a
+    thread is only sampled when its CPU clock moved since the last sample,
+    so idle waits do not show up.
+    """
+
+    def __init__(self):
+        # thread ident -> label, written by request threads without locking
+        self.labels = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.running = False
+        # Bumped on every start, so a sampler stopped and restarted within one interval exits
+        self.generation = 0
+        self.interval = DEFAULT_PROFILE_INTERVAL_MS / 1000
+        self.mode = "cpu"
+        self.samples = 0
+        self.started_wall = None
+        # code object -> "file:function"
+        self.frame_names = {}
+        self.cpu_times = {}
+
+    def start(self, interval_ms=None, mode=None):
+        with self.lock:
+            if interval_ms:
+                self.interval = max(float(interval_ms), 1.0) / 1000
+            if mode in ("cpu", "wall"):
+                self.mode = mode
+            if self.mode == "cpu" and not hasattr(time, "pthread_getcpuclockid"):
+                self.mode = "wall"
+            if self.running:
+                return
+            self.running = True
+            self.generation += 1
+            self.started_wall = time.time()
+            threading.Thread(target=self.run, args=(self.generation,), name="profiler", daemon=True).start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.samples = 0
+            self.started_wall = time.time() if self.running else None
+
+    def label_thread(self, label):
+        if self.running:
+            self.labels[threading.get_ident()] = label
+
+    def clear_thread(self):
+        self.labels.pop(threading.get_ident(), None)
+
+    def run(self, generation):
+        own_ident = threading.get_ident()
+        while self.running and self.generation == generation:
+            time.sleep(self.interval)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            cpu_times = {}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident or not self.on_cpu(ident, cpu_times):
+                    continue
+                label = self.labels.get(ident) or names.get(ident, "unknown")
+                self.record(label, self.collapse(frame))
+            # Only keep the clocks of threads that still exist
+            self.cpu_times = cpu_times
+            self.samples += 1
+
+    def on_cpu(self, ident, cpu_times):
+        if self.mode != "cpu":
+            return True
+        try:
+            cpu_time = time.clock_gettime(time.pthread_getcpuclockid(ident))
+        except (OSError, OverflowError):
+            return True
+        cpu_times[ident] = cpu_time
+        previous = self.cpu_times.get(ident)
+        return previous is not None and cpu_time != previous
+
+    def collapse(self, frame):
+        names = []
+        frame_names = self.frame_names
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            name = frame_names.get(code)
+            if name is None:
+                name = frame_names[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+            names.append(name)
+            frame = frame.f_back
+        names.reverse()
+        return ";".join(names)
+
+    def record(self, label, stack):
+        key = (label, stack)
+        with self.lock:
+            if key not in self.counts and len(self.counts) >= PROFILE_MAX_STACKS:
+                key = (label, "[truncated]")
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def collapsed(self, label_prefix=None):
+        """Collapsed stacks ("label;frame;...;frame count" lines), ready for flamegraph.pl or speedscope"""
+        with self.lock:
+            counts = list(self.counts.items())
+        lines = [
+            f"{label};{stack} {count}" for (label, stack), count in sorted(counts)
+            if not label_prefix or label.startswith(label_prefix)
+        ]
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def get_stats(self):
+        with self.lock:
+            per_label = {}
+            for (label, _), count in self.counts.items():
+                per_label[label] = per_label.get(label, 0) + count
+            return {
+                "running": self.running,
+                "mode": self.mode,
+                "interval_ms": self.interval * 1000,
+                "samples": self.samples,
+                "since": self.started_wall,
+                "stacks": len(self.counts),
+                "labels": per_label,
+            }
+
+profiler = SamplingProfiler()
+
+def is_admin_request(remote_addr, admin_token_header, args=None):
+    """Admin endpoints need --admin-token when set, otherwise a local client"""
+    args = args or get_config()
+    if args.admin_token:
+        return admin_token_header == args.admin_token
+    return remote_addr in LOCAL_ADDRESSES
+
+def control_profiler(options):
+    """Apply a POST /v1/profile body: {"enabled": bool, "interval_ms": n, "mode": "cpu"|"wall", "reset": bool}"""
+    if options.get("reset"):
+        profiler.reset()
+    enabled = options.get("enabled")
+    if enabled is True:
+        profiler.start(options.get("interval_ms"), options.get("mode"))
+    elif enabled is False:
+        profiler.stop()
+    return profiler.get_stats()
+
+def upstream_span(request_params):
+    """Span name of the upstream call, which returns at the first byte when streaming"""
+    return "upstream_first_byte" if request_params["stream"] else "upstream_response"
+
+@contextmanager
+def trace_span(name, trace=None, **attributes):
+    """Time a block as a span of the given trace, or of the request's current trace"""
+    trace = trace or current_trace.get()
+    if trace is None:
+        yield
+        return
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        trace.add_span(name, started_at, **attributes)
+
+def build_models_list(models):
+    """Build the OpenAI /v1/models response body"""
+    model_list = []
+    for model in models:
+        model_list.append({
+            "id": model["model_name"],
+            "object": "model",
+            "created": 1999999999,
+            "owned_by": "system"
+        })
 
+    return {
+        "object": "list",
+        "data": model_list
+    }
+
+class ModelRegistry:
+    """Immutable model lookup tables and pre-serialized /v1/models payload"""
+
+    def __init__(self, models):
+        by_name = {}
+        by_key = {}
+        for model in models:
+            by_name[model["model_name"]] = model
+            by_key[(model["provider"], model["model_id"])] = model
+        # Aliases never shadow a real model name
+        for model in models:
+            for alias in model.get("aliases", []):
+                by_name.setdefault(alias, model)
+
+        self.models = tuple(models)
+        self.by_name = MappingProxyType(by_name)
+        self.by_key = MappingProxyType(by_key)
+        self.models_payload = json.dumps(build_models_list(self.models)).encode("utf-8")
+        self.etag = f'"{hashlib.sha1(self.models_payload).hexdigest()}"'
 
+    def get(self, model_name):
+        """Find a model by name or alias"""
+        return self.by_name.get(model_name)
+
+    def get_by_id(self, provider, model_id):
+        """Find a model by its provider and upstream id"""
+        return self.by_key.get((provider, model_id))
+
+model_registry = ModelRegistry([])
+models_file_signature = None
+
+def get_models_file_signature():
+    """mtime and size of models.json, or None when it is missing"""
+    try:
+        stat = os.stat(MODELS_FILE)
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
 
 def load_models():
-    """Load model mappings from models.json"""
-    global models_data
+    """Load model mappings from models.json and swap in a new registry"""
+    global model_registry, models_file_signature
+    signature = get_models_file_signature()
     try:
-        with open('models.json', 'r') as f:
+        with open(MODELS_FILE, 'r') as f:
             models = json.load(f)
+            registry = ModelRegistry(models)
             log_message(f"Loaded {len(models)} models from models.json", "info")
-            models_data = models
     except FileNotFoundError:
         log_message("models.json not found. Creating empty models list.", "error")
         return []
     except json.JSONDecodeError as e:
         log_message(f"Error parsing models.json: {e}", "error")
         return []
+    except (KeyError, TypeError, AttributeError) as e:
+        log_message(f"Invalid model entry in models.json: {e}", "error")
+        return []
+    finally:
+        models_file_signature = signature
+
+    # A single reference swap, requests in flight keep the registry they started with
+    model_registry = registry
+    return models
+
+def watch_models(args=None):
+    """Reload models.json in the background whenever it changes"""
+    interval = args.models_reload_interval if args else 2.0
+    if interval <= 0:
+        return
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            if get_models_file_signature() != models_file_signature:
+                log_message("models.json changed, reloading", "info", args)
+                load_models()
+
+    threading.Thread(target=watch, name="models-watcher", daemon=True).start()
+
+class SharedState:
+    """
+    State shared by the --workers processes through one SQLite file in WAL
+    mode: Evalsone tokens, and expiring values used as leases (one worker
+    logs in to an account at a time), failed login markers and open
+    circuit breakers. Each process opens its own connection after the fork.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=SHARED_STATE_TIMEOUT)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tokens (email TEXT PRIMARY KEY, token TEXT, updated REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS shared_values (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+        self.owner = str(os.getpid())
+        self.lock = threading.Lock()
+
+    def get_token(self, email):
+        with self.lock:
+            row = self.db.execute("SELECT token FROM tokens WHERE email = ?", (email,)).fetchone()
+        return row[0] if row else None
+
+    def put_token(self, email, token):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", (email, token, time.time()))
+
+    def tokens(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT email, token FROM tokens"))
+
+    def get(self, key):
+        """Value of key, None when missing or expired"""
+        with self.lock:
+            row = self.db.execute("SELECT value FROM shared_values WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO shared_values VALUES (?, ?, ?)", (key, str(value), time.time() + ttl))
+
+    def acquire(self, key, ttl):
+        """Take a lease that lapses after ttl seconds, False while another process holds it"""
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO shared_values VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE "
+                "SET value = excluded.value, expires = excluded.expires WHERE shared_values.expires <= ?",
+                (key, self.owner, now + ttl, now)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM shared_values WHERE key = ? AND value = ?", (key, self.owner))
+
+    def renew(self, key, ttl):
+        """Extend a lease this process holds, False when it lost it"""
+        with self.lock:
+            cursor = self.db.execute(
+                "UPDATE shared_values SET expires = ? WHERE key = ? AND value = ?", (time.time() + ttl, key, self.owner)
+            )
+            return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM shared_values WHERE key = ?", (key,))
+
+    def purge(self):
+        """Drop expired values, which get() already ignores"""
+        with self.lock:
+            self.db.execute("DELETE FROM shared_values WHERE expires <= ?", (time.time(),))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+shared_state = None
+
+def init_shared_state(args):
+    """Open the shared state of this process when --state-file is set"""
+    global shared_state
+    if args.state_file:
+        shared_state = SharedState(args.state_file)
+        if worker_index is None:
+            # A single process owns tokens.json itself, workers leave it to the parent
+            token_store.import_shared(shared_state)
+            atexit.register(token_store.export_shared, shared_state)
+        token_store.attach(shared_state)
+    return shared_state
+
+class RefreshFlight:
+    """One in-flight login that concurrent callers wait on"""
 
-def save_tokens(tokens_data):
-    """Save tokens to tokens.json"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.token = None
+
+class TokenStore:
+    """Evalsone access tokens by email, refreshed before their JWT exp and persisted write-behind"""
+
+    def __init__(self, path=TOKENS_FILE):
+        self.path = path
+        self.tokens = {}
+        self.expiry = {}
+        # Passwords are only kept in memory, to refresh tokens in the background
+        self.credentials = {}
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.refresh_margin = DEFAULT_TOKEN_REFRESH_MARGIN
+        # Single-flight logins and recent failures, keyed by (email, password)
+        self.flights = {}
+        self.failures = {}
+        # SharedState of the --workers processes, which then replaces tokens.json
+        self.shared = None
+
+    def attach(self, shared):
+        self.shared = shared
+
+    def load(self):
+        """Warm the store from tokens.json, skipping tokens that already expired"""
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            log_message("tokens.json not found. Creating new tokens file.", "info")
+            return
+        except json.JSONDecodeError as e:
+            log_message(f"Error parsing tokens.json: {e}", "error")
+            return
+
+        now = time.time()
+        with self.lock:
+            for email, entry in saved.items():
+                token = entry.get("access_token") if isinstance(entry, dict) else None
+                if not token:
+                    continue
+                expires_at = get_token_expiry(token)
+                if expires_at is not None and expires_at <= now:
+                    continue
+                self.tokens[email] = token
+                self.expiry[email] = expires_at
+        log_message(f"Loaded {len(self.tokens)} valid tokens from tokens.json", "debug")
+
+    def get(self, email):
+        """Cached token for email, or None when missing or about to expire"""
+        token = self.tokens.get(email)
+        if token is None or not self.usable(email):
+            # Another worker may have logged in already
+            return self.get_shared(email) if self.shared else None
+        return token
+
+    def usable(self, email):
+        expires_at = self.expiry.get(email)
+        return expires_at is None or expires_at - TOKEN_EXPIRY_SKEW > time.time()
+
+    def get_shared(self, email):
+        """Token another worker stored for email, if it is still usable"""
+        token = self.shared.get_token(email)
+        if token is None or token == self.tokens.get(email):
+            return None
+        with self.lock:
+            self.tokens[email] = token
+            self.expiry[email] = get_token_expiry(token)
+        return token if self.usable(email) else None
+
+    def set(self, email, token):
+        with self.lock:
+            self.tokens[email] = token
+            self.expiry[email] = get_token_expiry(token)
+        if self.shared:
+            self.shared.put_token(email, token)
+        else:
+            self.dirty.set()
+
+    def remember_credentials(self, email, password):
+        self.credentials[email] = password
+
+    def refresh(self, email, password, args=None, deadline=None, stale_token=None):
+        """
+        Log in again and store the new token. Concurrent refreshes of the same
+        credentials share one login, and a failed login is returned to every
+        caller for TOKEN_FAILURE_TTL seconds without retrying.
+        """
+        self.remember_credentials(email, password)
+        key = (email, password)
+        with self.lock:
+            # Someone else already logged in since the caller looked at the token
+            current = self.tokens.get(email)
+            if current is not None and current != stale_token and self.usable(email):
+                return current
+
+            failed_at = self.failures.get(key)
+            if failed_at is not None and time.monotonic() - failed_at < TOKEN_FAILURE_TTL:
+                log_message(f"Skipping login for {email}, it failed {time.monotonic() - failed_at:.1f}s ago", "debug", args)
+                metrics.inc("gateway_token_refreshes_total", ("skipped",))
+                return None
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = RefreshFlight()
+
+        if not leader:
+            metrics.inc("gateway_token_refreshes_total", ("shared",))
+            flight.done.wait(deadline.remaining() if deadline else None)
+            return flight.token
+
+        token = None
+        try:
+            token = self.login(email, password, args, deadline, stale_token)
+            if token and token != self.tokens.get(email):
+                self.set(email, token)
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if token:
+                    self.failures.pop(key, None)
+                else:
+                    self.failures[key] = time.monotonic()
+            metrics.inc("gateway_token_refreshes_total", ("ok" if token else "failed",))
+            flight.token = token
+            flight.done.set()
+        return token
+
+    def login(self, email, password, args=None, deadline=None, stale_token=None):
+        """
+        get_new_token, but with --workers only the worker holding the
+        account's login lease logs in and the others wait for its token
+        """
+        if not self.shared:
+            return get_new_token(email, password, args, deadline)
+        lease = f"login:{email}"
+        failure = "login_failed:" + hashlib.sha256(f"{email}\0{password}".encode("utf-8")).hexdigest()
+        while not self.shared.acquire(lease, TOKEN_LOGIN_LEASE):
+            if deadline and deadline.remaining() <= 0:
+                return None
+            time.sleep(SHARED_POLL_INTERVAL)
+            token = self.shared.get_token(email)
+            if token and token != stale_token:
+                metrics.inc("gateway_token_refreshes_total", ("shared",))
+                return token
+        try:
+            # The previous lease holder may have just stored a token, or failed with the same password
+            token = self.shared.get_token(email)
+            if token and token != stale_token:
+                return token
+            if self.shared.get(failure):
+                return None
+            token = get_new_token(email, password, args, deadline)
+            if not token:
+                self.shared.set(failure, 1, TOKEN_FAILURE_TTL)
+            return token
+        finally:
+            self.shared.release(lease)
+
+    def get_or_refresh(self, email, password, args=None, deadline=None):
+        """Cached token if still valid, otherwise a fresh one"""
+        self.remember_credentials(email, password)
+        return self.get(email) or self.refresh(email, password, args, deadline)
+
+    def start(self, args=None):
+        """Start the proactive refresher and the write-behind persister"""
+        if args:
+            self.refresh_margin = args.token_refresh_margin
+        threading.Thread(target=self.refresh_loop, args=(args,), name="token-refresher", daemon=True).start()
+        if not self.shared:
+            threading.Thread(target=self.persist_loop, name="token-persister", daemon=True).start()
+            atexit.register(self.flush)
+
+    def refresh_loop(self, args=None):
+        while True:
+            time.sleep(TOKEN_REFRESH_CHECK_INTERVAL)
+            now = time.time()
+            due = [
+                email for email, expires_at in list(self.expiry.items())
+                if expires_at is not None and expires_at - self.refresh_margin <= now and email in self.credentials
+            ]
+            for email in due:
+                log_message(f"Proactively refreshing token for {email}", "debug", args)
+                self.refresh(email, self.credentials[email], args, stale_token=self.tokens.get(email))
+
+    def persist_loop(self):
+        while True:
+            self.dirty.wait()
+            # Coalesce bursts of updates into one write
+            time.sleep(TOKEN_PERSIST_DELAY)
+            self.flush()
+
+    def import_shared(self, shared):
+        """Seed the shared store with tokens.json, keeping whichever token of an account expires last"""
+        current = shared.tokens()
+        for email, token in self.tokens.items():
+            stored = current.get(email)
+            if stored is None or (get_token_expiry(stored) or 0) < (self.expiry.get(email) or float("inf")):
+                shared.put_token(email, token)
+
+    def export_shared(self, shared):
+        """Write the tokens the workers stored back to tokens.json"""
+        tokens = shared.tokens()
+        with self.lock:
+            self.tokens.update(tokens)
+            self.expiry.update({email: get_token_expiry(token) for email, token in tokens.items()})
+        self.dirty.set()
+        self.flush()
+
+    def flush(self):
+        """Write tokens.json atomically (temp file + rename) if anything changed"""
+        if not self.dirty.is_set():
+            return
+        self.dirty.clear()
+        with self.lock:
+            snapshot = {email: {"access_token": token} for email, token in self.tokens.items()}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f, indent=4)
+            os.replace(tmp_path, self.path)
+            log_message("Successfully updated tokens.json", "debug")
+        except Exception as e:
+            log_message(f"Error saving tokens: {e}", "error")
+
+token_store = TokenStore()
+
+class TimedConnectMixin:
+    """Records how long opening an upstream connection (TCP + TLS) takes"""
+
+    def connect(self):
+        started = time.monotonic()
+        super().connect()
+        provider = UPSTREAM_PROVIDERS.get((self.host, self.port))
+        if provider:
+            metrics.observe("gateway_upstream_connect_seconds", (provider,), time.monotonic() - started)
+        trace = current_trace.get()
+        if trace:
+            trace.add_span("upstream_connect", started, host=self.host)
+
+class TimedHTTPConnection(TimedConnectMixin, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectMixin, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter that turns on TCP keep-alive probes for pooled sockets"""
+
+    def __init__(self, keepalive=True, **kwargs):
+        self.keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            socket_options = list(HTTPConnection.default_socket_options)
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+def create_upstream_session(pool_size=DEFAULT_POOL_SIZE, keepalive=True):
+    """Create a pooled keep-alive session for one upstream provider"""
+    session = requests.Session()
+    adapter = KeepAliveAdapter(
+        keepalive=keepalive,
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        max_retries=0
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def init_upstream_sessions(args=None):
+    """Create one shared session per provider, optionally pre-connecting"""
+    pool_size = args.pool_size if args else DEFAULT_POOL_SIZE
+    keepalive = not args.no_keepalive if args else True
+    with upstream_sessions_lock:
+        for provider in PROVIDER_HOSTS:
+            old_session = upstream_sessions.get(provider)
+            upstream_sessions[provider] = create_upstream_session(pool_size, keepalive)
+            if old_session:
+                old_session.close()
+
+    if args and args.preconnect:
+        threads = [
+            threading.Thread(target=preconnect_upstream, args=(provider, args), daemon=True)
+            for provider in PROVIDER_HOSTS
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+def get_session(provider):
+    """Get the shared session for a provider, creating it on first use"""
+    session = upstream_sessions.get(provider)
+    if session is None:
+        with upstream_sessions_lock:
+            session = upstream_sessions.get(provider)
+            if session is None:
+                session = create_upstream_session()
+                upstream_sessions[provider] = session
+    return session
+
+def preconnect_upstream(provider, args=None):
+    """Warm up the connection pool of a provider with a cheap HEAD request"""
+    proxies = {"http": args.proxy, "https": args.proxy} if args and args.proxy else None
     try:
-        with open('tokens.json', 'w') as f:
-            json.dump(tokens_data, f, indent=4)
-        log_message("Successfully updated tokens.json", "debug")
-    except Exception as e:
-        log_message(f"Error saving tokens: {e}", "error")
+        get_session(provider).head(PROVIDER_HOSTS[provider], proxies=proxies, timeout=10)
+        log_message(f"Pre-connected to {provider} upstream", "debug", args)
+    except requests.exceptions.RequestException as e:
+        log_message(f"Pre-connect to {provider} upstream failed: {e}", "error", args)
+
+def get_pool_stats():
+    """Collect open/idle/reused/created connection counts per provider pool"""
+    stats = {}
+    for provider, session in list(upstream_sessions.items()):
+        provider_stats = {"open": 0, "idle": 0, "reused": 0, "created": 0, "requests": 0}
+        for adapter in set(session.adapters.values()):
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for key in manager.pools.keys():
+                    pool = manager.pools.get(key)
+                    if pool is None or pool.pool is None:
+                        continue
+                    idle = sum(1 for conn in list(pool.pool.queue) if conn is not None and getattr(conn, "sock", None) is not None)
+                    in_use = pool.pool.maxsize - pool.pool.qsize()
+                    provider_stats["idle"] += idle
+                    provider_stats["open"] += idle + in_use
+                    provider_stats["created"] += pool.num_connections
+                    provider_stats["requests"] += pool.num_requests
+                    provider_stats["reused"] += max(pool.num_requests - pool.num_connections, 0)
+        stats[provider] = provider_stats
+    return stats
+
+class UpstreamTimeout(Exception):
+    """Raised when an upstream connect, first-byte, idle or total deadline trips"""
+
+class RequestDeadline:
+    """Upstream timeouts of one client request plus its absolute total deadline"""
+
+    def __init__(self, timeouts, budget=None):
+        self.timeouts = timeouts
+        total = timeouts["total"] if budget is None else min(timeouts["total"], budget)
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + total
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def request_timeout(self):
+        """(connect, first byte) timeout tuple for requests, capped by the time left"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise UpstreamTimeout("Request deadline exceeded")
+        return (min(self.timeouts["connect"], remaining), min(self.timeouts["first_byte"], remaining))
+
+    def idle_timeout(self):
+        """Max wait for the next stream chunk, capped by the time left"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise UpstreamTimeout("Upstream stream exceeded the request deadline")
+        return min(self.timeouts["idle"], remaining)
+
+def get_timeouts(provider, model_info=None, args=None):
+    """Merge provider defaults, CLI overrides and per-model models.json "timeouts" """
+    timeouts = dict(DEFAULT_TIMEOUTS[provider])
+    if args:
+        for key in timeouts:
+            value = getattr(args, f"{key}_timeout", None)
+            if value is not None:
+                timeouts[key] = value
+    if model_info and isinstance(model_info.get("timeouts"), dict):
+        timeouts.update({key: float(value) for key, value in model_info["timeouts"].items() if key in timeouts})
+    return timeouts
+
+def make_deadline(provider, model_info=None, args=None, header_value=None):
+    """Build the deadline of a request, honoring a client supplied X-Request-Deadline (seconds)"""
+    budget = None
+    if header_value:
+        try:
+            budget = max(float(header_value), 0.0)
+        except ValueError:
+            log_message(f"Ignoring invalid {DEADLINE_HEADER} header: {header_value}", "debug", args)
+    return RequestDeadline(get_timeouts(provider, model_info, args), budget)
+
+def timeout_error(message="Upstream request timed out"):
+    """OpenAI-style error body for a tripped deadline"""
+    return {"error": {"message": message, "type": "timeout_error", "param": None, "code": UPSTREAM_TIMEOUT}}
+
+def timeout_stream_frames(message="Upstream request timed out"):
+    """Final SSE frames sent to the client when a stream deadline trips"""
+    return f"data: {json.dumps(timeout_error(message))}\n\ndata: [DONE]\n\n"
+
+def set_read_timeout(response, seconds):
+    """Change the socket read timeout of a streaming response"""
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        sock.settimeout(seconds)
 
-def load_tokens():
-    """Load tokens from tokens.json"""
-    global tokens_data
+class ClosingIterator:
+    """Iterator whose close() also releases the upstream resources, even if iteration never started"""
+
+    def __init__(self, iterator, *closables):
+        self.iterator = iterator
+        self.closables = closables
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.iterator)
+
+    def close(self):
+        for closable in (self.iterator,) + self.closables:
+            close = getattr(closable, "close", None)
+            if close:
+                close()
+
+def iter_upstream_lines(response, deadline):
+    """iter_lines() with idle and total deadlines that always releases the upstream socket"""
+    return ClosingIterator(_iter_upstream_lines(response, deadline), response)
+
+def _iter_upstream_lines(response, deadline):
     try:
-        with open('tokens.json', 'r') as f:
-            tokens_data = json.load(f)
-            log_message("Successfully loaded tokens.json", "debug")
-    except FileNotFoundError:
-        log_message("tokens.json not found. Creating new tokens file.", "info")
-    except json.JSONDecodeError as e:
-        log_message(f"Error parsing tokens.json: {e}", "error")
+        lines = response.iter_lines()
+        while True:
+            set_read_timeout(response, deadline.idle_timeout())
+            try:
+                line = next(lines)
+            except StopIteration:
+                return
+            except requests.exceptions.ConnectionError as e:
+                # urllib3 read timeouts surface as ConnectionError while iterating
+                if e.args and isinstance(e.args[0], ReadTimeoutError):
+                    raise UpstreamTimeout("Upstream stream stalled") from e
+                raise
+            yield line
+    finally:
+        response.close()
+
+def iter_upstream_bytes(response, deadline):
+    """Upstream body chunks exactly as they arrive, with idle and total deadlines, always releasing the socket"""
+    return ClosingIterator(_iter_upstream_bytes(response, deadline), response)
+
+def _iter_upstream_bytes(response, deadline):
+    try:
+        raw = response.raw
+        # read1() returns whatever one socket read produced instead of waiting for a full buffer.
+        # Upstreams are asked for identity, an encoded body is still decoded rather than relayed as is
+        while True:
+            set_read_timeout(response, deadline.idle_timeout())
+            try:
+                chunk = raw.read1(STREAM_READ_SIZE, decode_content=True)
+            except ReadTimeoutError as e:
+                raise UpstreamTimeout("Upstream stream stalled") from e
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        response.close()
+
+class SSEModelRewriter:
+    """Replaces the upstream model id with the gateway model name, on complete SSE events only"""
+
+    def __init__(self, model_id, model_name):
+        escaped_id = json_dumps_bytes(model_id)[1:-1]
+        self.pattern = re.compile(rb'("model"\s*:\s*)"' + re.escape(escaped_id) + rb'"')
+        self.model_name = json_dumps_bytes(model_name)
+        self.pending = bytearray()
+
+    def replace(self, match):
+        return match.group(1) + self.model_name
+
+    def feed(self, chunk):
+        """Rewritten bytes of every event completed by this chunk, the rest stays buffered"""
+        self.pending += chunk
+        boundary = max(self.pending.rfind(b"\n\n") + 2, self.pending.rfind(b"\r\n\r\n") + 4)
+        if boundary < 2:
+            return b""
+        complete = bytes(self.pending[:boundary])
+        del self.pending[:boundary]
+        return self.pattern.sub(self.replace, complete)
+
+    def flush(self):
+        rest = bytes(self.pending)
+        self.pending.clear()
+        return self.pattern.sub(self.replace, rest)
+
+def relay_sse(chunks, rewriter=None):
+    """Forward upstream SSE bytes, reframing only when the model name has to be rewritten"""
+    if rewriter is None:
+        return chunks
+    return ClosingIterator(_rewrite_sse(chunks, rewriter), chunks)
+
+def _rewrite_sse(chunks, rewriter):
+    for chunk in chunks:
+        data = rewriter.feed(chunk)
+        if data:
+            yield data
+    rest = rewriter.flush()
+    if rest:
+        yield rest
 
 def decode_auth_token(auth_token):
     """Decode base64 auth token to get email and password"""
@@ -104,14 +1590,16 @@ def decode_auth_token(auth_token):
         log_message(f"Error decoding auth token: {e}", "error")
         return None, None
 
-def get_new_token(email, password, args=None):
+def get_new_token(email, password, args=None, deadline=None):
     """Get new access token from Evalsone API"""
-    login_url = "https://api.evalsone.com/api/user/login"
+    deadline = deadline or make_deadline("ES", args=args)
+    login_url = f"{PROVIDER_HOSTS['ES']}/api/user/login"
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0",
         "Accept": "application/json, text/plain, */*",
         "Accept-Language": "en-US,fr;q=0.8,fr-FR;q=0.5,en;q=0.3",
-        "Accept-Encoding": "gzip, deflate, br, zstd",
+        # Only the codecs urllib3 can actually decode here (br and zstd need optional packages)
+        "Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING,
         "Content-Type": "application/json;charset=utf-8",
         "Origin": "https://consolex.ai",
         "DNT": "1",
@@ -124,11 +1612,12 @@ def get_new_token(email, password, args=None):
     
     try:
         log_message(f"Attempting to get new token for {email}", "info", args)
-        response = requests.post(
+        response = get_session("ES").post(
             login_url,
             headers=headers,
             json={"email": email, "password": password},
-            proxies=proxies
+            proxies=proxies,
+            timeout=deadline.request_timeout()
         )
         response.raise_for_status()
         token = response.json().get("access_token")
@@ -138,6 +1627,9 @@ def get_new_token(email, password, args=None):
         else:
             log_message(f"Unexpected response: {response.text}", "error", args)
             return None
+    except UpstreamTimeout as e:
+        log_message(f"Error getting new token: {e}", "error", args)
+        return None
     except requests.exceptions.RequestException as e:
         log_message(f"Error getting new token: {e}", "error", args)
         return None
@@ -148,7 +1640,7 @@ def get_new_token(email, password, args=None):
 
 def verify_credentials(email, password, args=None):
     """Verify credentials with Evalsone API without saving token"""
-    login_url = "https://api.evalsone.com/api/user/login"
+    login_url = f"{PROVIDER_HOSTS['ES']}/api/user/login"
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:136.0) Gecko/20100101 Firefox/136.0",
         "Accept": "application/json, text/plain, */*",
@@ -160,19 +1652,20 @@ def verify_credentials(email, password, args=None):
     proxies = {"http": args.proxy, "https": args.proxy} if args and args.proxy else None
     
     try:
-        response = requests.post(
+        response = get_session("ES").post(
             login_url,
             headers=headers,
             json={"email": email, "password": password},
-            proxies=proxies
+            proxies=proxies,
+            timeout=make_deadline("ES", args=args).request_timeout()
         )
         return response.status_code == 200
     except:
         return False
 
-def send_evalsone_request(messages, token, model_id, request_params, args=None):
-    """Send request to Evalsone API"""
-    api_url = "https://api.evalsone.com/api/llm/chatcomplete"
+def build_evalsone_request(messages, token, model_id, request_params):
+    """Build the URL, headers and payload for an Evalsone completion"""
+    api_url = f"{PROVIDER_HOSTS['ES']}/api/llm/chatcomplete"
 
     payload = {
         "messages": messages,
@@ -199,112 +1692,146 @@ def send_evalsone_request(messages, token, model_id, request_params, args=None):
         "Blade-auth": token
     }
 
+    return api_url, headers, payload
+
+def build_evalsone_chunk(stream_id, created_time, model_name, content, finish_reason, usage=None):
+    """Build one OpenAI chat.completion.chunk from Evalsone stream data"""
+    return {
+        "id": stream_id,
+        "object": "chat.completion.chunk",
+        "created": created_time,
+        "model": model_name,
+        "choices": [{
+            "index": 0,
+            "delta": {
+                "role": "assistant",
+                "content": content,
+                "tool_calls": None
+            },
+            "finish_reason": finish_reason,
+            "logprobs": None
+        }],
+        "system_fingerprint": "fp_06737a9306",
+        "usage": usage
+    }
+
+class EvalsoneTranscoder:
+    """
+    Streaming Evalsone SSE -> OpenAI chunk converter. The chunk envelope of a
+    stream is serialized once, each token only splices in its escaped content
+    and finish_reason.
+    """
+
+    CONTENT_MARKER = "\x00content\x00"
+    FINISH_MARKER = "\x00finish\x00"
+
+    def __init__(self, model_name, stream_id=None, created_time=None):
+        self.model_name = model_name
+        self.stream_id = stream_id or f"chatcmpl-{int(time.time())}"
+        self.created_time = created_time or int(time.time())
+        self.finished = False
+
+        envelope = json.dumps(build_evalsone_chunk(
+            self.stream_id, self.created_time, model_name, self.CONTENT_MARKER, self.FINISH_MARKER
+        ))
+        head, rest = envelope.split(json.dumps(self.CONTENT_MARKER), 1)
+        middle, tail = rest.split(json.dumps(self.FINISH_MARKER), 1)
+        self.head = b"data: " + head.encode("utf-8")
+        self.middle = middle.encode("utf-8")
+        self.tail = tail.encode("utf-8") + b"\n\n"
+
+    def transcode(self, line):
+        """OpenAI SSE frame for one Evalsone line, or None when the line is skipped"""
+        # Handle existing data: prefix from Evalsone
+        if not line.startswith(b"data: "):
+            return None
+        try:
+            evalsone_chunk = json_loads(line[6:])
+            choices = evalsone_chunk.get("choices") or [{}]
+            content = choices[0].get("delta", {}).get("content") or ""
+            finish_reason = evalsone_chunk.get("finish_reason")
+        except (ValueError, AttributeError, TypeError):
+            return None
+
+        # Skip empty content chunks except final one
+        if not content and not finish_reason:
+            return None
+        if finish_reason == "stop":
+            self.finished = True
+
+        finish = FINISH_REASON_JSON.get(finish_reason) or json_dumps_bytes(finish_reason)
+        return b"".join((self.head, json_dumps_bytes(content), self.middle, finish, self.tail))
+
+    def final_frames(self):
+        """Mandatory stop chunk if Evalsone did not send one, then [DONE]"""
+        frames = b""
+        if not self.finished:
+            final_chunk = build_evalsone_chunk(self.stream_id, self.created_time, self.model_name, "", "stop", {})
+            frames = f"data: {json.dumps(final_chunk)}\n\n".encode("utf-8")
+        return frames + b"data: [DONE]\n\n"
+
+def format_evalsone_response(response_data, model_name):
+    """Convert a non-streaming Evalsone response into the internal result dict"""
+    return {
+        "content": response_data.get("choices", [{}])[0].get("message", {}).get("content", ""),
+        "model": model_name,
+        "object": "chat.completion",
+        "created": int(time.time())
+    }
+
+def send_evalsone_request(messages, token, model_id, request_params, args=None, deadline=None):
+    """Send request to Evalsone API"""
+    api_url, headers, payload = build_evalsone_request(messages, token, model_id, request_params)
+    deadline = deadline or make_deadline("ES", args=args)
+
     proxies = {"http": args.proxy, "https": args.proxy} if args and args.proxy else None
 
     try:
-        model_name = next((m["model_name"] for m in models_data if m["model_id"] == model_id), None)
-        response = requests.post(
+        model_info = model_registry.get_by_id("ES", model_id)
+        model_name = model_info["model_name"] if model_info else None
+        response = get_session("ES").post(
             api_url,
             headers=headers,
             json=payload,
             proxies=proxies,
-            stream=payload["stream"]
+            stream=payload["stream"],
+            timeout=deadline.request_timeout()
         )
         
         if response.status_code == 401:
+            response.close()
             return None, "token_expired"
             
         response.raise_for_status()
 
         if payload["stream"]:
+            # Yields complete OpenAI SSE frames as bytes
             def generate():
-                stream_id = f"chatcmpl-{int(time.time())}"
-                created_time = int(time.time())
-                received_final_chunk = False
-
-                for line in response.iter_lines():
-                    if line:
-                        raw_data = line.decode('utf-8').strip()
-                        
-                        # Handle existing data: prefix from Evalsone
-                        if raw_data.startswith("data: "):
-                            clean_data = raw_data[6:]  # Remove Evalsone's data: prefix
-                            
-                            try:
-                                evalsone_chunk = json.loads(clean_data)
-                                
-                                # Skip empty content chunks except final one
-                                content = evalsone_chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                finish_reason = evalsone_chunk.get("finish_reason")
-                                
-                                if not content and not finish_reason:
-                                    continue
-                                
-                                # Transform to target format
-                                target_chunk = {
-                                    "id": stream_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created_time,
-                                    "model": model_name,
-                                    "choices": [{
-                                        "index": 0,
-                                        "delta": {
-                                            "role": "assistant",
-                                            "content": content,
-                                            "tool_calls": None
-                                        },
-                                        "finish_reason": finish_reason,
-                                        "logprobs": None
-                                    }],
-                                    "system_fingerprint": "fp_06737a9306",
-                                    "usage": None
-                                }
-                                
-                                # Send the transformed chunk
-                                yield f"{json.dumps(target_chunk)}\n\n"
-                                
-                                if finish_reason == "stop":
-                                    received_final_chunk = True
+                transcoder = EvalsoneTranscoder(model_name)
+                lines = iter_upstream_lines(response, deadline)
+                try:
+                    for line in lines:
+                        if line:
+                            frame = transcoder.transcode(line)
+                            if frame is not None:
+                                yield frame
+                                if transcoder.finished:
                                     break
+                finally:
+                    lines.close()
+                yield transcoder.final_frames()
 
-                            except json.JSONDecodeError:
-                                continue
-
-                # Add mandatory stop chunk if not received
-                if not received_final_chunk:
-                    final_chunk = {
-                        "id": stream_id,
-                        "object": "chat.completion.chunk",
-                        "created": created_time,
-                        "model": model_name,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {
-                                "role": "assistant",
-                                "content": "",
-                                "tool_calls": None
-                            },
-                            "finish_reason": "stop",
-                            "logprobs": None
-                        }],
-                        "system_fingerprint": "fp_06737a9306",
-                        "usage": {}
-                    }
-                    yield f"{json.dumps(final_chunk)}\n\n"
-
-                yield "[DONE]\n\n"
-
-            return generate(), None
+            return ClosingIterator(generate(), response), None
 
         # Handle non-streaming response
-        response_data = response.json()
-        return {
-            "content": response_data.get("choices", [{}])[0].get("message", {}).get("content", ""),
-            "model": model_name,
-            "object": "chat.completion",
-            "created": int(time.time())
-        }, None
+        return format_evalsone_response(response.json(), model_name), None
 
+    except (requests.exceptions.Timeout, UpstreamTimeout) as e:
+        log_message(f"Evalsone request timed out: {e}", "error", args)
+        return None, UPSTREAM_TIMEOUT
+    except requests.exceptions.ConnectionError as e:
+        log_message(f"Evalsone connection failed: {e}", "error", args)
+        return None, f"{CONNECT_ERROR_PREFIX}{e}"
     except requests.exceptions.RequestException as e:
         log_message(f"Request failed: {e}", "error", args)
         return None, str(e)
@@ -312,9 +1839,9 @@ def send_evalsone_request(messages, token, model_id, request_params, args=None):
         log_message(f"Unexpected error: {e}", "error", args)
         return None, str(e)
 
-def send_deepinfra_request(messages, model_id, request_params, args=None):
-    """Send request to DeepInfra API"""
-    api_url = "https://api.deepinfra.com/v1/openai/chat/completions"
+def build_deepinfra_request(messages, model_id, request_params):
+    """Build the URL, headers and payload for a DeepInfra completion, or raise ValueError"""
+    api_url = f"{PROVIDER_HOSTS['DI']}/v1/openai/chat/completions"
     
     # Ensure each message has 'role' and 'content'
     formatted_messages = []
@@ -325,8 +1852,7 @@ def send_deepinfra_request(messages, model_id, request_params, args=None):
                 'content': msg['content']
             })
         else:
-            log_message(f"Invalid message format: {msg}", "error", args)
-            return None, "Invalid message format"
+            raise ValueError(f"Invalid message format: {msg}")
     
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0",
@@ -337,6 +1863,9 @@ def send_deepinfra_request(messages, model_id, request_params, args=None):
         "Referer": "https://deepinfra.com/",
         "X-Deepinfra-Source": "web-page"
     }
+    if request_params.get("stream", False):
+        # Streams are relayed as raw socket reads, ask for the body unencoded
+        headers["Accept-Encoding"] = "identity"
 
     payload = {
         "model": model_id,
@@ -354,34 +1883,43 @@ def send_deepinfra_request(messages, model_id, request_params, args=None):
     if request_params.get("frequency_penalty") is not None:
         payload["frequency_penalty"] = request_params["frequency_penalty"]
 
+    return api_url, headers, payload
+
+def send_deepinfra_request(messages, model_id, request_params, args=None, deadline=None):
+    """Send request to DeepInfra API"""
+    deadline = deadline or make_deadline("DI", args=args)
+    try:
+        api_url, headers, payload = build_deepinfra_request(messages, model_id, request_params)
+    except ValueError as e:
+        log_message(str(e), "error", args)
+        return None, "Invalid message format"
+
     proxies = {"http": args.proxy, "https": args.proxy} if args and args.proxy else None
 
     try:
-        response = requests.post(
+        response = get_session("DI").post(
             api_url,
             headers=headers,
             json=payload,
             proxies=proxies,
-            stream=payload["stream"]
+            stream=payload["stream"],
+            timeout=deadline.request_timeout()
         )
         
         response.raise_for_status()
         
         if payload["stream"]:
-            def generate():
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            # Decode using utf-8 and handle any encoding issues
-                            decoded_line = line.decode('utf-8')
-                            yield decoded_line
-                        except UnicodeDecodeError as e:
-                            log_message(f"Unicode decode error: {e}", "error", args)
-                            continue
-            return generate(), None
+            # DeepInfra already speaks OpenAI SSE, relay its bytes untouched
+            return iter_upstream_bytes(response, deadline), None
             
         return response.json(), None
 
+    except (requests.exceptions.Timeout, UpstreamTimeout) as e:
+        log_message(f"DeepInfra request timed out: {e}", "error", args)
+        return None, UPSTREAM_TIMEOUT
+    except requests.exceptions.ConnectionError as e:
+        log_message(f"DeepInfra connection failed: {e}", "error", args)
+        return None, f"{CONNECT_ERROR_PREFIX}{e}"
     except requests.exceptions.HTTPError as e:
         log_message(f"DeepInfra HTTP error: {e.response.text}", "error", args)
         return None, f"HTTP {e.response.status_code}: {e.response.text}"
@@ -389,13 +1927,16 @@ def send_deepinfra_request(messages, model_id, request_params, args=None):
         log_message(f"DeepInfra request failed: {e}", "error", args)
         return None, str(e)
 
-def send_pai_request(messages, model_id, request_params, args=None):
-    """Send request to Pollinations AI API"""
-    api_url = "https://text.pollinations.ai/openai"
+def build_pai_request(messages, model_id, request_params):
+    """Build the URL, headers and payload for a Pollinations AI completion"""
+    api_url = f"{PROVIDER_HOSTS['PAI']}/openai"
     
     headers = {
         "Content-Type": "application/json"
     }
+    if request_params.get("stream", False):
+        # Streams are relayed as raw socket reads, ask for the body unencoded
+        headers["Accept-Encoding"] = "identity"
 
     payload = {
         "model": model_id,
@@ -403,35 +1944,49 @@ def send_pai_request(messages, model_id, request_params, args=None):
         "stream": request_params.get("stream", False)
     }
 
+    return api_url, headers, payload
+
+def clean_pai_response(response_data):
+    """Remove content filter results and usage data from a PAI response"""
+    if "choices" in response_data and len(response_data["choices"]) > 0:
+        for choice in response_data["choices"]:
+            if "content_filter_results" in choice:
+                del choice["content_filter_results"]
+    if "usage" in response_data:
+        del response_data["usage"]
+    return response_data
+
+def send_pai_request(messages, model_id, request_params, args=None, deadline=None):
+    """Send request to Pollinations AI API"""
+    deadline = deadline or make_deadline("PAI", args=args)
+    api_url, headers, payload = build_pai_request(messages, model_id, request_params)
+
     proxies = {"http": args.proxy, "https": args.proxy} if args and args.proxy else None
 
     try:
-        response = requests.post(
+        response = get_session("PAI").post(
             api_url,
             headers=headers,
             json=payload,
             proxies=proxies,
-            stream=payload["stream"]
+            stream=payload["stream"],
+            timeout=deadline.request_timeout()
         )
         
         response.raise_for_status()
         
         if payload["stream"]:
-            return response.iter_lines(), None
+            return iter_upstream_bytes(response, deadline), None
             
         # For non-streaming responses, clean up the response
-        response_data = response.json()
-        
-        # Remove content filter results and usage data
-        if "choices" in response_data and len(response_data["choices"]) > 0:
-            for choice in response_data["choices"]:
-                if "content_filter_results" in choice:
-                    del choice["content_filter_results"]
-        if "usage" in response_data:
-            del response_data["usage"]
-            
-        return response_data, None
+        return clean_pai_response(response.json()), None
 
+    except (requests.exceptions.Timeout, UpstreamTimeout) as e:
+        log_message(f"PAI request timed out: {e}", "error", args)
+        return None, UPSTREAM_TIMEOUT
+    except requests.exceptions.ConnectionError as e:
+        log_message(f"PAI connection failed: {e}", "error", args)
+        return None, f"{CONNECT_ERROR_PREFIX}{e}"
     except requests.exceptions.RequestException as e:
         log_message(f"PAI request failed: {e}", "error", args)
         return None, str(e)
@@ -439,25 +1994,37 @@ def send_pai_request(messages, model_id, request_params, args=None):
         log_message(f"Unexpected error in PAI request: {e}", "error", args)
         return None, str(e)
 
+def decode_jwt_payload(token):
+    """Decode the claims of a JWT without verifying it"""
+    # Get the payload part (second segment) of the JWT
+    payload = token.split('.')[1]
+    # Add padding if needed
+    payload += '=' * (-len(payload) % 4)
+    # Decode base64 and parse JSON
+    return json.loads(base64.urlsafe_b64decode(payload).decode('utf-8'))
+
 def get_user_id_from_token(token):
     """Extract user ID from JWT token"""
     try:
-        # Get the payload part (second segment) of the JWT
-        payload = token.split('.')[1]
-        # Add padding if needed
-        payload += '=' * (-len(payload) % 4)
-        # Decode base64 and parse JSON
-        decoded = json.loads(base64.b64decode(payload).decode('utf-8'))
-        return decoded.get('sub')
+        return decode_jwt_payload(token).get('sub')
     except Exception as e:
         log_message(f"Error decoding JWT token: {e}", "error")
         return None
 
-def get_balance_info(token, user_id, args=None):
-    """Get balance info from Evalsone API"""
-    api_url = "https://api.evalsone.com/api/balance/get_info"
-    
-    headers = {
+def get_token_expiry(token):
+    """Unix time of the JWT exp claim, or None when the token has none"""
+    try:
+        exp = decode_jwt_payload(token).get('exp')
+        return float(exp) if exp is not None else None
+    except Exception as e:
+        log_message(f"Error decoding JWT token: {e}", "error")
+        return None
+
+def get_balance_info(token, user_id, args=None):
+    """Get balance info from Evalsone API"""
+    api_url = f"{PROVIDER_HOSTS['ES']}/api/balance/get_info"
+    
+    headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0",
         "Accept": "application/json, text/plain, */*",
         "Content-Type": "application/json;charset=utf-8",
@@ -469,11 +2036,12 @@ def get_balance_info(token, user_id, args=None):
     proxies = {"http": args.proxy, "https": args.proxy} if args and args.proxy else None
 
     try:
-        response = requests.post(
+        response = get_session("ES").post(
             api_url,
             headers=headers,
             json={"user_id": user_id},
-            proxies=proxies
+            proxies=proxies,
+            timeout=make_deadline("ES", args=args).request_timeout()
         )
         
         if response.status_code == 401:
@@ -499,57 +2067,2569 @@ def get_balance_info(token, user_id, args=None):
         log_message(f"Unexpected error in balance request: {e}", "error", args)
         return None, str(e)
 
-@app.route("/v1/balance", methods=["GET"])
-def get_balance():
-    args = parse_args()
+def fetch_balance(auth_header, args=None):
+    """Resolve credentials and fetch the balance, returns (response body, status code)"""
+    if not auth_header:
+        log_message("Missing Authorization header for balance request", "error", args)
+        return {"error": "Missing Authorization header"}, 401
+
+    email, password = decode_auth_token(auth_header)
+    if not email or not password:
+        log_message("Invalid authorization token for balance request", "error", args)
+        return {"error": "Invalid authorization token"}, 401
+
+    token = token_store.get_or_refresh(email, password, args)
+    if not token:
+        return {"error": "Failed to authenticate"}, 401
+
+    user_id = get_user_id_from_token(token)
+    if not user_id:
+        return {"error": "Failed to extract user ID from token"}, 500
+
+    result, error = get_balance_info(token, user_id, args)
+    
+    if error == "token_expired":
+        token = token_store.refresh(email, password, args, stale_token=token)
+        if token:
+            user_id = get_user_id_from_token(token)
+            if user_id:
+                result, error = get_balance_info(token, user_id, args)
+            else:
+                return {"error": "Failed to extract user ID from new token"}, 500
+        else:
+            return {"error": "Failed to refresh token"}, 401
+    
+    if error:
+        return {"error": f"Balance request failed: {error}"}, 500
+
+    # Add PAI category to the result
+    if result:
+        result["PAI_balance"] = "unlimited"
+        result["PAI_user_id"] = "n/a"
+        
+    return result, 200
+
+class BalanceCache:
+    """
+    /v1/balance answers per Evalsone account. A fresh entry is returned as is,
+    a stale one is returned while a single background refresh runs, and only
+    a missing or expired entry waits on the upstream. Completions made with an
+    account take the "request_cost" of their model off its cached balance, or
+    without one mark it as spent, so the next poll revalidates it in the
+    background.
+    """
+
+    def __init__(self):
+        # email -> {"password", "result", "fetched_at", "attempted_at", "spent", "refreshing"}
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Concurrent misses for the same account wait on one upstream query
+        self.fetch_locks = {}
+        self.stats = dict.fromkeys(("hits", "stale_hits", "misses", "refreshes", "errors"), 0)
+
+    def get(self, auth_header, args=None):
+        """(response body, status code) for a balance request"""
+        args = args or get_config()
+        if args.balance_ttl <= 0:
+            return fetch_balance(auth_header, args)
+        email, password = decode_auth_token(auth_header) if auth_header else (None, None)
+        if not email or not password:
+            # Let fetch_balance produce the usual 401
+            return fetch_balance(auth_header, args)
+
+        cached = self.lookup(email, password, auth_header, args)
+        if cached is not None:
+            return cached, 200
+
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(email, threading.Lock())
+        with fetch_lock:
+            # Someone else may have fetched it while we waited
+            cached = self.lookup(email, password, auth_header, args, count=False)
+            if cached is not None:
+                return cached, 200
+            with self.lock:
+                self.stats["misses"] += 1
+            return self.load(email, password, auth_header, args)
+
+    def lookup(self, email, password, auth_header, args, count=True):
+        """Copy of a usable cached balance or None, starts a refresh when it is stale"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is None or entry["password"] != password:
+                return None
+            age = now - entry["fetched_at"]
+            if age < args.balance_ttl and not entry["spent"]:
+                if count:
+                    self.stats["hits"] += 1
+                return dict(entry["result"])
+            if age >= args.balance_ttl + args.balance_stale:
+                return None
+            if count:
+                self.stats["stale_hits"] += 1
+            # Failed refreshes are retried at the same bounded rate
+            revalidate = not entry["refreshing"] and now - entry["attempted_at"] >= args.balance_min_interval
+            if revalidate:
+                entry["refreshing"] = True
+                entry["attempted_at"] = now
+            result = dict(entry["result"])
+
+        if revalidate:
+            threading.Thread(
+                target=self.load, args=(email, password, auth_header, args), name="balance-refresh", daemon=True
+            ).start()
+        return result
+
+    def load(self, email, password, auth_header, args):
+        """Query the upstream balance and store it if it succeeded"""
+        try:
+            result, status = fetch_balance(auth_header, args)
+        except Exception as e:
+            log_message(f"Balance refresh for {email} failed: {e}", "error", args)
+            result, status = {"error": str(e)}, 500
+        with self.lock:
+            self.stats["refreshes"] += 1
+            entry = self.entries.get(email)
+            if status == 200:
+                now = time.monotonic()
+                self.entries[email] = {
+                    "password": password,
+                    "result": result,
+                    "fetched_at": now,
+                    "attempted_at": now,
+                    "spent": False,
+                    "refreshing": False,
+                }
+                self.evict(now, args)
+            else:
+                self.stats["errors"] += 1
+                if entry is not None:
+                    entry["refreshing"] = False
+        return dict(result) if status == 200 else result, status
+
+    def evict(self, now, args):
+        """Drop expired entries and the fetch locks nobody holds, called with self.lock held"""
+        expired = [email for email, entry in self.entries.items()
+                   if now - entry["fetched_at"] >= args.balance_ttl + args.balance_stale]
+        for email in expired:
+            del self.entries[email]
+        for email in [email for email, lock in self.fetch_locks.items() if email not in self.entries and not lock.locked()]:
+            del self.fetch_locks[email]
+
+    def note_activity(self, email, cost):
+        """
+        An account spent cost credits on a completion: take them off its cached
+        balance, or serve it stale until revalidated when the cost is unknown
+        """
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is None:
+                return
+            balance = entry["result"].get("ES_balance")
+            if cost and isinstance(balance, (int, float)):
+                entry["result"] = dict(entry["result"], ES_balance=round(balance - cost, 6))
+            else:
+                entry["spent"] = True
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, accounts=len(self.entries))
+
+balance_cache = BalanceCache()
+
+def parse_completion_request(data, args=None):
+    """Validate a chat completion body, returns (model_info, messages, request_params) and an error tuple"""
+    if not isinstance(data, dict):
+        log_message("Request body is not a JSON object", "error", args)
+        return None, ("Invalid JSON in request body", 400)
+
+    messages = data.get("messages", [])
+    if not messages:
+        log_message("No messages in request", "error", args)
+        return None, ("No messages provided", 400)
+
+    model_name = data.get("model", "")
+    if not model_name:
+        log_message("No model name provided", "error", args)
+        return None, ("Model name is required", 400)
+
+    model_info = model_registry.get(model_name)
+    if not model_info:
+        log_message(f"Invalid model name: {model_name}", "error", args)
+        return None, ("Invalid model name", 400)
+
+    request_params = {
+        "max_tokens": data.get("max_tokens"),
+        "frequency_penalty": data.get("frequency_penalty"),
+        "presence_penalty": data.get("presence_penalty"),
+        "temperature": data.get("temperature"),
+        "stream": data.get("stream", False)
+    }
+    return (model_info, messages, request_params), None
+
+@lru_cache(maxsize=4096)
+def encoded_length(text):
+    """UTF-8 size of a non-ASCII string, cached since conversations resend their history"""
+    return len(text.encode("utf-8", "surrogatepass"))
+
+def estimate_text_tokens(text):
+    """Estimated tokens of a string, O(1) for ASCII text"""
+    size = len(text) if text.isascii() else encoded_length(text)
+    return -(-size // BYTES_PER_TOKEN)
+
+def estimate_message_tokens(message):
+    """Estimated tokens of one chat message, text parts of multi-part content included"""
+    content = message.get("content") if isinstance(message, dict) else None
+    if isinstance(content, str):
+        tokens = estimate_text_tokens(content)
+    elif isinstance(content, list):
+        tokens = sum(
+            estimate_text_tokens(part["text"]) for part in content
+            if isinstance(part, dict) and isinstance(part.get("text"), str)
+        )
+    else:
+        tokens = 0
+    return tokens + MESSAGE_TOKEN_OVERHEAD
+
+def context_length_error(window, prompt_tokens, output_tokens):
+    """OpenAI-style error body for a prompt that can't fit the context window"""
+    message = (
+        f"This model's maximum context length is {window} tokens, however you requested about "
+        f"{prompt_tokens + output_tokens} tokens ({prompt_tokens} in the messages, {output_tokens} in the completion). "
+        "Please reduce the length of the messages or completion."
+    )
+    return {"error": {"message": message, "type": "invalid_request_error", "param": "messages", "code": "context_length_exceeded"}}
+
+def truncate_middle_text(text, excess):
+    """text shortened by about excess tokens cut out of its middle, None when too little would be left"""
+    tokens = estimate_text_tokens(text)
+    target = tokens - excess - estimate_text_tokens(TRUNCATION_MARKER)
+    if target <= 0:
+        return None
+    keep = len(text) * target // tokens
+    head = keep // 2
+    return text[:head] + TRUNCATION_MARKER + text[len(text) - (keep - head):]
+
+def trim_messages(messages, sizes, budget, strategy):
+    """
+    Drop turns (drop_oldest, truncate_middle) and cut the middle out of the
+    longest message (truncate_middle) until the estimate fits the budget.
+    System messages and the last message are always kept, truncate_middle
+    also keeps the first turn. Returns (messages, outcome) or None.
+    """
+    pinned = {index for index, message in enumerate(messages) if isinstance(message, dict) and message.get("role") == "system"}
+    pinned.add(len(messages) - 1)
+    if strategy == "truncate_middle":
+        pinned.add(next((index for index in range(len(messages)) if index not in pinned), 0))
+
+    kept = [True] * len(messages)
+    total = sum(sizes)
+    outcome = None
+    index = 0
+    while total > budget and index < len(messages):
+        if index in pinned or not kept[index] or (isinstance(messages[index], dict) and messages[index].get("role") == "tool"):
+            index += 1
+            continue
+        kept[index] = False
+        total -= sizes[index]
+        outcome = "dropped"
+        # Tool results are useless without the assistant turn that asked for them
+        following = index + 1
+        while following < len(messages) and following not in pinned and isinstance(messages[following], dict) and messages[following].get("role") == "tool":
+            kept[following] = False
+            total -= sizes[following]
+            following += 1
+        index = following
+
+    fitted = [message for message, keep in zip(messages, kept) if keep]
+    if total > budget and strategy == "truncate_middle":
+        fitted_sizes = [size for size, keep in zip(sizes, kept) if keep]
+        longest = max(
+            (index for index, message in enumerate(fitted) if isinstance(message.get("content"), str)),
+            key=fitted_sizes.__getitem__, default=None
+        )
+        if longest is not None:
+            content = truncate_middle_text(fitted[longest]["content"], total - budget)
+            if content is not None:
+                fitted[longest] = dict(fitted[longest], content=content)
+                total += estimate_message_tokens(fitted[longest]) - fitted_sizes[longest]
+                outcome = "truncated"
+    return (fitted, outcome) if total <= budget else None
+
+def fit_context(model_info, messages, request_params, args=None):
+    """
+    Check a request against the "context_window" and "max_output_tokens"
+    of its model before anything is sent upstream. max_tokens is clamped to
+    the output limit, a prompt over the window is trimmed or rejected as
+    --context-strategy says. Returns messages and an error tuple.
+    """
+    args = args or get_config()
+    max_output = model_info.get("max_output_tokens")
+    requested = request_params.get("max_tokens")
+    if not isinstance(requested, int) or requested <= 0:
+        requested = 0
+    elif max_output and requested > max_output:
+        request_params["max_tokens"] = requested = max_output
+
+    window = model_info.get("context_window") or args.default_context_window
+    if not window:
+        return messages, None
+    sizes = [estimate_message_tokens(message) for message in messages]
+    prompt_tokens = sum(sizes)
+    budget = window - requested
+    if prompt_tokens <= budget:
+        return messages, None
+
+    labels = (model_info["provider"], model_info["model_name"])
+    if args.context_strategy != "reject" and budget > 0:
+        trimmed = trim_messages(messages, sizes, budget, args.context_strategy)
+        if trimmed:
+            fitted, outcome = trimmed
+            metrics.inc("gateway_context_fits_total", labels + (outcome,))
+            log_message(
+                f"Fit ~{prompt_tokens} prompt tokens into {budget} for {model_info['model_name']}: "
+                f"{outcome}, {len(messages) - len(fitted)} of {len(messages)} messages dropped", "debug", args
+            )
+            return fitted, None
+
+    metrics.inc("gateway_context_fits_total", labels + ("rejected",))
+    log_message(f"Rejected ~{prompt_tokens} prompt tokens over the {window} token window of {model_info['model_name']}", "debug", args)
+    return None, (context_length_error(window, prompt_tokens, requested), 400)
+
+def build_completion_response(result, model_name):
+    """Wrap an Evalsone result dict into an OpenAI chat.completion body"""
+    return {
+        "id": str(result["created"]),
+        "object": result.get("object", "chat.completion"),
+        "created": result.get("created", int(time.time())),
+        "model": model_name,
+        "choices": [{"message": {"role": "assistant", "content": result.get("content", "")}}]
+    }
+
+def model_rewriter(model_info, args=None):
+    """SSEModelRewriter for a DI/PAI stream when --rewrite-model-name is on"""
+    if args and args.rewrite_model_name and model_info["model_id"] != model_info["model_name"]:
+        return SSEModelRewriter(model_info["model_id"], model_info["model_name"])
+    return None
+
+def rewrite_model_name(result, model_info, args=None):
+    """Report the gateway model name in a non-streaming DI/PAI response when --rewrite-model-name is on"""
+    if args and args.rewrite_model_name and isinstance(result, dict) and "model" in result:
+        result["model"] = model_info["model_name"]
+    return result
+
+PROVIDER_LABELS = {"ES": "Evalsone", "DI": "DeepInfra", "PAI": "PAI"}
+STREAM_OUTCOMES = ("completed", "cancelled", "timed_out", "failed")
+stream_stats = {provider: dict.fromkeys(("active", "started") + STREAM_OUTCOMES, 0) for provider in PROVIDER_HOSTS}
+stream_stats_lock = threading.Lock()
+
+def record_stream_event(provider, event):
+    """Count a stream start or its outcome for /v1/streams"""
+    with stream_stats_lock:
+        stats = stream_stats[provider]
+        stats[event] += 1
+        stats["active"] += 1 if event == "started" else -1
+
+def get_stream_stats():
+    """Snapshot of the per-provider stream counters"""
+    with stream_stats_lock:
+        return {PROVIDER_LABELS[provider]: dict(stats) for provider, stats in stream_stats.items()}
+
+class StreamMeter:
+    """
+    Time to first chunk, chunk gaps, volume and duration of one relayed
+    stream. It takes over the request's trace and finishes it with the stream.
+    """
+
+    def __init__(self, provider, model=None, started_at=None):
+        self.labels = (provider, model or "unknown")
+        self.relay_started_at = time.monotonic()
+        self.started_at = started_at or self.relay_started_at
+        self.last_sent = None
+        self.sent_bytes = 0
+        self.sent_chunks = 0
+        self.trace = current_trace.get()
+        if self.trace:
+            self.trace.streaming = True
+
+    def sent(self, frame):
+        now = time.monotonic()
+        if self.last_sent is None:
+            metrics.observe("gateway_time_to_first_token_seconds", self.labels, now - self.started_at)
+            if self.trace:
+                self.trace.add_span("stream_first_chunk", self.relay_started_at, now)
+        else:
+            metrics.observe("gateway_stream_chunk_gap_seconds", self.labels, now - self.last_sent)
+        self.last_sent = now
+        self.sent_bytes += len(frame)
+        self.sent_chunks += 1
+
+    def finish(self, outcome):
+        labels = self.labels
+        metrics.observe("gateway_request_duration_seconds", labels, time.monotonic() - self.started_at)
+        metrics.inc("gateway_relayed_bytes_total", labels, self.sent_bytes)
+        metrics.inc("gateway_relayed_chunks_total", labels, self.sent_chunks)
+        if outcome in ("timed_out", "failed"):
+            metrics.inc("gateway_errors_total", (labels[0], f"stream_{outcome}"))
+        if self.trace:
+            self.trace.add_span("stream_relay", self.relay_started_at, outcome=outcome, chunks=self.sent_chunks, bytes=self.sent_bytes)
+            self.trace.finish(200)
+
+@lru_cache(maxsize=256)
+def negotiate_encoding(accept_encoding):
+    """Response codec for an Accept-Encoding header, None for identity"""
+    weights = {}
+    for item in accept_encoding.lower().split(","):
+        codec, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[codec.strip()] = weight
+    wildcard = weights.get("*", 0.0)
+    best, best_weight = None, 0.0
+    for codec in RESPONSE_CODECS:
+        weight = weights.get(codec, wildcard)
+        if weight > best_weight:
+            best, best_weight = codec, weight
+    return best
+
+def encoding_varies(mimetype, streamed, args=None):
+    """Whether a response is compressed for some Accept-Encoding, so it needs Vary: Accept-Encoding"""
+    args = args or get_config()
+    if args.no_compression or (streamed and args.no_stream_compression):
+        return False
+    return (mimetype or "").split(";")[0].strip() in COMPRESSIBLE_MIMETYPES
+
+def response_codec(accept_encoding, mimetype, streamed, args=None):
+    """Codec to compress a response with, None to send it as is"""
+    if not accept_encoding or not encoding_varies(mimetype, streamed, args):
+        return None
+    return negotiate_encoding(accept_encoding)
+
+def weak_etag(etag):
+    """ETag of a re-encoded body: its bytes differ per codec, so it is only weakly the same resource"""
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+def compress_body(body, codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if codec == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+class StreamCompressor:
+    """
+    Compresses a stream chunk by chunk and flushes after every chunk, so an
+    SSE frame reaches the client as soon as it is relayed. Frames still
+    share one compression window, which is where the savings come from.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        if codec == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif codec == "br":
+            self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        if self.codec == "zstd":
+            return self.compressor.compress(chunk) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.codec == "br":
+            return self.compressor.process(chunk) + self.compressor.flush()
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.codec == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+def brotli_decompress(body, limit):
+    """Inflate a brotli body, stopping once the output passes limit bytes"""
+    decompressor = brotli.Decompressor()
+    output = bytearray()
+    for start in range(0, len(body), BROTLI_INPUT_CHUNK):
+        output += decompressor.process(body[start:start + BROTLI_INPUT_CHUNK])
+        if len(output) > limit:
+            return bytes(output)
+    if not decompressor.is_finished():
+        raise brotli.error("truncated brotli stream")
+    return bytes(output)
+
+class RequestBodyError(ValueError):
+    """A request body that cannot be decoded, with the status to answer"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def decode_request_body(body, content_encoding):
+    """
+    Request body with its Content-Encoding undone. Raises RequestBodyError for
+    an unknown codec (415), a corrupt body (400) or one that inflates past
+    MAX_REQUEST_BODY_BYTES (413).
+    """
+    codecs = [codec.strip().lower() for codec in (content_encoding or "").split(",") if codec.strip()]
+    # Codecs are listed in the order they were applied
+    for codec in reversed(codecs):
+        if codec == "identity":
+            continue
+        try:
+            if codec in ("gzip", "x-gzip", "deflate"):
+                # 47 detects gzip and zlib headers, raw deflate streams need -15
+                wbits = 47 if codec != "deflate" or body[:1] == b"\x78" else -15
+                decompressor = zlib.decompressobj(wbits)
+                body = decompressor.decompress(body, MAX_REQUEST_BODY_BYTES + 1)
+            elif codec == "br" and brotli:
+                body = brotli_decompress(body, MAX_REQUEST_BODY_BYTES)
+            elif codec == "zstd" and zstandard:
+                body = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read(MAX_REQUEST_BODY_BYTES + 1)
+            else:
+                raise RequestBodyError(f"Unsupported Content-Encoding: {codec}", 415)
+        except DECODE_ERRORS as e:
+            raise RequestBodyError(f"Invalid {codec} request body: {e}")
+        if len(body) > MAX_REQUEST_BODY_BYTES:
+            raise RequestBodyError("Decompressed request body is too large", 413)
+    return body
+
+class RequestDecompressor:
+    """WSGI middleware undoing the Content-Encoding of request bodies before Flask reads them"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        content_encoding = environ.get("HTTP_CONTENT_ENCODING")
+        if content_encoding:
+            length = environ.get("CONTENT_LENGTH")
+            stream = environ["wsgi.input"]
+            if length:
+                try:
+                    length = int(length)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    response = Response(json.dumps({"error": "Invalid Content-Length header"}), status=400, mimetype="application/json")
+                    return response(environ, start_response)
+                body = stream.read(min(length, MAX_REQUEST_BODY_BYTES + 1))
+            elif environ.get("wsgi.input_terminated"):
+                body = stream.read(MAX_REQUEST_BODY_BYTES + 1)
+            else:
+                body = b""
+            try:
+                body = decode_request_body(body, content_encoding)
+            except RequestBodyError as e:
+                response = Response(json.dumps({"error": str(e)}), status=e.status, mimetype="application/json")
+                return response(environ, start_response)
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = RequestDecompressor(app.wsgi_app)
+
+class CompressedStream:
+    """Response iterable compressing the chunks of another, which it closes along with itself"""
+
+    def __init__(self, chunks, codec):
+        self.chunks = chunks
+        self.compressor = StreamCompressor(codec)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if chunk:
+                yield self.compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+        yield self.compressor.finish()
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close:
+            close()
+
+class StreamRelay:
+    """
+    Relays SSE frames (bytes) to the client and ends with a clean error frame
+    if the upstream fails. The WSGI server calls close() when the client goes
+    away, which closes the upstream response at once and counts the stream as
+    cancelled.
+    """
+
+    def __init__(self, frames, provider, args=None, model=None, started_at=None):
+        self.frames = frames
+        self.provider = provider
+        self.args = args
+        self.meter = StreamMeter(provider, model, started_at)
+        self.outcome = None
+        self.closed = False
+        self.relay = self.generate()
+        record_stream_event(provider, "started")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.relay)
+
+    def finish(self, outcome):
+        if self.outcome is None:
+            self.outcome = outcome
+            record_stream_event(self.provider, outcome)
+            self.meter.finish(outcome)
+            profiler.clear_thread()
+
+    def generate(self):
+        label = PROVIDER_LABELS[self.provider]
+        sent = self.meter.sent
+        try:
+            for frame in self.frames:
+                sent(frame)
+                yield frame
+            self.finish("completed")
+        except UpstreamTimeout as e:
+            log_message(f"{label} stream timed out: {e}", "error", self.args)
+            self.finish("timed_out")
+            yield timeout_stream_frames(str(e)).encode("utf-8")
+        except Exception as e:
+            log_message(f"Stream encoding error: {e}", "error", self.args)
+            self.finish("failed")
+            yield b"data: [ERROR] Failed to encode response\n\n"
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.outcome is None:
+            log_message(f"Client disconnected, cancelling {PROVIDER_LABELS[self.provider]} stream", "debug", self.args)
+        self.finish("cancelled")
+        self.relay.close()
+        close = getattr(self.frames, "close", None)
+        if close:
+            close()
+
+def relay_stream(frames, provider, args=None, flight=None, model=None, started_at=None):
+    """Streaming Flask response that cancels the upstream when the client disconnects"""
+    if flight:
+        frames = flight.publish_stream(frames)
+    relay = StreamRelay(frames, provider, args, model, started_at)
+    response = Response(stream_with_context(relay), mimetype='text/event-stream')
+    # stream_with_context does not pass close() on to a relay it never started iterating
+    response.call_on_close(relay.close)
+    return response
+
+class CompletionCache:
+    """
+    Completion bodies (serialized chat.completion JSON) by request hash. A
+    size-bounded LRU lives in memory, an optional SQLite file behind it keeps
+    entries across restarts. Both tiers expire entries after the TTL.
+    """
+
+    def __init__(self, ttl, max_memory_bytes, path=None, max_file_bytes=0):
+        self.ttl = ttl
+        self.max_memory_bytes = max_memory_bytes
+        self.max_file_bytes = max_file_bytes
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.db = None
+        self.puts_since_evict = 0
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, expires REAL, accessed REAL, size INTEGER, body BLOB)"
+            )
+            self.evict_file()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            if entry:
+                self.drop(key)
+            row = None
+            if self.db:
+                row = self.db.execute("SELECT expires, body FROM completions WHERE key = ?", (key,)).fetchone()
+                if row and row[0] <= now:
+                    self.db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                    row = None
+                elif row:
+                    self.db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+            if not row:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.remember(key, row[0], bytes(row[1]))
+            return bytes(row[1])
+
+    def put(self, key, body):
+        now = time.time()
+        expires = now + self.ttl
+        with self.lock:
+            self.stats["stores"] += 1
+            self.remember(key, expires, body)
+            if self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                    (key, expires, now, len(body), body)
+                )
+                self.puts_since_evict += 1
+                if self.puts_since_evict >= CACHE_FILE_EVICT_EVERY:
+                    self.evict_file()
+
+    def remember(self, key, expires, body):
+        """Insert into the memory tier and evict least recently used entries past the size limit"""
+        if len(body) > self.max_memory_bytes:
+            return
+        if key in self.entries:
+            self.drop(key)
+        self.entries[key] = (expires, body)
+        self.memory_bytes += len(body)
+        while self.memory_bytes > self.max_memory_bytes:
+            self.drop(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def drop(self, key):
+        self.memory_bytes -= len(self.entries.pop(key)[1])
+
+    def evict_file(self):
+        """Delete expired rows, then least recently used rows until the file tier fits its size limit"""
+        self.puts_since_evict = 0
+        self.db.execute("DELETE FROM completions WHERE expires <= ?", (time.time(),))
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_file_bytes:
+            return
+        victims = []
+        for key, size in self.db.execute("SELECT key, size FROM completions ORDER BY accessed"):
+            if total <= self.max_file_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        self.db.executemany("DELETE FROM completions WHERE key = ?", victims)
+        self.stats["evictions"] += len(victims)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, entries=len(self.entries), memory_bytes=self.memory_bytes)
+            if self.db:
+                stats["file_entries"], stats["file_bytes"] = self.db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+                ).fetchone()
+            return stats
+
+completion_cache = None
+
+def init_completion_cache(args):
+    """Create the completion cache when --cache is set"""
+    global completion_cache
+    if args.cache:
+        completion_cache = CompletionCache(
+            args.cache_ttl,
+            int(args.cache_memory_mb * 1024 * 1024),
+            args.cache_file,
+            int(args.cache_file_mb * 1024 * 1024)
+        )
+        log_message(f"Completion cache enabled (ttl {args.cache_ttl}s, file: {args.cache_file or 'none'})", "info", args)
+
+def completion_cache_key(model_info, messages, request_params, owner=""):
+    """Canonical hash of the upstream model, the messages, the sampling params (stream excluded) and the owner"""
+    params = {name: value for name, value in request_params.items() if name != "stream" and value is not None}
+    canonical = json.dumps(
+        [model_info["provider"], model_info["model_id"], messages, params, owner],
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def request_cache_policy(cache_control=None, bypass=None):
+    """
+    (may_reuse, may_store) from the request headers. Cache-Control: no-cache
+    asks for a fresh result, no-store keeps the result out of the cache and
+    X-Cache-Bypass does both.
+    """
+    if (bypass or "").lower() in ("1", "true", "yes"):
+        return False, False
+    directives = {directive.strip().lower() for directive in (cache_control or "").split(",")}
+    return "no-cache" not in directives, "no-store" not in directives
+
+def cache_owner(model_info, auth_header):
+    """
+    Owner part of a cache key: Evalsone completions are billed to and only
+    visible to the account that made them, so they are keyed by its
+    credentials. DeepInfra and PAI answers are shared.
+    """
+    return credentials_owner(auth_header) if model_info["provider"] == "ES" else ""
+
+def evalsone_auth_error(model_info, auth_header, args=None):
+    """(message, 401) when an Evalsone request lacks usable credentials, checked before any cache is consulted"""
+    if model_info["provider"] != "ES":
+        return None
+    if not auth_header:
+        log_message("Missing Authorization header for Evalsone model", "error", args)
+        return "Missing Authorization header", 401
+    email, password = decode_auth_token(auth_header)
+    if not email or not password:
+        log_message("Invalid authorization token for Evalsone model", "error", args)
+        return "Invalid authorization token", 401
+    return None
+
+def cache_plan(model_info, messages, request_params, cache_control=None, bypass=None, auth_header=None):
+    """(lookup_key, store_key) for a completion request, either is None when it must not be used"""
+    may_reuse, may_store = request_cache_policy(cache_control, bypass)
+    if completion_cache is None or not (may_reuse or may_store):
+        return None, None
+    key = completion_cache_key(model_info, messages, request_params, cache_owner(model_info, auth_header))
+    return (key if may_reuse else None), (key if may_store else None)
+
+def replay_completion_stream(body):
+    """SSE frames (bytes) replaying a cached chat.completion body"""
+    result = json_loads(body)
+    choice = (result.get("choices") or [{}])[0]
+    message = choice.get("message") or {}
+    delta = {"role": "assistant", "content": message.get("content") or ""}
+    if message.get("reasoning_content"):
+        delta["reasoning_content"] = message["reasoning_content"]
+    head = {
+        "id": result.get("id"),
+        "object": "chat.completion.chunk",
+        "created": result.get("created") or int(time.time()),
+        "model": result.get("model")
+    }
+    chunks = (
+        dict(head, choices=[{"index": 0, "delta": delta, "finish_reason": None}]),
+        dict(head, choices=[{"index": 0, "delta": {}, "finish_reason": choice.get("finish_reason") or "stop"}])
+    )
+    return b"".join(b"data: " + json_dumps_bytes(chunk) + b"\n\n" for chunk in chunks) + b"data: [DONE]\n\n"
+
+def cached_completion(lookup_key, stream):
+    """(body, mimetype) of a cache hit, or None"""
+    if not lookup_key:
+        return None
+    body = completion_cache.get(lookup_key)
+    if body is None:
+        return None
+    if stream:
+        return replay_completion_stream(body), "text/event-stream"
+    return body, "application/json"
+
+def completion_sink(store_key=None, conversation=None):
+    """
+    Callback taking the finished chat.completion of a request, which stores
+    it in the completion cache and appends the turn to its conversation.
+    None when neither wants it, so streams are not captured for nothing.
+    """
+    if not store_key and not conversation:
+        return None
+
+    def sink(result):
+        if store_key:
+            completion_cache.put(store_key, json_dumps_bytes(result))
+        if conversation:
+            conversation_id, owner, messages, new = conversation
+            conversation_store.append_turn(conversation_id, owner, messages, result, new)
+
+    return sink
+
+def cache_result(result, sink):
+    """Hand a non-streaming completion body to its sink and back unchanged"""
+    if sink:
+        sink(result)
+    return result
+
+class StreamCapture:
+    """Reassembles a chat.completion from the OpenAI SSE frames of a stream"""
+
+    def __init__(self):
+        self.buffer = b""
+        self.content = []
+        self.reasoning = []
+        self.finish_reason = None
+        self.done = False
+        self.id = None
+        self.model = None
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        *events, self.buffer = self.buffer.split(b"\n\n")
+        for event in events:
+            for line in event.split(b"\n"):
+                if line.startswith(b"data:"):
+                    self.parse(line[5:].strip())
+
+    def parse(self, data):
+        if data == b"[DONE]":
+            self.done = True
+            return
+        try:
+            chunk = json_loads(data)
+            choice = (chunk.get("choices") or [{}])[0]
+        except (ValueError, AttributeError):
+            return
+        self.id = self.id or chunk.get("id")
+        self.model = self.model or chunk.get("model")
+        delta = choice.get("delta") or {}
+        if delta.get("content"):
+            self.content.append(delta["content"])
+        if delta.get("reasoning_content"):
+            self.reasoning.append(delta["reasoning_content"])
+        self.finish_reason = choice.get("finish_reason") or self.finish_reason
+
+    def result(self):
+        """The completed chat.completion, None if the stream never finished"""
+        if not self.finish_reason and not self.done:
+            return None
+        message = {"role": "assistant", "content": "".join(self.content)}
+        if self.reasoning:
+            message["reasoning_content"] = "".join(self.reasoning)
+        return {
+            "id": self.id or f"chatcmpl-{int(time.time())}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [{"index": 0, "message": message, "finish_reason": self.finish_reason or "stop"}]
+        }
+
+def store_stream_capture(sink, capture):
+    """Hand what a fully relayed stream produced to its sink"""
+    result = capture.result()
+    if result:
+        cache_result(result, sink)
+
+def cache_stream(frames, sink):
+    """Pass SSE frames through, handing the completion to its sink once the stream ends normally"""
+    if not sink:
+        return frames
+
+    def generate():
+        capture = StreamCapture()
+        for frame in frames:
+            capture.feed(frame)
+            yield frame
+        store_stream_capture(sink, capture)
+
+    return ClosingIterator(generate(), frames)
+
+def completion_message(result):
+    """The assistant message of a chat.completion body, as it goes back into a history"""
     try:
-        auth_header = request.headers.get('Authorization')
+        message = result["choices"][0]["message"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if not isinstance(message, dict):
+        return None
+    # Reasoning is shown to the client once, models don't expect it back
+    message = {key: value for key, value in message.items() if key != "reasoning_content"}
+    message.setdefault("role", "assistant")
+    return message
+
+def invalid_request_error(message, code, status, param=None):
+    """(OpenAI-style error body, status) of a request the gateway turns down itself"""
+    return {"error": {"message": message, "type": "invalid_request_error", "param": param, "code": code}}, status
+
+def credentials_owner(auth_header):
+    """Conversations, batches and their files are only visible to the credentials that created them"""
+    return hashlib.sha256((auth_header or "").encode("utf-8")).hexdigest()
+
+class Conversation:
+    def __init__(self, owner):
+        self.owner = owner
+        self.messages = []
+        self.size = 0
+        self.touched = time.monotonic()
+
+class ConversationStore:
+    """
+    Server-side histories of X-Conversation-Id clients, which then only send
+    the new messages of each turn. An LRU bounded by count, total size and
+    idle time; with --state-file the histories live in the shared state
+    instead, so any worker can continue a conversation, and only expire.
+    A turn is appended once its completion finished, a failed one leaves
+    no trace and can be sent again. A new conversation only gets stored
+    with its first successful turn.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=256 * 1024 * 1024, ttl=DEFAULT_CONVERSATION_TTL):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.lock = threading.Lock()
+        self.shared = None
+        self.stats = dict.fromkeys(("created", "continued", "missing", "turns", "evicted"), 0)
+
+    def configure(self, args, shared=None):
+        self.max_entries = args.conversation_max
+        self.max_bytes = int(args.conversation_memory_mb * 1024 * 1024)
+        self.ttl = args.conversation_ttl
+        self.shared = shared
+
+    @staticmethod
+    def messages_size(messages):
+        return sum(estimate_message_tokens(message) for message in messages) * BYTES_PER_TOKEN
+
+    @staticmethod
+    def new_id():
+        """Id of a conversation that append_turn(..., new=True) creates"""
+        return secrets.token_urlsafe(18)
+
+    def load(self, conversation_id, owner, record=True):
+        """History of a conversation, None when unknown, expired or started by other credentials"""
+        with self.lock:
+            if self.shared:
+                messages = self.load_shared(conversation_id, owner)
+            else:
+                entry = self.entries.get(conversation_id)
+                messages = None
+                if entry and entry.owner == owner and time.monotonic() - entry.touched < self.ttl:
+                    entry.touched = time.monotonic()
+                    self.entries.move_to_end(conversation_id)
+                    messages = list(entry.messages)
+            if record:
+                self.stats["continued" if messages is not None else "missing"] += 1
+            return messages
+
+    def append_turn(self, conversation_id, owner, messages, result, new=False):
+        """Add the new messages of a turn and the reply in result, new creates the conversation"""
+        reply = completion_message(result)
+        if reply is None:
+            return
+        turn = list(messages) + [reply]
+        with self.lock:
+            if self.shared:
+                if new:
+                    self.shared.purge()
+                    history = []
+                    self.stats["created"] += 1
+                else:
+                    history = self.load_shared(conversation_id, owner)
+                if history is not None:
+                    self.save_shared(conversation_id, owner, history + turn)
+                    self.stats["turns"] += 1
+                return
+            if new:
+                self.entries[conversation_id] = Conversation(owner)
+                self.stats["created"] += 1
+            entry = self.entries.get(conversation_id)
+            if entry is None or entry.owner != owner:
+                return
+            size = self.messages_size(turn)
+            entry.messages.extend(turn)
+            entry.size += size
+            entry.touched = time.monotonic()
+            self.entries.move_to_end(conversation_id)
+            self.size += size
+            self.stats["turns"] += 1
+            self.evict()
+
+    def delete(self, conversation_id, owner):
+        with self.lock:
+            if self.shared:
+                if self.load_shared(conversation_id, owner) is None:
+                    return False
+                self.shared.delete(f"conversation:{conversation_id}")
+                return True
+            entry = self.entries.get(conversation_id)
+            if entry is None or entry.owner != owner:
+                return False
+            del self.entries[conversation_id]
+            self.size -= entry.size
+            return True
+
+    def evict(self):
+        """Drop idle conversations, then the least recently used over the bounds, lock held"""
+        now = time.monotonic()
+        while self.entries:
+            conversation_id, entry = next(iter(self.entries.items()))
+            if now - entry.touched < self.ttl and len(self.entries) <= self.max_entries and self.size <= self.max_bytes:
+                break
+            del self.entries[conversation_id]
+            self.size -= entry.size
+            self.stats["evicted"] += 1
+
+    def load_shared(self, conversation_id, owner):
+        value = self.shared.get(f"conversation:{conversation_id}")
+        if value is None:
+            return None
+        entry = json_loads(value)
+        return entry["messages"] if entry.get("owner") == owner else None
+
+    def save_shared(self, conversation_id, owner, messages):
+        value = json_dumps_bytes({"owner": owner, "messages": messages}).decode("utf-8")
+        self.shared.set(f"conversation:{conversation_id}", value, self.ttl)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, shared=bool(self.shared))
+            if not self.shared:
+                stats.update(conversations=len(self.entries), bytes=self.size)
+            return stats
+
+conversation_store = ConversationStore()
+
+def open_conversation(conversation_id, auth_header, messages, args=None):
+    """
+    Resolve the X-Conversation-Id of a request: "new" starts a conversation,
+    a known id puts its history in front of the new messages. Returns
+    ((conversation_id, owner, new messages, is new), full messages) and an
+    error tuple. A new conversation is only stored once its first turn succeeded.
+    """
+    args = args or get_config()
+    if not args.conversations:
+        return None, invalid_request_error(f"{CONVERSATION_HEADER} needs the gateway to run with --conversations", "conversations_disabled", 400)
+    owner = credentials_owner(auth_header)
+    if conversation_id == NEW_CONVERSATION:
+        return ((conversation_store.new_id(), owner, messages, True), messages), None
+    history = conversation_store.load(conversation_id, owner)
+    if history is None:
+        return None, invalid_request_error(
+            "Conversation not found or expired, start a new one with the full message history",
+            "conversation_not_found", 404
+        )
+    return ((conversation_id, owner, messages, False), history + messages), None
+
+in_flight = {}
+in_flight_lock = threading.Lock()
+coalesce_stats = {"leaders": 0, "followers": 0}
+
+def coalesce_key(model_info, messages, request_params, auth_header=None, cache_control=None, bypass=None, args=None):
+    """
+    Key shared by identical concurrent completions when --coalesce is on,
+    None otherwise. Streams only join streams, and Evalsone requests only
+    join requests made with the same credentials.
+    """
+    args = args or get_config()
+    if not args.coalesce or not request_cache_policy(cache_control, bypass)[0]:
+        return None
+    key = completion_cache_key(model_info, messages, request_params, cache_owner(model_info, auth_header))
+    return hashlib.sha256(f"{key}:{bool(request_params['stream'])}".encode("utf-8")).hexdigest()
+
+class StreamBroadcast:
+    """
+    Fans one upstream stream out to every request attached to it. A pump
+    thread reads the upstream into a buffer, subscribers replay the buffered
+    prefix and then follow the live tail. The pump stops and closes the
+    upstream once the last subscriber is gone.
+    """
+
+    def __init__(self, frames, on_done):
+        self.frames = frames
+        self.on_done = on_done
+        self.chunks = []
+        self.subscribers = 0
+        self.done = False
+        self.abandoned = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.pump, name="stream-broadcast", daemon=True).start()
+
+    def pump(self):
+        try:
+            for frame in self.frames:
+                with self.cond:
+                    self.chunks.append(frame)
+                    self.cond.notify_all()
+                    if not self.subscribers:
+                        self.abandoned = True
+                        break
+        except Exception as e:
+            self.error = e
+        finally:
+            close = getattr(self.frames, "close", None)
+            if close:
+                close()
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.on_done()
+
+    def subscribe(self):
+        """A BroadcastSubscription, None if the stream was already abandoned"""
+        with self.cond:
+            if self.abandoned:
+                return None
+            self.subscribers += 1
+        return BroadcastSubscription(self)
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+
+class BroadcastSubscription:
+    """One client's position in a StreamBroadcast"""
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        broadcast = self.broadcast
+        with broadcast.cond:
+            while self.index >= len(broadcast.chunks) and not broadcast.done:
+                broadcast.cond.wait()
+            chunks = broadcast.chunks[self.index:]
+            self.index += len(chunks)
+        # A late joiner gets the whole buffered prefix in one write
+        if chunks:
+            return b"".join(chunks)
+        if broadcast.error:
+            raise broadcast.error
+        raise StopIteration
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast.unsubscribe()
+
+class Flight:
+    """One upstream completion shared by identical concurrent requests"""
+
+    def __init__(self, key):
+        self.key = key
+        self.ready = threading.Event()
+        self.response = None
+        self.broadcast = None
+
+    def publish_response(self, response):
+        """Hand a complete Flask response (None if the leader failed) to the followers"""
+        if response is not None:
+            self.response = (response.get_data(), response.status_code, response.mimetype)
+        self.land()
+        self.ready.set()
+
+    def publish_stream(self, frames):
+        """Start broadcasting a stream, returns the leader's own subscription"""
+        self.broadcast = StreamBroadcast(frames, self.land)
+        subscription = self.broadcast.subscribe()
+        self.broadcast.start()
+        self.ready.set()
+        return subscription
+
+    def land(self):
+        land_flight(self)
+
+def land_flight(flight):
+    """Stop new requests from joining a flight"""
+    with in_flight_lock:
+        if in_flight.get(flight.key) is flight:
+            del in_flight[flight.key]
+
+def join_flight(key, factory=Flight):
+    """(flight, is_leader) for a coalescing key"""
+    with in_flight_lock:
+        flight = in_flight.get(key)
+        if flight:
+            coalesce_stats["followers"] += 1
+            return flight, False
+        flight = in_flight[key] = factory(key)
+        coalesce_stats["leaders"] += 1
+        return flight, True
+
+def lead_flight(flight, dispatch):
+    """Run the upstream call of a flight and hand its response to the followers"""
+    response = None
+    try:
+        response = app.make_response(dispatch(flight))
+        return response
+    finally:
+        if not flight.ready.is_set():
+            flight.publish_response(response)
+
+def follow_flight(flight, provider, deadline, args=None, model=None):
+    """Response for a request attached to a flight, None if it has to go upstream on its own"""
+    if not flight.ready.wait(max(deadline.remaining(), 0)):
+        return jsonify(timeout_error("Request deadline exceeded waiting for an identical request")), 504
+    if flight.broadcast:
+        subscription = flight.broadcast.subscribe()
+        return relay_stream(subscription, provider, args, model=model, started_at=deadline.started_at) if subscription else None
+    if flight.response is None:
+        return jsonify({"error": "Identical in-flight request failed"}), 500
+    body, status, mimetype = flight.response
+    return Response(body, status=status, mimetype=mimetype, headers={COALESCED_HEADER: "true"})
+
+def client_tenant(model_info, auth_header, remote_addr, args=None):
+    """
+    Fair queuing tenant of a request: the Evalsone account of its token,
+    or the client IP for the keyless DeepInfra/Pollinations models. None
+    without --fair-queuing, which makes the limiter queues plain FIFO.
+    """
+    args = args or get_config()
+    if not args.fair_queuing:
+        return None
+    if model_info["provider"] == "ES" and auth_header:
+        email, _ = decode_auth_token(auth_header)
+        if email:
+            return email
+    return remote_addr or "unknown"
+
+def tenant_weight(tenant):
+    return TENANT_WEIGHTS.get(tenant) or TENANT_WEIGHTS["default"]
+
+def tenant_class(tenant):
+    """
+    Bounded label for a tenant in exported metrics: batch, weighted (set by
+    --tenant-weight) or default. Tenants are emails and client IPs, which must
+    not end up in label values.
+    """
+    if tenant == BATCH_TENANT:
+        return "batch"
+    if tenant in TENANT_WEIGHTS:
+        return "weighted"
+    return "default"
+
+def record_queue_wait(tenant, started_at):
+    if tenant is not None:
+        metrics.observe("gateway_queue_wait_seconds", (tenant_class(tenant),), time.monotonic() - started_at)
+
+class LimiterWaiter:
+    """
+    A request thread waiting for a concurrency slot. state becomes
+    "admitted" or "rejected" (pushed out of a full queue) before wake().
+    """
+
+    def __init__(self, tenant=None, weight=1.0):
+        self.tenant = tenant
+        self.weight = weight
+        self.state = None
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit of one provider or model. Successful calls grow
+    the limit by about one per limit's worth of calls while it is in use,
+    latency above --latency-tolerance times the baseline shrinks it gently
+    and 429/5xx/timeouts cut it by CONCURRENCY_BACKOFF.
+
+    Requests over the limit wait in a bounded queue served by start-time
+    fair queuing: a waiter is tagged with the later of the virtual time and
+    the finish tag of its tenant's previous waiter, the finish tag adds
+    1/weight, and the smallest start tag is granted the next slot. A tenant
+    with a long backlog therefore only gets its weighted share of the
+    slots, and with a single tenant the queue is plain FIFO.
+    """
+
+    def __init__(self, name, args):
+        self.name = name
+        self.limit = float(args.concurrency_initial)
+        self.max_limit = float(args.concurrency_max)
+        self.max_queue = args.queue_size
+        self.tolerance = args.latency_tolerance
+        self.in_flight = 0
+        # Heap of (start tag, sequence, waiter), abandoned waiters are skipped lazily
+        self.waiters = []
+        self.queued = 0
+        self.sequence = 0
+        self.virtual_time = 0.0
+        # tenant -> [finish tag of its last queued waiter, waiters queued], only while it has some
+        self.tenants = {}
+        # Separate latency baselines for time to first byte (streams) and full responses
+        self.baseline = {}
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(("admitted", "queued", "rejected", "queue_timeouts", "decreases"), 0)
+
+    def slots(self):
+        return max(int(self.limit), 1)
+
+    def enter(self, waiter):
+        """"admitted", "queued" or "rejected" """
+        with self.lock:
+            if self.in_flight < self.slots() and not self.queued:
+                self.in_flight += 1
+                self.stats["admitted"] += 1
+                return "admitted"
+            tenant = self.tenants.get(waiter.tenant)
+            start = max(self.virtual_time, tenant[0]) if tenant else self.virtual_time
+            if self.queued >= self.max_queue and not self.displace(start):
+                self.stats["rejected"] += 1
+                return "rejected"
+            if tenant is None:
+                tenant = self.tenants[waiter.tenant] = [0.0, 0]
+            tenant[0] = start + 1 / waiter.weight
+            tenant[1] += 1
+            self.sequence += 1
+            heapq.heappush(self.waiters, (start, self.sequence, waiter))
+            self.queued += 1
+            self.stats["queued"] += 1
+            return "queued"
+
+    def displace(self, start):
+        """Reject the queued waiter that would be served last to make room, if it is behind start"""
+        last = max((entry for entry in self.waiters if entry[2].state is None), default=None)
+        if last is None or last[0] <= start:
+            return False
+        self.dequeue(last[2], "rejected")
+        self.stats["rejected"] += 1
+        last[2].wake()
+        return True
+
+    def dequeue(self, waiter, state):
+        waiter.state = state
+        self.queued -= 1
+        tenant = self.tenants[waiter.tenant]
+        tenant[1] -= 1
+        if not tenant[1]:
+            del self.tenants[waiter.tenant]
+
+    def abandon(self, waiter):
+        """Stop waiting, returns the final state: "admitted" (the waiter now owns a slot), "rejected" or "timeout" """
+        with self.lock:
+            if waiter.state is None:
+                self.dequeue(waiter, "timeout")
+                self.stats["queue_timeouts"] += 1
+            return waiter.state
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.grant_waiters()
+
+    def grant_waiters(self):
+        while self.queued and self.in_flight < self.slots():
+            start, _, waiter = heapq.heappop(self.waiters)
+            if waiter.state is not None:
+                continue
+            self.virtual_time = start
+            self.dequeue(waiter, "admitted")
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            waiter.wake()
+        if not self.queued:
+            self.waiters.clear()
+
+    def observe(self, latency, overloaded, stream):
+        """Adapt the limit to one upstream call"""
+        with self.lock:
+            if overloaded:
+                now = time.monotonic()
+                # A burst of failures from calls that were already in flight counts once
+                if now - self.last_decrease >= CONCURRENCY_DECREASE_INTERVAL:
+                    self.limit = max(self.limit * CONCURRENCY_BACKOFF, 1.0)
+                    self.last_decrease = now
+                    self.stats["decreases"] += 1
+                return
+
+            baseline = self.baseline.get(stream)
+            if baseline is None or latency < baseline:
+                self.baseline[stream] = latency
+            else:
+                self.baseline[stream] = baseline + (latency - baseline) * LATENCY_BASELINE_DRIFT
+            if baseline is not None and latency > baseline * self.tolerance:
+                self.limit = max(self.limit * CONCURRENCY_LATENCY_BACKOFF, 1.0)
+            elif self.in_flight >= self.limit / 2:
+                # Only grow while the limit is actually being used
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self.grant_waiters()
+
+    def retry_after(self):
+        """Seconds a rejected client should wait, from the queue length and the latency baseline"""
+        with self.lock:
+            latency = max(self.baseline.values(), default=1.0)
+            return min(max(int(latency * (self.queued + 1) / self.slots()) + 1, 1), 60)
+
+    def queue_depths(self):
+        """Waiters queued per tenant right now"""
+        with self.lock:
+            return {tenant: state[1] for tenant, state in self.tenants.items()}
+
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                limit=round(self.limit, 2),
+                in_flight=self.in_flight,
+                queued_now=self.queued,
+                tenants_queued=sum(1 for tenant, state in self.tenants.items() if tenant is not None and state[1]),
+                baseline_ms={"stream" if stream else "response": round(value * 1000, 1) for stream, value in self.baseline.items()},
+            )
+
+class ConcurrencyPermit:
+    """Slots held in the provider and model limiters for one upstream call"""
+
+    def __init__(self, limiters, stream):
+        self.limiters = limiters
+        self.stream = stream
+        self.released = False
+
+    def observe(self, overloaded, started_at):
+        latency = time.monotonic() - started_at
+        for limiter in self.limiters:
+            limiter.observe(latency, overloaded, self.stream)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            for limiter in self.limiters:
+                limiter.release()
+
+class ConcurrencyControl:
+    """Adaptive limiters per provider and per provider/model, created on first use"""
+
+    def __init__(self):
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiters_for(self, model_info, args):
+        """Provider limiter first, then the model's, always in this order"""
+        names = (model_info["provider"], f"{model_info['provider']}/{model_info['model_name']}")
+        limiters = []
+        for name in names:
+            limiter = self.limiters.get(name)
+            if limiter is None:
+                with self.lock:
+                    limiter = self.limiters.setdefault(name, AdaptiveLimiter(name, args))
+            limiters.append(limiter)
+        return limiters
+
+    def acquire(self, model_info, request_params, deadline, args=None, tenant=None):
+        """(permit, None), or (None, (message, retry_after)) when the request was turned away"""
+        args = args or get_config()
+        acquired = []
+        started_at = time.monotonic()
+        try:
+            for limiter in self.limiters_for(model_info, args):
+                waiter = LimiterWaiter(tenant, tenant_weight(tenant))
+                state = limiter.enter(waiter)
+                if state == "queued":
+                    waiter.event.wait(min(args.queue_timeout, deadline.remaining()))
+                    state = limiter.abandon(waiter)
+                if state != "admitted":
+                    return None, self.reject(limiter, state, acquired)
+                acquired.append(limiter)
+            return ConcurrencyPermit(acquired, bool(request_params["stream"])), None
+        finally:
+            record_queue_wait(tenant, started_at)
+
+    def reject(self, limiter, state, acquired):
+        for held in acquired:
+            held.release()
+        if state == "rejected":
+            message = f"{limiter.name} is overloaded, too many requests queued"
+        else:
+            message = f"{limiter.name} is overloaded, no upstream slot freed up in time"
+        return message, limiter.retry_after()
+
+    def queue_depths(self):
+        """Waiters per tenant class summed over all limiters"""
+        with self.lock:
+            limiters = list(self.limiters.values())
+        depths = {}
+        for limiter in limiters:
+            for tenant, queued in limiter.queue_depths().items():
+                if tenant is not None:
+                    depths[tenant_class(tenant)] = depths.get(tenant_class(tenant), 0) + queued
+        return depths
+
+    def get_stats(self):
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return {limiter.name: limiter.get_stats() for limiter in limiters}
+
+concurrency = ConcurrencyControl()
+
+def overloaded_error(message):
+    """OpenAI-style error body for a request turned away by the concurrency limits"""
+    return {"error": {"message": message, "type": "overloaded_error", "param": None, "code": "gateway_overloaded"}}
+
+def is_overload_error(error):
+    """
+    True when an upstream error means "back off" (timeouts, 429, 5xx,
+    connection failures), None when it says nothing about load.
+    """
+    if error is None:
+        return False
+    if error == UPSTREAM_TIMEOUT:
+        return True
+    if error in ("token_expired", "Invalid message format"):
+        return None
+    match = UPSTREAM_STATUS_PATTERN.match(error)
+    if match:
+        status = int(match.group(1))
+        return True if status == 429 or status >= 500 else None
+    return True
+
+def observe_upstream(permit, overloaded, started_at):
+    """Feed the outcome of an upstream call to the limiters, overloaded None is ignored"""
+    if permit is not None and overloaded is not None:
+        permit.observe(overloaded, started_at)
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one provider or model. Closed, calls go through and
+    --breaker-failures consecutive failures open it. Open, calls fail fast
+    for --breaker-cooldown seconds. Half-open, one probe call at a time is
+    let through, its success closes the circuit and its failure opens it
+    again.
+    """
+
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.threshold = args.breaker_failures
+        self.cooldown = args.breaker_cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.shared_checked = 0.0
+        self.lock = threading.Lock()
+        self.stats = dict.fromkeys(("opened", "fast_failures", "probes"), 0)
+
+    def allow(self):
+        """"pass", "probe", or None while the circuit is open"""
+        with self.lock:
+            if self.state == "closed" and shared_state:
+                self.sync_shared()
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    self.stats["fast_failures"] += 1
+                    return None
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probing:
+                    self.stats["fast_failures"] += 1
+                    return None
+                self.probing = True
+                self.stats["probes"] += 1
+                return "probe"
+            return "pass"
+
+    def record(self, ticket, failed):
+        """Outcome of a call let through by allow(), failed None when it says nothing about health"""
+        with self.lock:
+            if ticket == "probe":
+                self.probing = False
+            if failed is None:
+                return
+            if not failed:
+                self.failures = 0
+                if ticket == "probe":
+                    self.state = "closed"
+                return
+            self.failures += 1
+            if ticket == "probe" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.stats["opened"] += 1
+                if shared_state:
+                    shared_state.set(f"breaker:{self.name}", time.time(), self.cooldown)
+
+    def sync_shared(self):
+        """Open this breaker too when another worker opened it, checked at most every SHARED_SYNC_INTERVAL"""
+        now = time.monotonic()
+        if now - self.shared_checked < SHARED_SYNC_INTERVAL:
+            return
+        self.shared_checked = now
+        opened = shared_state.get(f"breaker:{self.name}")
+        if opened is not None:
+            self.state = "open"
+            self.opened_at = now - (time.time() - float(opened))
+
+    def retry_after(self):
+        with self.lock:
+            return max(int(self.cooldown - (time.monotonic() - self.opened_at)) + 1, 1)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, state=self.state, consecutive_failures=self.failures)
+
+class BreakerControl:
+    """Circuit breakers per provider and per provider/model, created on first use"""
+
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breakers_for(self, model_info, args):
+        names = (model_info["provider"], f"{model_info['provider']}/{model_info['model_name']}")
+        breakers = []
+        for name in names:
+            breaker = self.breakers.get(name)
+            if breaker is None:
+                with self.lock:
+                    breaker = self.breakers.setdefault(name, CircuitBreaker(name, args))
+            breakers.append(breaker)
+        return breakers
+
+    def enter(self, model_info, args=None):
+        """
+        Tickets of the provider and model breakers for one upstream call,
+        or (None, breaker) when one of them is open
+        """
+        args = args or get_config()
+        if args.breaker_failures <= 0:
+            return [], None
+        tickets = []
+        for breaker in self.breakers_for(model_info, args):
+            ticket = breaker.allow()
+            if ticket is None:
+                self.finish(tickets, None)
+                return None, breaker
+            tickets.append((breaker, ticket))
+        return tickets, None
+
+    def finish(self, tickets, failed):
+        for breaker, ticket in tickets:
+            breaker.record(ticket, failed)
+
+    def get_stats(self):
+        with self.lock:
+            breakers = list(self.breakers.values())
+        return {breaker.name: breaker.get_stats() for breaker in breakers}
+
+breakers = BreakerControl()
+
+def circuit_open_error(breaker):
+    """(OpenAI-style error body, Retry-After seconds) of a request failed fast by an open circuit"""
+    message = f"{breaker.name} is failing, requests are paused for a moment"
+    error = {"error": {"message": message, "type": "overloaded_error", "param": None, "code": CIRCUIT_OPEN}}
+    return error, breaker.retry_after()
+
+def retry_reason(error):
+    """Why a failed upstream call may be repeated ("connect" or the status), None when it may not"""
+    if not error or error in (UPSTREAM_TIMEOUT, CIRCUIT_OPEN):
+        return None
+    if error.startswith(CONNECT_ERROR_PREFIX):
+        return "connect"
+    match = UPSTREAM_STATUS_PATTERN.match(error)
+    if match and int(match.group(1)) in RETRY_STATUSES:
+        return match.group(1)
+    return None
+
+def retry_delay(attempt, deadline, args):
+    """Full-jitter backoff before retry number attempt + 1, None when it would not fit in the deadline"""
+    if attempt >= args.upstream_retries:
+        return None
+    delay = random.uniform(0, min(args.retry_backoff * 2 ** attempt, RETRY_BACKOFF_MAX))
+    return delay if delay < deadline.remaining() else None
+
+def call_upstream(model_info, request_params, deadline, permit, send, args, **span_attributes):
+    """
+    Run send() -> (result, error) behind the circuit breakers and feed its
+    outcome to the concurrency limits. Failures before the first byte that
+    are safe to repeat are retried with jittered backoff within the deadline.
+    An open circuit returns (breaker, CIRCUIT_OPEN).
+    """
+    attempt = 0
+    while True:
+        tickets, open_breaker = breakers.enter(model_info, args)
+        if tickets is None:
+            return open_breaker, CIRCUIT_OPEN
+        started_at = time.monotonic()
+        with trace_span(upstream_span(request_params), **span_attributes):
+            result, error = send()
+        overloaded = is_overload_error(error)
+        observe_upstream(permit, overloaded, started_at)
+        breakers.finish(tickets, overloaded)
+        reason = retry_reason(error)
+        delay = retry_delay(attempt, deadline, args) if reason else None
+        if delay is None:
+            return result, error
+        metrics.inc("gateway_upstream_retries_total", (model_info["provider"], reason))
+        log_message(f"Retrying {model_info['provider']} request in {delay:.2f}s after: {error}", "debug", args)
+        time.sleep(delay)
+        attempt += 1
+        span_attributes = dict(span_attributes, attempt=attempt)
+
+def upstream_error_response(result, error, label):
+    """Flask response of a failed upstream call"""
+    if error == UPSTREAM_TIMEOUT:
+        return jsonify(timeout_error()), 504
+    if error == CIRCUIT_OPEN:
+        body, retry_after = circuit_open_error(result)
+        return jsonify(body), 503, {"Retry-After": str(retry_after)}
+    return jsonify({"error": f"{label} request failed: {error}"}), 500
+
+def dispatch_with_permit(model_info, request_params, deadline, args, dispatch, tenant=None):
+    """
+    Run dispatch(permit) inside the concurrency limits. The slot is released
+    when the response is done, for a stream only once the relay closes.
+    """
+    if not args.adaptive_concurrency:
+        return dispatch(None)
+    permit, rejection = concurrency.acquire(model_info, request_params, deadline, args, tenant)
+    if rejection:
+        message, retry_after = rejection
+        log_message(message, "debug", args)
+        response = jsonify(overloaded_error(message))
+        response.status_code = 503
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+    try:
+        response = app.make_response(dispatch(permit))
+    except Exception:
+        permit.release()
+        raise
+    if response.is_streamed:
+        response.call_on_close(permit.release)
+    else:
+        permit.release()
+    return response
+
+def get_cache_stats():
+    """Completion cache, request coalescing and balance cache counters"""
+    stats = dict(completion_cache.get_stats(), enabled=True) if completion_cache else {"enabled": False}
+    with in_flight_lock:
+        stats["coalescing"] = dict(coalesce_stats, in_flight=len(in_flight))
+    stats["balance"] = balance_cache.get_stats()
+    return stats
+
+def collect_state_metrics():
+    """Stream, cache and coalescing counters kept elsewhere, exported at scrape time"""
+    with stream_stats_lock:
+        streams = {provider: dict(stats) for provider, stats in stream_stats.items()}
+    yield "gateway_streams_active", "gauge", "Streams currently relayed", [
+        ({"provider": provider}, stats["active"]) for provider, stats in streams.items()
+    ]
+    yield "gateway_streams_total", "counter", "Finished streams by outcome", [
+        ({"provider": provider, "outcome": outcome}, stats[outcome])
+        for provider, stats in streams.items() for outcome in STREAM_OUTCOMES
+    ]
+
+    lookups = []
+    if completion_cache:
+        with completion_cache.lock:
+            cache_stats = dict(completion_cache.stats)
+        lookups += [({"cache": "completion", "result": result}, cache_stats[key]) for key, result in (("hits", "hit"), ("misses", "miss"))]
+    balance_stats = balance_cache.get_stats()
+    lookups += [
+        ({"cache": "balance", "result": result}, balance_stats[key])
+        for key, result in (("hits", "hit"), ("stale_hits", "stale"), ("misses", "miss"))
+    ]
+    yield "gateway_cache_lookups_total", "counter", "Cache lookups by result", lookups
+
+    with in_flight_lock:
+        coalescing = dict(coalesce_stats)
+    yield "gateway_coalesced_requests_total", "counter", "Coalesced completions by role", [
+        ({"role": "leader"}, coalescing["leaders"]),
+        ({"role": "follower"}, coalescing["followers"]),
+    ]
+
+    conversations = conversation_store.get_stats()
+    if "conversations" in conversations:
+        yield "gateway_conversations", "gauge", "Server-side conversations kept in memory", [({}, conversations["conversations"])]
+    yield "gateway_conversation_events_total", "counter", "Conversations created, continued, missing and evicted, and turns appended", [
+        ({"event": event}, conversations[event]) for event in ("created", "continued", "missing", "turns", "evicted")
+    ]
+
+    limits = concurrency.get_stats()
+    for name, kind, help_text, key in (
+        ("gateway_concurrency_limit", "gauge", "Adaptive concurrency limit", "limit"),
+        ("gateway_concurrency_in_flight", "gauge", "Upstream calls holding a concurrency slot", "in_flight"),
+        ("gateway_concurrency_queued", "gauge", "Requests waiting for a concurrency slot", "queued_now"),
+        ("gateway_concurrency_rejected_total", "counter", "Requests turned away with 503 for a full queue", "rejected"),
+        ("gateway_concurrency_queue_timeouts_total", "counter", "Requests turned away with 503 after waiting too long", "queue_timeouts"),
+    ):
+        yield name, kind, help_text, [({"limiter": limiter}, stats[key]) for limiter, stats in limits.items()]
+    breaker_states = breakers.get_stats()
+    yield "gateway_circuit_state", "gauge", "Circuit breaker state, 0 closed, 1 half-open, 2 open", [
+        ({"breaker": name}, CircuitBreaker.STATES.index(stats["state"])) for name, stats in breaker_states.items()
+    ]
+    yield "gateway_circuit_opened_total", "counter", "Times a circuit breaker opened", [
+        ({"breaker": name}, stats["opened"]) for name, stats in breaker_states.items()
+    ]
+    yield "gateway_circuit_fast_failures_total", "counter", "Requests failed fast by an open circuit", [
+        ({"breaker": name}, stats["fast_failures"]) for name, stats in breaker_states.items()
+    ]
+    yield "gateway_tenant_queue_depth", "gauge", "Requests waiting for a concurrency slot per fair queuing tenant class", [
+        ({"tenant_class": name}, queued) for name, queued in concurrency.queue_depths().items()
+    ]
+
+metrics.collectors.append(collect_state_metrics)
+
+def dispatch_completion(model_info, messages, request_params, deadline, auth_header, sink, args, flight=None, permit=None):
+    """Send a parsed completion to its provider and build the Flask response"""
+    model_name = model_info["model_name"]
+    # Handle PAI models (no auth required)
+    if model_info["provider"] == "PAI":
+        result, error = call_upstream(
+            model_info, request_params, deadline, permit,
+            lambda: send_pai_request(messages, model_info["model_id"], request_params, args, deadline), args
+        )
+        if error:
+            return upstream_error_response(result, error, "PAI")
+            
+        if request_params["stream"]:
+            return relay_stream(cache_stream(relay_sse(result, model_rewriter(model_info, args)), sink), "PAI", args, flight, model_name, deadline.started_at)
+        with trace_span("finalize"):
+            return jsonify(cache_result(rewrite_model_name(result, model_info, args), sink))
+
+    # Handle DeepInfra models (no auth required)
+    if model_info["provider"] == "DI":
+        result, error = call_upstream(
+            model_info, request_params, deadline, permit,
+            lambda: send_deepinfra_request(messages, model_info["model_id"], request_params, args, deadline), args
+        )
+        if error:
+            return upstream_error_response(result, error, "DeepInfra")
+            
+        if request_params["stream"]:
+            return relay_stream(cache_stream(relay_sse(result, model_rewriter(model_info, args)), sink), "DI", args, flight, model_name, deadline.started_at)
+        with trace_span("finalize"):
+            return jsonify(cache_result(rewrite_model_name(result, model_info, args), sink))
+        
+    # Handle Evalsone models (auth required)
+    else:  
         if not auth_header:
-            log_message("Missing Authorization header for balance request", "error", args)
+            log_message("Missing Authorization header for Evalsone model", "error", args)
             return jsonify({"error": "Missing Authorization header"}), 401
 
-        email, password = decode_auth_token(auth_header)
+        with trace_span("decode_auth_token"):
+            email, password = decode_auth_token(auth_header)
         if not email or not password:
-            log_message("Invalid authorization token for balance request", "error", args)
+            log_message("Invalid authorization token for Evalsone model", "error", args)
             return jsonify({"error": "Invalid authorization token"}), 401
 
-        token = tokens_data.get(email, {}).get("access_token")
-        if not token:
-            token = get_new_token(email, password, args)
-            if token:
-                tokens_data[email] = {"access_token": token}
-                save_tokens(tokens_data)
-            else:
-                return jsonify({"error": "Failed to authenticate"}), 401
-
-        user_id = get_user_id_from_token(token)
-        if not user_id:
-            return jsonify({"error": "Failed to extract user ID from token"}), 500
-
-        result, error = get_balance_info(token, user_id, args)
+        # A token known to be expired is refreshed up front, the 401 path below is only a fallback
+        with trace_span("token"):
+            token = token_store.get_or_refresh(email, password, args, deadline)
+        if token:
+            result, error = call_upstream(
+                model_info, request_params, deadline, permit,
+                lambda: send_evalsone_request(messages, token, model_info["model_id"], request_params, args, deadline), args
+            )
+        else:
+            result, error = None, "token_expired"
         
         if error == "token_expired":
-            token = get_new_token(email, password, args)
+            with trace_span("token_refresh"):
+                token = token_store.refresh(email, password, args, deadline, stale_token=token)
             if token:
-                tokens_data[email] = {"access_token": token}
-                save_tokens(tokens_data)
-                user_id = get_user_id_from_token(token)
-                if user_id:
-                    result, error = get_balance_info(token, user_id, args)
-                else:
-                    return jsonify({"error": "Failed to extract user ID from new token"}), 500
+                result, error = call_upstream(
+                    model_info, request_params, deadline, permit,
+                    lambda: send_evalsone_request(messages, token, model_info["model_id"], request_params, args, deadline), args,
+                    retry=True
+                )
+            elif deadline.remaining() <= 0:
+                return jsonify(timeout_error("Request deadline exceeded during token refresh")), 504
             else:
                 return jsonify({"error": "Failed to refresh token"}), 401
-        
+            
         if error:
-            return jsonify({"error": f"Balance request failed: {error}"}), 500
+            return upstream_error_response(result, error, "Evalsone")
 
-        # Add PAI category to the result
-        if result:
-            result["PAI_balance"] = "unlimited"
-            result["PAI_user_id"] = "n/a"
-            
-        return jsonify(result)
+        balance_cache.note_activity(email, model_info.get("request_cost"))
+        if request_params["stream"]:
+            return relay_stream(cache_stream(result, sink), "ES", args, flight, model_name, deadline.started_at)
+
+        with trace_span("finalize"):
+            return jsonify(cache_result(build_completion_response(result, model_name), sink))
+
+def read_upload(body, content_type, purpose=None, filename=None):
+    """(filename, purpose, data) of a multipart/form-data or raw JSONL upload to /v1/files"""
+    if not (content_type or "").startswith("multipart/form-data"):
+        return filename or "upload.jsonl", purpose or "batch", body
+    message = BytesParser(policy=policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    data = None
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name == "file":
+            filename, data = part.get_filename() or filename, part.get_payload(decode=True)
+        elif name == "purpose":
+            purpose = part.get_payload(decode=True).decode("utf-8").strip()
+    return filename or "upload.jsonl", purpose or "batch", data
+
+def batch_line_error(item, endpoint, seen, has_credentials, args):
+    """(code, message, param) of an invalid batch input line, None when it may run"""
+    if not isinstance(item, dict):
+        return "invalid_request", "Line is not a JSON object", None
+    custom_id = item.get("custom_id")
+    if not isinstance(custom_id, str) or not custom_id:
+        return "missing_custom_id", "custom_id must be a non-empty string", "custom_id"
+    if custom_id in seen:
+        return "duplicate_custom_id", f"custom_id {custom_id!r} is used more than once", "custom_id"
+    if item.get("method", "POST") != "POST":
+        return "invalid_method", "Batch requests must use POST", "method"
+    if item.get("url") != endpoint:
+        return "invalid_url", f"url must be the batch endpoint {endpoint}", "url"
+    body = item.get("body")
+    if isinstance(body, dict) and body.get("stream"):
+        return "invalid_request", "Streaming is not supported in batches", "body.stream"
+    parsed, parse_error = parse_completion_request(body, args)
+    if parse_error:
+        return "invalid_request", parse_error[0], "body"
+    if parsed[0]["provider"] == "ES" and not has_credentials:
+        return "invalid_request", "Evalsone models need the batch to be created with an Authorization header", "body.model"
+    return None
+
+def validate_batch_input(path, endpoint, has_credentials, args):
+    """
+    Check every line of a batch input file before anything runs. Returns
+    the requests as (custom_id, provider, body) in file order and the errors.
+    """
+    tasks = []
+    errors = []
+    seen = set()
+    with open(path, "rb") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            if len(seen) >= BATCH_MAX_REQUESTS:
+                errors.append({"code": "too_many_requests", "message": f"A batch holds at most {BATCH_MAX_REQUESTS} requests", "param": None, "line": line_number})
+                break
+            try:
+                item = json_loads(line)
+            except ValueError:
+                item = None
+                error = ("invalid_json_line", "Line is not valid JSON", None)
+            else:
+                error = batch_line_error(item, endpoint, seen, has_credentials, args)
+            if error:
+                if len(errors) < BATCH_MAX_ERRORS:
+                    code, message, param = error
+                    errors.append({"code": code, "message": message, "param": param, "line": line_number})
+                continue
+            seen.add(item["custom_id"])
+            tasks.append((item["custom_id"], model_registry.get(item["body"]["model"])["provider"], item["body"]))
+    if not tasks and not errors:
+        errors.append({"code": "empty_file", "message": "The input file holds no requests", "param": None, "line": None})
+    return tasks, errors
+
+def execute_batch_request(body, auth_header, args):
+    """
+    Run one batch request through the interactive completion path, without
+    streaming. Returns (status, body, retry_after), retry_after is set when
+    the concurrency limits or a circuit breaker asked to come back later.
+    """
+    parsed, parse_error = parse_completion_request(body, args)
+    if parse_error:
+        message, status = parse_error
+        return status, {"error": message}, None
+    model_info, messages, request_params = parsed
+    request_params["stream"] = False
+    messages, context_error = fit_context(model_info, messages, request_params, args)
+    if context_error:
+        error, status = context_error
+        return status, error, None
+
+    lookup_key, store_key = cache_plan(model_info, messages, request_params, auth_header=auth_header)
+    cached = cached_completion(lookup_key, False)
+    if cached:
+        metrics.inc("gateway_batch_requests_total", (model_info["provider"], "200"))
+        return 200, json_loads(cached[0]), None
+
+    deadline = make_deadline(model_info["provider"], model_info, args)
+    sink = completion_sink(store_key)
+    with app.app_context():
+        response = app.make_response(dispatch_with_permit(
+            model_info, request_params, deadline, args,
+            lambda permit: dispatch_completion(model_info, messages, request_params, deadline, auth_header, sink, args, permit=permit),
+            BATCH_TENANT
+        ))
+        result = response.get_json(silent=True)
+    metrics.inc("gateway_batch_requests_total", (model_info["provider"], str(response.status_code)))
+    retry_after = response.headers.get("Retry-After") if response.status_code == 503 else None
+    return response.status_code, result, float(retry_after) if retry_after else None
+
+def read_batch_results(path):
+    """custom_ids already written to a batch output file, cutting off a line left half-written by a crash"""
+    done = set()
+    try:
+        with open(path, "rb+") as f:
+            data = f.read()
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                f.truncate(complete)
+    except FileNotFoundError:
+        return done
+    for line in data[:complete].splitlines():
+        try:
+            done.add(json_loads(line)["custom_id"])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
+
+batch_slots = {}
+batch_slots_lock = threading.Lock()
+
+def get_batch_slots(provider, args):
+    """Semaphore bounding the batch requests in flight to one provider, across all batches"""
+    with batch_slots_lock:
+        if provider not in batch_slots:
+            batch_slots[provider] = threading.BoundedSemaphore(max(args.batch_parallel, 1))
+        return batch_slots[provider]
+
+class BatchRun:
+    """
+    Runs one batch in a background thread: validates the input file, then
+    sends its requests through the interactive completion path with at most
+    --batch-parallel calls per provider, appending every result to the
+    output (2xx) or error JSONL file as soon as it is in. Requests already
+    found in those files are skipped, which is how a batch resumes after a
+    restart.
+    """
+
+    def __init__(self, store, record, args, auth_header=None):
+        self.store = store
+        self.record = record
+        self.args = args
+        # Only in memory: the credentials of an Evalsone batch never reach the batch directory
+        self.auth_header = auth_header
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.lost = False
+        self.outputs = {}
+        self.saved_counts = None
+        self.thread = threading.Thread(target=self.run, name=f"batch-{record['id']}", daemon=True)
+
+    def run(self):
+        batch_id = self.record["id"]
+        try:
+            if self.store.cancel_requested(batch_id):
+                return self.finish("cancelled")
+            tasks, errors = validate_batch_input(
+                self.store.content_path(self.record["input_file_id"]), self.record["endpoint"],
+                self.record.get("has_credentials"), self.args
+            )
+            if errors:
+                return self.finish("failed", errors={"object": "list", "data": errors})
+            self.execute(tasks)
+        except Exception as e:
+            log_message(f"Batch {batch_id} failed: {e}", "error", self.args)
+            self.finish("failed", errors={"object": "list", "data": [{"code": "internal_error", "message": str(e), "param": None, "line": None}]})
+        finally:
+            for output in self.outputs.values():
+                output.close()
+            if self.record["status"] not in BATCH_ACTIVE_STATES:
+                self.store.clear_cancel(batch_id)
+            self.store.release(batch_id)
+
+    def execute(self, tasks):
+        counts = self.record["request_counts"]
+        done = set()
+        for kind in ("output", "error"):
+            path = self.store.content_path(self.record[f"{kind}_file_id"])
+            results = read_batch_results(path)
+            done |= results
+            counts["completed" if kind == "output" else "failed"] = len(results)
+            self.outputs[kind] = open(path, "ab")
+        counts["total"] = len(tasks)
+        if self.record["status"] == "validating":
+            self.update(status="in_progress", in_progress_at=int(time.time()))
+
+        queues = {}
+        for task in tasks:
+            if task[0] not in done:
+                queues.setdefault(task[1], deque()).append(task)
+        if "ES" in queues and self.auth_header is None:
+            # A restart or another worker lost the credentials, which are never written to disk
+            return self.finish("failed", errors={"object": "list", "data": [{
+                "code": "credentials_unavailable",
+                "message": "The Evalsone requests of this batch need the credentials it was created with, which are only kept "
+                           "in memory and were lost when the gateway restarted. Create a new batch with the remaining requests; "
+                           "the results so far are in output_file_id and error_file_id.",
+                "param": None, "line": None,
+            }]})
+        log_message(f"Batch {self.record['id']}: {len(tasks) - len(done)} of {len(tasks)} requests to run", "info", self.args)
+        workers = [
+            threading.Thread(target=self.work, args=(provider, pending), name=f"batch-{self.record['id']}-{provider}", daemon=True)
+            for provider, pending in queues.items() for _ in range(min(max(self.args.batch_parallel, 1), len(pending)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(BATCH_CHECK_INTERVAL)
+                self.checkpoint()
+
+        if self.lost:
+            return
+        if self.record["status"] == "cancelling":
+            return self.finish("cancelled")
+        if self.cancelled.is_set():
+            return self.finish("expired")
+        self.update(status="finalizing", finalizing_at=int(time.time()))
+        self.finish("completed")
+
+    def work(self, provider, pending):
+        slots = get_batch_slots(provider, self.args)
+        auth_header = self.auth_header
+        while not self.cancelled.is_set():
+            try:
+                custom_id, _, body = pending.popleft()
+            except IndexError:
+                return
+            for attempt in range(BATCH_OVERLOAD_RETRIES + 1):
+                with slots:
+                    if self.cancelled.is_set():
+                        return
+                    status, result, retry_after = execute_batch_request(body, auth_header, self.args)
+                # An overloaded gateway or open circuit is waited out, batches are in no hurry
+                if retry_after is None or attempt == BATCH_OVERLOAD_RETRIES:
+                    break
+                if self.cancelled.wait(retry_after):
+                    return
+            self.write_result(custom_id, status, result)
+
+    def write_result(self, custom_id, status, result):
+        line = {
+            "id": f"batch_req_{secrets.token_hex(12)}",
+            "custom_id": custom_id,
+            "response": {"status_code": status, "request_id": secrets.token_hex(12), "body": result},
+            "error": None,
+        }
+        kind = "output" if status < 400 else "error"
+        data = json_dumps_bytes(line) + b"\n"
+        with self.lock:
+            # One write and flush per line, so readers of the file never see half a result
+            self.outputs[kind].write(data)
+            self.outputs[kind].flush()
+            self.record["request_counts"]["completed" if kind == "output" else "failed"] += 1
+
+    def checkpoint(self):
+        """Notice cancellation and expiry, keep the lease and save the progress"""
+        batch_id = self.record["id"]
+        if self.record["status"] != "cancelling" and self.store.cancel_requested(batch_id):
+            self.cancelled.set()
+            self.update(status="cancelling", cancelling_at=int(time.time()))
+        elif time.time() >= self.record["expires_at"]:
+            self.cancelled.set()
+        if not self.store.renew(batch_id):
+            log_message(f"Batch {batch_id}: lost its lease to another worker", "error", self.args)
+            self.lost = True
+            self.cancelled.set()
+            return
+        with self.lock:
+            counts = dict(self.record["request_counts"])
+        if counts != self.saved_counts:
+            self.update()
+
+    def update(self, **fields):
+        with self.lock:
+            self.record.update(fields)
+            self.saved_counts = dict(self.record["request_counts"])
+            self.store.save(self.record)
+
+    def finish(self, status, **fields):
+        log_message(f"Batch {self.record['id']} {status}: {self.record['request_counts']}", "info", self.args)
+        self.update(status=status, **{f"{status}_at": int(time.time())}, **fields)
+
+class BatchStore:
+    """
+    Batches and their files under --batch-dir: a <batch id>.json record per
+    batch, and files/<file id>.jsonl contents next to a files/<file id>.json
+    description. The Authorization header of a batch is only kept by its
+    run in memory, so a batch with Evalsone requests left fails with
+    credentials_unavailable when it is resumed. With --workers, a
+    lease in the shared state decides which worker runs a batch, and the
+    others adopt the batches of a worker that died.
+    """
+
+    def __init__(self, path, args):
+        self.path = path
+        self.files_path = os.path.join(path, "files")
+        os.makedirs(self.files_path, exist_ok=True)
+        self.args = args
+        self.runs = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def public(record):
+        return {key: value for key, value in record.items() if key not in ("owner", "has_credentials")}
+
+    def content_path(self, file_id):
+        return os.path.join(self.files_path, f"{file_id}.jsonl")
+
+    def write_json(self, path, data):
+        """Atomic (temp file + rename), readers in other workers never see a partial record"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json_dumps_bytes(data))
+        os.replace(tmp_path, path)
+
+    def read_json(self, path):
+        try:
+            with open(path, "rb") as f:
+                return json_loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def new_file(self, filename, purpose, owner, data=b""):
+        file_id = f"file-{secrets.token_hex(12)}"
+        with open(self.content_path(file_id), "wb") as f:
+            f.write(data)
+        info = {"id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()), "filename": filename, "purpose": purpose, "owner": owner}
+        self.write_json(os.path.join(self.files_path, f"{file_id}.json"), info)
+        return info
+
+    def get_file(self, file_id, owner):
+        """Description of a file, its size read live since batch outputs grow"""
+        if not FILE_ID_PATTERN.match(file_id or ""):
+            return None
+        info = self.read_json(os.path.join(self.files_path, f"{file_id}.json"))
+        if not info or info.get("owner") != owner:
+            return None
+        try:
+            info["bytes"] = os.path.getsize(self.content_path(file_id))
+        except OSError:
+            return None
+        return self.public(info)
+
+    def upload(self, body, content_type, auth_header, purpose=None, filename=None):
+        if len(body) > BATCH_MAX_FILE_BYTES:
+            return invalid_request_error(f"Files are limited to {BATCH_MAX_FILE_BYTES // (1024 * 1024)} MB", "file_too_large", 413, "file")
+        try:
+            filename, purpose, data = read_upload(body, content_type, purpose, filename)
+        except (ValueError, UnicodeDecodeError) as e:
+            return invalid_request_error(f"Invalid upload: {e}", "invalid_file", 400, "file")
+        if data is None:
+            return invalid_request_error("The upload has no file field", "invalid_file", 400, "file")
+        if purpose != "batch":
+            return invalid_request_error("Only files with purpose batch are accepted", "invalid_purpose", 400, "purpose")
+        return self.public(self.new_file(filename, purpose, credentials_owner(auth_header), data)), 200
+
+    def create(self, data, auth_header):
+        """Record a new batch as validating and start it, validation runs in the background"""
+        if not isinstance(data, dict):
+            return invalid_request_error("Invalid JSON in request body", "invalid_request", 400)
+        owner = credentials_owner(auth_header)
+        input_file = self.get_file(data.get("input_file_id"), owner)
+        if input_file is None:
+            return invalid_request_error("No such input file", "file_not_found", 404, "input_file_id")
+        if data.get("endpoint") not in BATCH_ENDPOINTS:
+            return invalid_request_error(f"endpoint must be one of {', '.join(BATCH_ENDPOINTS)}", "invalid_endpoint", 400, "endpoint")
+        window = data.get("completion_window", "24h")
+        if window not in BATCH_COMPLETION_WINDOWS:
+            return invalid_request_error(f"completion_window must be one of {', '.join(BATCH_COMPLETION_WINDOWS)}", "invalid_completion_window", 400, "completion_window")
+
+        now = int(time.time())
+        batch_id = f"batch_{secrets.token_hex(12)}"
+        # Both outputs exist from the start, so they can be read while the batch runs
+        output_file = self.new_file(f"{batch_id}_output.jsonl", "batch_output", owner)
+        error_file = self.new_file(f"{batch_id}_error.jsonl", "batch_output", owner)
+        record = {
+            "id": batch_id, "object": "batch", "endpoint": data["endpoint"], "errors": None,
+            "input_file_id": input_file["id"], "completion_window": window, "status": "validating",
+            "output_file_id": output_file["id"], "error_file_id": error_file["id"],
+            "created_at": now, "in_progress_at": None, "expires_at": now + BATCH_COMPLETION_WINDOWS[window],
+            "finalizing_at": None, "completed_at": None, "failed_at": None, "expired_at": None,
+            "cancelling_at": None, "cancelled_at": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": data.get("metadata"), "owner": owner, "has_credentials": bool(auth_header),
+        }
+        self.save(record)
+        self.start(record, auth_header)
+        return self.public(record), 200
+
+    def save(self, record):
+        self.write_json(os.path.join(self.path, f"{record['id']}.json"), record)
+
+    def load(self, batch_id, owner=None):
+        if not BATCH_ID_PATTERN.match(batch_id or ""):
+            return None
+        record = self.read_json(os.path.join(self.path, f"{batch_id}.json"))
+        if not record or (owner is not None and record.get("owner") != owner):
+            return None
+        return record
+
+    def get(self, batch_id, auth_header):
+        record = self.load(batch_id, credentials_owner(auth_header))
+        if record is None:
+            return invalid_request_error("No such batch", "batch_not_found", 404)
+        return self.public(record), 200
+
+    def list(self, auth_header, limit=20, after=None):
+        owner = credentials_owner(auth_header)
+        records = [self.load(name[:-5], owner) for name in os.listdir(self.path) if name.endswith(".json")]
+        records = sorted((record for record in records if record), key=lambda record: (record["created_at"], record["id"]), reverse=True)
+        if after:
+            ids = [record["id"] for record in records]
+            records = records[ids.index(after) + 1:] if after in ids else []
+        page = [self.public(record) for record in records[:limit]]
+        return {
+            "object": "list", "data": page, "has_more": len(records) > limit,
+            "first_id": page[0]["id"] if page else None, "last_id": page[-1]["id"] if page else None,
+        }, 200
+
+    def cancel(self, batch_id, auth_header):
+        """Ask the worker running a batch to stop, requests in flight still finish and are written"""
+        record = self.load(batch_id, credentials_owner(auth_header))
+        if record is None:
+            return invalid_request_error("No such batch", "batch_not_found", 404)
+        if record["status"] not in BATCH_ACTIVE_STATES:
+            return invalid_request_error(f"Batch is already {record['status']}", "batch_not_active", 409)
+        open(os.path.join(self.path, f"{batch_id}.cancel"), "w").close()
+        with self.lock:
+            run = self.runs.get(batch_id)
+        if run:
+            run.checkpoint()
+            record = run.record
+        elif record["status"] != "cancelling":
+            record = dict(record, status="cancelling", cancelling_at=int(time.time()))
+        return self.public(record), 200
+
+    def cancel_requested(self, batch_id):
+        return os.path.exists(os.path.join(self.path, f"{batch_id}.cancel"))
+
+    def clear_cancel(self, batch_id):
+        try:
+            os.remove(os.path.join(self.path, f"{batch_id}.cancel"))
+        except FileNotFoundError:
+            pass
+
+    def start(self, record, auth_header=None):
+        """Run a batch in this process unless it already runs here or in another worker"""
+        with self.lock:
+            if record["id"] in self.runs:
+                return False
+            if shared_state and not shared_state.acquire(f"batch:{record['id']}", BATCH_LEASE_TTL):
+                return False
+            run = self.runs[record["id"]] = BatchRun(self, record, self.args, auth_header)
+        run.thread.start()
+        return True
+
+    def renew(self, batch_id):
+        return shared_state is None or shared_state.renew(f"batch:{batch_id}", BATCH_LEASE_TTL)
+
+    def release(self, batch_id):
+        with self.lock:
+            self.runs.pop(batch_id, None)
+        if shared_state:
+            shared_state.release(f"batch:{batch_id}")
+
+    def resume(self):
+        """Start the unfinished batches nobody runs, after a restart or the death of a worker"""
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                record = self.load(name[:-5])
+                if record and record["status"] in BATCH_ACTIVE_STATES and self.start(record):
+                    log_message(f"Resuming batch {record['id']} ({record['status']})", "info", self.args)
+
+    def watch(self):
+        while True:
+            time.sleep(BATCH_SCAN_INTERVAL)
+            try:
+                self.resume()
+            except Exception as e:
+                log_message(f"Batch scan failed: {e}", "error", self.args)
+
+def file_chunks(path, size):
+    """The first size bytes of a file in chunks, a running batch keeps appending to its outputs"""
+    with open(path, "rb") as f:
+        while size > 0:
+            chunk = f.read(min(size, STREAM_READ_SIZE))
+            if not chunk:
+                return
+            size -= len(chunk)
+            yield chunk
+
+batch_store = None
+
+def init_batches(args):
+    """Open --batch-dir and pick up the batches a previous run left unfinished"""
+    global batch_store
+    if not args.batches:
+        return None
+    batch_store = BatchStore(args.batch_dir, args)
+    batch_store.resume()
+    # Other workers only adopt batches whose lease lapsed, so keep looking
+    if shared_state:
+        threading.Thread(target=batch_store.watch, name="batch-watch", daemon=True).start()
+    return batch_store
+
+def batches_disabled():
+    return invalid_request_error("Batches are off, start the gateway with --batches", "batches_disabled", 404)
+
+@app.after_request
+def record_completion_metrics(response):
+    started = g.get("request_started")
+    if started is not None:
+        provider, model = g.get("metric_labels", (None, None))
+        # Streamed responses are timed by StreamRelay once the last chunk is out
+        duration = None if response.is_streamed else time.monotonic() - started
+        record_request_metrics(provider, model, response.status_code, duration)
+        # StreamRelay clears the label of a streaming thread when the relay ends
+        if not response.is_streamed:
+            profiler.clear_thread()
+    if g.get("conversation_id"):
+        response.headers[CONVERSATION_HEADER] = g.conversation_id
+    trace = g.get("trace")
+    if trace:
+        response.headers[TRACE_HEADER] = trace.trace_id
+        # A relayed stream finishes its own trace once the last chunk is out
+        if not trace.streaming:
+            trace.finish(response.status_code)
+        current_trace.set(None)
+    return response
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON and SSE responses for the client's Accept-Encoding, streams flushed per frame"""
+    if response.status_code < 200 or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+        return response
+    streamed = response.is_streamed
+    if not encoding_varies(response.mimetype, streamed):
+        return response
+    response.vary.add("Accept-Encoding")
+    codec = response_codec(request.headers.get("Accept-Encoding"), response.mimetype, streamed)
+    if codec is None:
+        return response
+    if streamed:
+        response.response = CompressedStream(response.response, codec)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < get_config().compress_min_bytes:
+            return response
+        response.set_data(compress_body(body, codec))
+    response.headers["Content-Encoding"] = codec
+    if "ETag" in response.headers:
+        response.headers["ETag"] = weak_etag(response.headers["ETag"])
+    return response
+
+@app.before_request
+def require_admin():
+    """Answer 403 on the ADMIN_PATHS to anyone but an admin client"""
+    if request.path in ADMIN_PATHS and not is_admin_request(request.remote_addr, request.headers.get(ADMIN_TOKEN_HEADER)):
+        return jsonify({"error": "Forbidden"}), 403
+
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/v1/profile", methods=["GET"])
+def profile_route():
+    if request.args.get("format") == "json":
+        return jsonify(profiler.get_stats())
+    return Response(profiler.collapsed(request.args.get("label")), mimetype="text/plain")
+
+@app.route("/v1/profile", methods=["POST"])
+def control_profile_route():
+    options = request.get_json(silent=True)
+    if not isinstance(options, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    return jsonify(control_profiler(options))
+
+@app.route("/v1/balance", methods=["GET"])
+def get_balance():
+    args = get_config()
+    try:
+        result, status = balance_cache.get(request.headers.get('Authorization'), args)
+        return jsonify(result), status
 
     except Exception as e:
         log_message(f"Unexpected error in get_balance: {e}", "error", args)
@@ -557,147 +4637,306 @@ def get_balance():
 
 @app.route("/v1/models", methods=["GET"])
 def list_models():
-    args = parse_args()
+    args = get_config()
     try:
-        model_list = []
-        for model in models_data:
-            model_list.append({
-                "id": model["model_name"],
-                "object": "model",
-                "created": 1999999999,
-                "owned_by": "system"
-            })
-
-        return jsonify({
-            "object": "list",
-            "data": model_list
-        })
+        registry = model_registry
+        if request.if_none_match.contains_weak(registry.etag.strip('"')):
+            return Response(status=304, headers={"ETag": registry.etag})
+        return Response(registry.models_payload, mimetype="application/json", headers={"ETag": registry.etag})
 
     except Exception as e:
         log_message(f"Unexpected error in list_models: {e}", "error", args)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/v1/pools", methods=["GET"])
+def pool_stats():
+    return jsonify(get_pool_stats())
+
+@app.route("/v1/streams", methods=["GET"])
+def stream_stats_route():
+    return jsonify(get_stream_stats())
+
+@app.route("/v1/cache", methods=["GET"])
+def cache_stats():
+    return jsonify(get_cache_stats())
+
+@app.route("/v1/limits", methods=["GET"])
+def limit_stats():
+    return jsonify(concurrency.get_stats())
+
+@app.route("/v1/breakers", methods=["GET"])
+def breaker_stats():
+    return jsonify(breakers.get_stats())
+
+@app.route("/v1/conversations", methods=["GET"])
+def conversation_stats():
+    return jsonify(conversation_store.get_stats())
+
+@app.route("/v1/conversations/<conversation_id>", methods=["GET", "DELETE"])
+def conversation(conversation_id):
+    owner = credentials_owner(request.headers.get('Authorization'))
+    if request.method == "DELETE":
+        found = conversation_store.delete(conversation_id, owner)
+        messages = []
+    else:
+        messages = conversation_store.load(conversation_id, owner, record=False)
+        found = messages is not None
+    if not found:
+        body, status = invalid_request_error("Conversation not found or expired", "conversation_not_found", 404)
+        return jsonify(body), status
+    return jsonify({"id": conversation_id, "object": "conversation", "deleted": request.method == "DELETE", "messages": messages})
+
+def batch_route(action):
+    """JSON response of a BatchStore call, or the error when batches are off"""
+    body, status = action(batch_store) if batch_store else batches_disabled()
+    return jsonify(body), status
+
+@app.route("/v1/files", methods=["POST"])
+def upload_file():
+    return batch_route(lambda store: store.upload(
+        request.get_data(), request.content_type, request.headers.get('Authorization'),
+        request.args.get("purpose"), request.args.get("filename")
+    ))
+
+@app.route("/v1/files/<file_id>", methods=["GET"])
+def file_info(file_id):
+    def describe(store):
+        info = store.get_file(file_id, credentials_owner(request.headers.get('Authorization')))
+        return (info, 200) if info else invalid_request_error("No such file", "file_not_found", 404)
+    return batch_route(describe)
+
+@app.route("/v1/files/<file_id>/content", methods=["GET"])
+def file_content(file_id):
+    info = batch_store and batch_store.get_file(file_id, credentials_owner(request.headers.get('Authorization')))
+    if info:
+        return Response(
+            file_chunks(batch_store.content_path(file_id), info["bytes"]),
+            mimetype="application/jsonl", headers={"Content-Length": str(info["bytes"])}
+        )
+    return batch_route(lambda store: invalid_request_error("No such file", "file_not_found", 404))
+
+@app.route("/v1/batches", methods=["POST"])
+def create_batch():
+    return batch_route(lambda store: store.create(request.get_json(silent=True), request.headers.get('Authorization')))
+
+@app.route("/v1/batches", methods=["GET"])
+def list_batches():
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    return batch_route(lambda store: store.list(request.headers.get('Authorization'), limit, request.args.get("after")))
+
+@app.route("/v1/batches/<batch_id>", methods=["GET"])
+def get_batch(batch_id):
+    return batch_route(lambda store: store.get(batch_id, request.headers.get('Authorization')))
+
+@app.route("/v1/batches/<batch_id>/cancel", methods=["POST"])
+def cancel_batch(batch_id):
+    return batch_route(lambda store: store.cancel(batch_id, request.headers.get('Authorization')))
+
 @app.route("/v1/chat/completions", methods=["POST"])
 def chat_completions():
-    args = parse_args()
+    args = get_config()
+    g.request_started = time.monotonic()
+    trace = g.trace = start_trace(request.headers.get(TRACE_HEADER))
+    profiler.label_thread("chat_completions")
     try:
         try:
-            data = request.get_json()
+            with trace_span("body_parse"):
+                data = request.get_json()
         except json.JSONDecodeError as e:
             log_message(f"Invalid JSON in request body: {e}", "error", args)
             return jsonify({"error": "Invalid JSON in request body"}), 400
 
-        messages = data.get("messages", [])
-        if not messages:
-            log_message("No messages in request", "error", args)
-            return jsonify({"error": "No messages provided"}), 400
-
-        model_name = data.get("model", "")
-        if not model_name:
-            log_message("No model name provided", "error", args)
-            return jsonify({"error": "Model name is required"}), 400
-
-        model_info = next((model for model in models_data if model["model_name"] == model_name), None)
-        if not model_info:
-            log_message(f"Invalid model name: {model_name}", "error", args)
-            return jsonify({"error": "Invalid model name"}), 400
-
-        request_params = {
-            "max_tokens": data.get("max_tokens"),
-            "frequency_penalty": data.get("frequency_penalty"),
-            "presence_penalty": data.get("presence_penalty"),
-            "temperature": data.get("temperature"),
-            "stream": data.get("stream", False)
-        }
+        with trace_span("model_lookup"):
+            parsed, parse_error = parse_completion_request(data, args)
+        if parse_error:
+            message, status = parse_error
+            return jsonify({"error": message}), status
+        model_info, messages, request_params = parsed
+        g.metric_labels = (model_info["provider"], model_info["model_name"])
+        conversation = None
+        cache_control = request.headers.get("Cache-Control")
+        if request.headers.get(CONVERSATION_HEADER):
+            opened, conversation_failure = open_conversation(request.headers[CONVERSATION_HEADER], request.headers.get('Authorization'), messages, args)
+            if conversation_failure:
+                body, status = conversation_failure
+                return jsonify(body), status
+            conversation, messages = opened
+            g.conversation_id = conversation[0]
+            # The turn is appended by the sink of its own completion, never answered by a cache hit or another flight
+            cache_control = f"{cache_control or ''}, no-cache"
+        with trace_span("context_fit"):
+            messages, context_error = fit_context(model_info, messages, request_params, args)
+        if context_error:
+            body, status = context_error
+            return jsonify(body), status
+        if trace:
+            trace.attributes.update(provider=model_info["provider"], model=model_info["model_name"], stream=bool(request_params["stream"]))
+        profiler.label_thread(f"chat_completions/{model_info['provider']}")
+        deadline = make_deadline(model_info["provider"], model_info, args, request.headers.get(DEADLINE_HEADER))
 
-        # Handle PAI models (no auth required)
-        if model_info["provider"] == "PAI":
-            result, error = send_pai_request(messages, model_info["model_id"], request_params, args)
-            if error:
-                return jsonify({"error": f"PAI request failed: {error}"}), 500
-                
-            if request_params["stream"]:
-                def generate():
-                    try:
-                        for line in result:
-                            line = line.decode("utf-8").strip()  # Decode bytes to string
-                            if line:  
-                                yield f"{line}\n\n"  # Ensure it follows SSE format
-                    except Exception as e:
-                        log_message(f"Stream encoding error: {e}", "error", args)
-                        yield f"data: [ERROR] Failed to encode response\n\n"
-
-                return Response(stream_with_context(generate()), mimetype='text/event-stream')
-            return jsonify(result)
-
-        # Handle DeepInfra models (no auth required)
-        if model_info["provider"] == "DI":
-            result, error = send_deepinfra_request(messages, model_info["model_id"], request_params, args)
-            if error:
-                return jsonify({"error": f"DeepInfra request failed: {error}"}), 500
-                
-            if request_params["stream"]:
-                def generate():
-                    try:
-                        for line in result:
-                            yield f"{line}\n\n"
-                    except Exception as e:
-                        log_message(f"Stream encoding error: {e}", "error", args)
-                        yield f"data: [ERROR] Failed to encode response\n\n"
-                return Response(stream_with_context(generate()), mimetype='text/event-stream')
-            return jsonify(result)
-            
-        # Handle Evalsone models (auth required)
-        else:  
-            auth_header = request.headers.get('Authorization')
-            if not auth_header:
-                log_message("Missing Authorization header for Evalsone model", "error", args)
-                return jsonify({"error": "Missing Authorization header"}), 401
+        auth_error = evalsone_auth_error(model_info, request.headers.get('Authorization'), args)
+        if auth_error:
+            message, status = auth_error
+            return jsonify({"error": message}), status
+        lookup_key, store_key = cache_plan(
+            model_info, messages, request_params,
+            cache_control, request.headers.get(CACHE_BYPASS_HEADER), request.headers.get('Authorization')
+        )
+        sink = completion_sink(store_key, conversation)
+        cached = cached_completion(lookup_key, request_params["stream"])
+        if cached:
+            body, mimetype = cached
+            return Response(body, mimetype=mimetype, headers={CACHE_STATUS_HEADER: "HIT"})
 
-            email, password = decode_auth_token(auth_header)
-            if not email or not password:
-                log_message("Invalid authorization token for Evalsone model", "error", args)
-                return jsonify({"error": "Invalid authorization token"}), 401
+        flight_key = coalesce_key(
+            model_info, messages, request_params, request.headers.get('Authorization'),
+            cache_control, request.headers.get(CACHE_BYPASS_HEADER), args
+        )
 
-            token = tokens_data.get(email, {}).get("access_token")
-            result, error = send_evalsone_request(messages, token, model_info["model_id"], request_params, args)
-            
-            if error == "token_expired":
-                token = get_new_token(email, password, args)
-                if token:
-                    tokens_data[email] = {"access_token": token}
-                    save_tokens(tokens_data)
-                    result, error = send_evalsone_request(messages, token, model_info["model_id"], request_params, args)
-                else:
-                    return jsonify({"error": "Failed to refresh token"}), 401
-                
-            if error:
-                return jsonify({"error": f"Evalsone request failed: {error}"}), 500
-
-            if request_params["stream"]:
-                def generate():
-                    for line in result:
-                        yield f"data: {line.strip()}\n\n"
-                return Response(stream_with_context(generate()), mimetype='text/event-stream')
-
-            response_data = {
-                "id": str(result["created"]),
-                "object": result.get("object", "chat.completion"),
-                "created": result.get("created", int(time.time())),
-                "model": model_name,
-                "choices": [{"message": {"role": "assistant", "content": result.get("content", "")}}]
-            }
-            
-            return jsonify(response_data)
+        tenant = client_tenant(model_info, request.headers.get('Authorization'), request.remote_addr, args)
+
+        def dispatch(flight=None):
+            return dispatch_with_permit(model_info, request_params, deadline, args, lambda permit: dispatch_completion(
+                model_info, messages, request_params, deadline, request.headers.get('Authorization'), sink, args, flight, permit
+            ), tenant)
+
+        if not flight_key:
+            return dispatch()
+        flight, leader = join_flight(flight_key)
+        if leader:
+            return lead_flight(flight, dispatch)
+        response = follow_flight(flight, model_info["provider"], deadline, args, model_info["model_name"])
+        return response if response is not None else dispatch()
 
     except Exception as e:
         log_message(f"Unexpected error: {e}", "error", args)
         return jsonify({"error": str(e)}), 500
 
+def start_services(args):
+    """Background threads, pools and caches of one serving process, started after any fork"""
+    watch_models(args)
+    init_shared_state(args)
+    if args.conversations:
+        conversation_store.configure(args, shared_state)
+    token_store.start(args)
+    init_upstream_sessions(args)
+    init_completion_cache(args)
+    init_tracing(args)
+    # Last, a resumed batch starts sending right away
+    init_batches(args)
+    if args.profile:
+        profiler.start(args.profile_interval, args.profile_mode)
+
+def serve(args, port, ssl_context=None, fd=None):
+    """Serve on port, or on the inherited listening socket fd of a worker"""
+    if args.asgi:
+        import asgi_app
+        asgi_app.run(args, port, ssl_context, fd)
+    elif fd is None:
+        app.run(debug=False, host="0.0.0.0", port=port, ssl_context=ssl_context)
+    else:
+        from werkzeug.serving import make_server
+        make_server("0.0.0.0", port, app, threaded=True, ssl_context=ssl_context, fd=fd).serve_forever()
+
+def run_worker(args, index, listener, port, ssl_context):
+    """Body of a forked worker process, never returns"""
+    global worker_index, log_rotation, log_writer, log_writer_lock
+    worker_index = index
+    log_rotation = index == 0
+    # The parent stops its log writer before forking, this process starts its own
+    log_writer = None
+    log_writer_lock = threading.Lock()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    status = 0
+    try:
+        start_services(args)
+        log_message(f"Worker {index} serving (pid {os.getpid()})", "debug", args)
+        serve(args, port, ssl_context, listener.fileno())
+    except Exception as e:
+        log_message(f"Worker {index} failed: {e}", "error", args)
+        status = 1
+    finally:
+        os._exit(status)
+
+def serve_workers(args, port, ssl_context=None):
+    """
+    Pre-fork serving: bind the port once, fork --workers processes that
+    all accept on it and share state through --state-file, and replace
+    workers that die until SIGTERM/SIGINT.
+    """
+    if not hasattr(os, "fork"):
+        raise SystemExit("--workers needs os.fork, run a single process on this platform")
+    global log_rotation
+    # Worker 0 rotates logs.txt, the parent only appends to it
+    log_rotation = False
+    shared = SharedState(args.state_file)
+    token_store.import_shared(shared)
+    shared.close()
+
+    listener = socket.create_server(("0.0.0.0", port), backlog=1024)
+    listener.set_inheritable(True)
+    workers = {}
+    stopping = False
+
+    def spawn(index):
+        # Never fork while the log writer thread runs, the child could inherit its locks held
+        stop_log_writer()
+        pid = os.fork()
+        if pid == 0:
+            run_worker(args, index, listener, port, ssl_context)
+        workers[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        spawn(index)
+    log_message(f"Started {args.workers} workers sharing {args.state_file}", "info", args)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index, started_at = workers.pop(pid, (None, 0))
+        if index is None or stopping:
+            continue
+        log_message(f"Worker {index} (pid {pid}) exited with status {status}, restarting it", "error", args)
+        # Do not spin when a worker keeps dying on startup
+        if time.monotonic() - started_at < WORKER_RESPAWN_DELAY:
+            time.sleep(WORKER_RESPAWN_DELAY)
+        spawn(index)
+
+    listener.close()
+    token_store.export_shared(SharedState(args.state_file))
+
+def configure_workers(args):
+    """Defaults of --workers: a state file, the cache file tier in it and limits split between workers"""
+    args.state_file = args.state_file or DEFAULT_STATE_FILE
+    if args.cache and not args.cache_file:
+        args.cache_file = args.state_file
+    # Every worker enforces its share of the concurrency limits and queue
+    args.concurrency_initial = max(args.concurrency_initial // args.workers, 1)
+    args.concurrency_max = max(args.concurrency_max // args.workers, 1)
+    args.queue_size = max(args.queue_size // args.workers, 1)
+
 # [Previous imports and functions remain the same until main]
 
 if __name__ == "__main__":
-    args = parse_args()
+    args = configure(parse_args())
+    # Let the asyncio gateway import this module instead of a second copy of it
+    sys.modules.setdefault("api", sys.modules[__name__])
     
     if not args.disable_log and not os.path.exists(LOG_FILE):
         open(LOG_FILE, 'a').close()
@@ -716,6 +4955,13 @@ if __name__ == "__main__":
     
     port = args.port if args.port is not None else default_port
     log_message(f"Using port {port}", "info", args)
+    set_upstream_hosts(args.upstream_url)
+    set_tenant_weights(args.tenant_weight)
     load_models()
-    load_tokens()
-    app.run(debug=False, host="0.0.0.0", port=port, ssl_context=ssl_context)
+    token_store.load()
+    if args.workers > 1:
+        configure_workers(args)
+        serve_workers(args, port, ssl_context)
+    else:
+        start_services(args)
+        serve(args, port, ssl_context)
@@ -0,0 +1,1035 @@
+"""
+Native asyncio gateway mode for api.py.
+
+Serves the same routes as the Flask app (/v1/chat/completions, /v1/models,
+/v1/balance, /v1/pools, /v1/streams, /v1/cache, /v1/limits, /v1/breakers, /v1/conversations, /v1/files, /v1/batches, /v1/profile, /metrics) but relays upstream streams with async HTTP clients
+and async generators, so one process can hold thousands of open streams.
+Start it with `python api.py --asgi`.
+"""
+import asyncio
+import json
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+import api
+
+# Set by run(), mirrors the parsed CLI args of api.py
+args = None
+async_clients = {}
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"Authorization, Content-Type, Content-Encoding, X-Conversation-Id"),
+    (b"access-control-allow-methods", b"GET, POST, DELETE, OPTIONS"),
+]
+
+
+def init_async_clients():
+    """Create one pooled keep-alive async client per provider"""
+    pool_size = args.pool_size if args else api.DEFAULT_POOL_SIZE
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    proxy = args.proxy if args and args.proxy else None
+    for provider in api.PROVIDER_HOSTS:
+        async_clients[provider] = httpx.AsyncClient(limits=limits, proxy=proxy, timeout=None)
+
+
+async def close_async_clients():
+    """Close all async upstream clients"""
+    for client in async_clients.values():
+        await client.aclose()
+    async_clients.clear()
+
+
+async def read_body(receive):
+    """Read the full request body from the ASGI receive channel"""
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+
+async def send_body(send, status, body, content_type, extra_headers=()):
+    """Send a complete pre-serialized response"""
+    headers = [
+        (b"content-type", content_type),
+        (b"content-length", str(len(body)).encode()),
+    ] + list(extra_headers) + CORS_HEADERS
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, data):
+    """Send a complete JSON response"""
+    await send_body(send, status, json.dumps(data).encode("utf-8"), b"application/json")
+
+
+async def send_models(send, headers_map):
+    """Send the pre-serialized /v1/models payload, or 304 when the ETag matches"""
+    registry = api.model_registry
+    etag_header = [(b"etag", registry.etag.encode())]
+    if registry.etag in headers_map.get("if-none-match", ""):
+        await send({"type": "http.response.start", "status": 304, "headers": etag_header + CORS_HEADERS})
+        return await send({"type": "http.response.body", "body": b""})
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(registry.models_payload)).encode()),
+    ] + etag_header + CORS_HEADERS
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({"type": "http.response.body", "body": registry.models_payload})
+
+
+async def pump_frames(send, frames, provider, meter):
+    """Send SSE frames (bytes) to the client and return the stream outcome"""
+    sent = meter.sent
+    try:
+        async for frame in frames:
+            sent(frame)
+            await send({"type": "http.response.body", "body": frame, "more_body": True})
+        return "completed"
+    except api.UpstreamTimeout as e:
+        api.log_message(f"{api.PROVIDER_LABELS[provider]} stream timed out: {e}", "error", args)
+        await send({"type": "http.response.body", "body": api.timeout_stream_frames(str(e)).encode("utf-8"), "more_body": True})
+        return "timed_out"
+    except Exception as e:
+        api.log_message(f"Stream encoding error: {e}", "error", args)
+        await send({"type": "http.response.body", "body": b"data: [ERROR] Failed to encode response\n\n", "more_body": True})
+        return "failed"
+
+
+class AsyncBroadcast:
+    """
+    Fans one upstream stream out to every request attached to it. A pump task
+    reads the upstream into a buffer, subscribers replay the buffered prefix
+    and then follow the live tail. The pump is cancelled, closing the
+    upstream, once the last subscriber is gone.
+    """
+
+    def __init__(self, frames, on_done):
+        self.frames = frames
+        self.on_done = on_done
+        self.chunks = []
+        self.subscribers = 0
+        self.done = False
+        self.abandoned = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.pump())
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def pump(self):
+        try:
+            async for frame in self.frames:
+                self.chunks.append(frame)
+                self.notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            await self.frames.aclose()
+            self.done = True
+            self.notify()
+            self.on_done()
+
+    def subscribe(self):
+        """An AsyncSubscription, None if the stream was already abandoned"""
+        if self.abandoned:
+            return None
+        self.subscribers += 1
+        return AsyncSubscription(self)
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if not self.subscribers and not self.done:
+            self.abandoned = True
+            self.task.cancel()
+
+
+class AsyncSubscription:
+    """One client's position in an AsyncBroadcast"""
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.index = 0
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        broadcast = self.broadcast
+        while self.index >= len(broadcast.chunks) and not broadcast.done:
+            await broadcast.changed.wait()
+        chunks = broadcast.chunks[self.index:]
+        self.index += len(chunks)
+        # A late joiner gets the whole buffered prefix in one message
+        if chunks:
+            return b"".join(chunks)
+        if broadcast.error:
+            raise broadcast.error
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast.unsubscribe()
+
+
+class AsyncFlight:
+    """One upstream completion shared by identical concurrent requests"""
+
+    def __init__(self, key):
+        self.key = key
+        self.ready = asyncio.Event()
+        self.messages = None
+        self.broadcast = None
+
+    def publish_response(self, messages):
+        """Hand the recorded ASGI messages of a complete response (None if the leader failed) to the followers"""
+        self.messages = messages
+        api.land_flight(self)
+        self.ready.set()
+
+    def publish_stream(self, frames):
+        """Start broadcasting a stream, returns the leader's own subscription"""
+        self.broadcast = AsyncBroadcast(frames, lambda: api.land_flight(self))
+        subscription = self.broadcast.subscribe()
+        self.broadcast.start()
+        self.ready.set()
+        return subscription
+
+
+class FlightRecorder:
+    """ASGI send wrapper keeping a copy of the leader's response for its followers"""
+
+    def __init__(self, send, flight):
+        self.send = send
+        self.flight = flight
+        self.messages = []
+
+    async def __call__(self, message):
+        if self.flight.broadcast is None:
+            self.messages.append(message)
+        await self.send(message)
+
+    def complete_response(self):
+        """The recorded messages if they form a complete response"""
+        if self.messages and not self.messages[-1].get("more_body", False):
+            return self.messages
+        return None
+
+
+async def lead_flight(send, flight, dispatch):
+    """Run the upstream call of a flight and hand its response to the followers"""
+    recorder = FlightRecorder(send, flight)
+    try:
+        return await dispatch(recorder, flight)
+    finally:
+        if not flight.ready.is_set():
+            flight.publish_response(recorder.complete_response())
+
+
+async def follow_flight(send, receive, flight, provider, deadline, model=None):
+    """Answer a request attached to a flight, False if it has to go upstream on its own"""
+    try:
+        await asyncio.wait_for(flight.ready.wait(), max(deadline.remaining(), 0))
+    except asyncio.TimeoutError:
+        await send_json(send, 504, api.timeout_error("Request deadline exceeded waiting for an identical request"))
+        return True
+    if flight.broadcast:
+        subscription = flight.broadcast.subscribe()
+        if subscription is None:
+            return False
+        await send_stream(send, receive, provider, subscription, model=model, started_at=deadline.started_at)
+        return True
+    if flight.messages is None:
+        await send_json(send, 500, {"error": "Identical in-flight request failed"})
+        return True
+    start, *body = flight.messages
+    await send(dict(start, headers=list(start["headers"]) + [(api.COALESCED_HEADER.lower().encode(), b"true")]))
+    for message in body:
+        await send(message)
+    return True
+
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone away"""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def send_stream(send, receive, provider, frames, flight=None, model=None, started_at=None):
+    """
+    Relay an async generator of SSE frames (bytes) to the client. The relay
+    races a watcher on the client connection, so a disconnect cancels it at
+    once and closes the upstream response instead of draining it.
+    """
+    headers = [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache"),
+    ] + CORS_HEADERS
+    if flight:
+        frames = flight.publish_stream(frames)
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    api.record_stream_event(provider, "started")
+    meter = api.StreamMeter(provider, model, started_at)
+    relay = asyncio.ensure_future(pump_frames(send, frames, provider, meter))
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait((relay, watcher), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        relay.cancel()
+        try:
+            outcome = await relay
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            api.log_message(f"Client disconnected, cancelling {api.PROVIDER_LABELS[provider]} stream", "debug", args)
+        await frames.aclose()
+        api.record_stream_event(provider, outcome)
+        meter.finish(outcome)
+    if outcome != "cancelled":
+        await send({"type": "http.response.body", "body": b""})
+
+
+def connect_tracer(provider):
+    """httpx trace hook recording how long opening a new upstream connection (TCP + TLS) takes"""
+    started = None
+
+    async def trace(event_name, info):
+        nonlocal started
+        if event_name == "connection.connect_tcp.started":
+            started = time.monotonic()
+        elif started is not None and event_name in (
+            "connection.start_tls.complete", "http11.send_request_headers.started", "http2.send_request_headers.started"
+        ):
+            api.metrics.observe("gateway_upstream_connect_seconds", (provider,), time.monotonic() - started)
+            trace = api.current_trace.get()
+            if trace:
+                trace.add_span("upstream_connect", started)
+            started = None
+
+    return trace
+
+
+async def open_upstream(provider, api_url, headers, payload, deadline):
+    """Send an upstream request within the deadline, keeping the body unread when streaming"""
+    client = async_clients[provider]
+    # requests silently drops None headers (e.g. no cached token yet), httpx does not
+    headers = {key: value for key, value in headers.items() if value is not None}
+    connect_timeout, first_byte_timeout = deadline.request_timeout()
+    timeout = httpx.Timeout(
+        connect=connect_timeout,
+        read=max(first_byte_timeout, deadline.timeouts["idle"]),
+        write=connect_timeout,
+        pool=connect_timeout
+    )
+    upstream_request = client.build_request(
+        "POST", api_url, headers=headers, json=payload, timeout=timeout,
+        extensions={"trace": connect_tracer(provider)}
+    )
+    try:
+        with api.trace_span(api.upstream_span(payload)):
+            return await asyncio.wait_for(
+                client.send(upstream_request, stream=payload["stream"]),
+                min(connect_timeout + first_byte_timeout, deadline.remaining())
+            )
+    except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+        raise api.UpstreamTimeout("Upstream did not respond in time") from e
+
+
+async def aiter_upstream_lines(response, deadline):
+    """aiter_lines() with idle and total deadlines that always releases the upstream connection"""
+    try:
+        lines = response.aiter_lines()
+        while True:
+            try:
+                line = await asyncio.wait_for(lines.__anext__(), deadline.idle_timeout())
+            except StopAsyncIteration:
+                return
+            except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+                raise api.UpstreamTimeout("Upstream stream stalled") from e
+            yield line
+    finally:
+        await response.aclose()
+
+
+async def aiter_upstream_bytes(response, deadline):
+    """Upstream body chunks as they arrive, with idle and total deadlines, always releasing the connection"""
+    try:
+        chunks = response.aiter_bytes()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), deadline.idle_timeout())
+            except StopAsyncIteration:
+                return
+            except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+                raise api.UpstreamTimeout("Upstream stream stalled") from e
+            if chunk:
+                yield chunk
+    finally:
+        await response.aclose()
+
+
+async def relay_openai_stream(response, deadline, rewriter=None):
+    """Relay an upstream OpenAI-style SSE stream as raw bytes, reframing only to rewrite the model name"""
+    chunks = aiter_upstream_bytes(response, deadline)
+    try:
+        async for chunk in chunks:
+            if rewriter is None:
+                yield chunk
+                continue
+            data = rewriter.feed(chunk)
+            if data:
+                yield data
+    finally:
+        await chunks.aclose()
+    if rewriter is not None:
+        rest = rewriter.flush()
+        if rest:
+            yield rest
+
+
+async def relay_evalsone_stream(response, model_name, deadline):
+    """Transform an Evalsone SSE stream into OpenAI chat.completion.chunk frames"""
+    transcoder = api.EvalsoneTranscoder(model_name)
+    lines = aiter_upstream_lines(response, deadline)
+    try:
+        async for line in lines:
+            if not line:
+                continue
+            frame = transcoder.transcode(line.encode("utf-8"))
+            if frame is not None:
+                yield frame
+                if transcoder.finished:
+                    break
+    finally:
+        await lines.aclose()
+    yield transcoder.final_frames()
+
+
+async def cache_stream(frames, sink):
+    """Pass SSE frames through, handing the completion to its sink once the stream ends normally"""
+    capture = api.StreamCapture()
+    try:
+        async for frame in frames:
+            capture.feed(frame)
+            yield frame
+    finally:
+        await frames.aclose()
+    await asyncio.to_thread(api.store_stream_capture, sink, capture)
+
+
+async def cache_result(result, sink):
+    """Hand a non-streaming completion body to its sink off the event loop"""
+    if sink:
+        await asyncio.to_thread(api.cache_result, result, sink)
+    return result
+
+
+class AsyncLimiterWaiter(api.LimiterWaiter):
+    """api.LimiterWaiter for a coroutine, woken from whichever thread frees the slot"""
+
+    def __init__(self, tenant=None, weight=1.0):
+        super().__init__(tenant, weight)
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.set_result)
+
+    def set_result(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+async def acquire_permit(model_info, request_params, deadline, tenant=None):
+    """Async api.ConcurrencyControl.acquire, (permit, None) or (None, (message, retry_after))"""
+    acquired = []
+    started_at = time.monotonic()
+    try:
+        for limiter in api.concurrency.limiters_for(model_info, args):
+            waiter = AsyncLimiterWaiter(tenant, api.tenant_weight(tenant))
+            state = limiter.enter(waiter)
+            if state == "queued":
+                timeout = max(min(args.queue_timeout, deadline.remaining()), 0)
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                except asyncio.CancelledError:
+                    if limiter.abandon(waiter) == "admitted":
+                        limiter.release()
+                    for held in acquired:
+                        held.release()
+                    raise
+                state = limiter.abandon(waiter)
+            if state != "admitted":
+                return None, api.concurrency.reject(limiter, state, acquired)
+            acquired.append(limiter)
+        return api.ConcurrencyPermit(acquired, bool(request_params["stream"])), None
+    finally:
+        api.record_queue_wait(tenant, started_at)
+
+
+def response_overloaded(response):
+    """api.is_overload_error for an upstream status: 429 and 5xx are overload, other errors say nothing"""
+    if not response.is_error:
+        return False
+    return True if response.status_code == 429 or response.status_code >= 500 else None
+
+
+async def call_upstream(provider, model_info, api_url, headers, payload, deadline, permit=None):
+    """
+    open_upstream behind the circuit breakers, feeding the concurrency
+    limits and retrying connection failures and 429/502/503 answers with
+    jittered backoff within the deadline. Returns the response, or the
+    api.CircuitBreaker that is open.
+    """
+    attempt = 0
+    while True:
+        tickets, open_breaker = api.breakers.enter(model_info, args)
+        if tickets is None:
+            return open_breaker
+        started_at = time.monotonic()
+        try:
+            response = await open_upstream(provider, api_url, headers, payload, deadline)
+        except (api.UpstreamTimeout, httpx.HTTPError) as e:
+            api.observe_upstream(permit, True, started_at)
+            api.breakers.finish(tickets, True)
+            delay = api.retry_delay(attempt, deadline, args) if isinstance(e, httpx.ConnectError) else None
+            if delay is None:
+                raise
+            reason = "connect"
+        else:
+            overloaded = response_overloaded(response)
+            api.observe_upstream(permit, overloaded, started_at)
+            api.breakers.finish(tickets, overloaded)
+            delay = api.retry_delay(attempt, deadline, args) if response.status_code in api.RETRY_STATUSES else None
+            if delay is None:
+                return response
+            reason = str(response.status_code)
+            await response.aclose()
+        api.metrics.inc("gateway_upstream_retries_total", (provider, reason))
+        api.log_message(f"Retrying {provider} request in {delay:.2f}s after: {reason}", "debug", args)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def send_circuit_open(send, breaker):
+    body, retry_after = api.circuit_open_error(breaker)
+    return await send_body(send, 503, json.dumps(body).encode("utf-8"), b"application/json", [(b"retry-after", str(retry_after).encode())])
+
+
+async def upstream_error_text(response):
+    """Read and close an upstream error response"""
+    await response.aread()
+    await response.aclose()
+    return response.text
+
+
+async def handle_openai_provider(send, receive, provider, label, model_info, messages, request_params, deadline, sink=None, flight=None, permit=None):
+    """Serve a completion from an OpenAI-compatible provider (DI or PAI)"""
+    if provider == "DI":
+        try:
+            api_url, headers, payload = api.build_deepinfra_request(messages, model_info["model_id"], request_params)
+        except ValueError as e:
+            api.log_message(str(e), "error", args)
+            return await send_json(send, 500, {"error": f"{label} request failed: Invalid message format"})
+    else:
+        api_url, headers, payload = api.build_pai_request(messages, model_info["model_id"], request_params)
+
+    try:
+        response = await call_upstream(provider, model_info, api_url, headers, payload, deadline, permit)
+    except api.UpstreamTimeout as e:
+        api.log_message(f"{label} request timed out: {e}", "error", args)
+        return await send_json(send, 504, api.timeout_error())
+    except httpx.HTTPError as e:
+        api.log_message(f"{label} request failed: {e}", "error", args)
+        return await send_json(send, 500, {"error": f"{label} request failed: {e}"})
+    if isinstance(response, api.CircuitBreaker):
+        return await send_circuit_open(send, response)
+
+    if response.is_error:
+        error_text = await upstream_error_text(response)
+        api.log_message(f"{label} HTTP error: {error_text}", "error", args)
+        return await send_json(send, 500, {"error": f"{label} request failed: HTTP {response.status_code}: {error_text}"})
+
+    if request_params["stream"]:
+        frames = relay_openai_stream(response, deadline, api.model_rewriter(model_info, args))
+        return await send_stream(
+            send, receive, provider, cache_stream(frames, sink) if sink else frames, flight,
+            model_info["model_name"], deadline.started_at
+        )
+
+    result = response.json()
+    if provider == "PAI":
+        result = api.clean_pai_response(result)
+    with api.trace_span("finalize"):
+        result = await cache_result(api.rewrite_model_name(result, model_info, args), sink)
+    return await send_json(send, 200, result)
+
+
+async def refresh_token(email, password, deadline, stale_token=None):
+    """Log in again without blocking the event loop"""
+    with api.trace_span("token_refresh"):
+        return await asyncio.to_thread(api.token_store.refresh, email, password, args, deadline, stale_token)
+
+
+async def handle_evalsone(send, receive, headers_map, model_info, messages, request_params, deadline, sink=None, flight=None, permit=None):
+    """Serve a completion from Evalsone, refreshing the token once on 401"""
+    auth_header = headers_map.get("authorization")
+    if not auth_header:
+        api.log_message("Missing Authorization header for Evalsone model", "error", args)
+        return await send_json(send, 401, {"error": "Missing Authorization header"})
+
+    with api.trace_span("decode_auth_token"):
+        email, password = api.decode_auth_token(auth_header)
+    if not email or not password:
+        api.log_message("Invalid authorization token for Evalsone model", "error", args)
+        return await send_json(send, 401, {"error": "Invalid authorization token"})
+
+    # A token known to be expired is refreshed up front, the 401 retry below is only a fallback
+    token = api.token_store.get(email)
+    if not token:
+        token = await refresh_token(email, password, deadline)
+        if not token and deadline.remaining() <= 0:
+            return await send_json(send, 504, api.timeout_error("Request deadline exceeded during token refresh"))
+        if not token:
+            return await send_json(send, 401, {"error": "Failed to refresh token"})
+    api.token_store.remember_credentials(email, password)
+    response = None
+    for attempt in range(2):
+        api_url, headers, payload = api.build_evalsone_request(messages, token, model_info["model_id"], request_params)
+        try:
+            response = await call_upstream("ES", model_info, api_url, headers, payload, deadline, permit)
+        except api.UpstreamTimeout as e:
+            api.log_message(f"Evalsone request timed out: {e}", "error", args)
+            return await send_json(send, 504, api.timeout_error())
+        except httpx.HTTPError as e:
+            api.log_message(f"Request failed: {e}", "error", args)
+            return await send_json(send, 500, {"error": f"Evalsone request failed: {e}"})
+        if isinstance(response, api.CircuitBreaker):
+            return await send_circuit_open(send, response)
+
+        if response.status_code != 401 or attempt:
+            break
+        await response.aclose()
+        token = await refresh_token(email, password, deadline, stale_token=token)
+        if not token and deadline.remaining() <= 0:
+            return await send_json(send, 504, api.timeout_error("Request deadline exceeded during token refresh"))
+        if not token:
+            return await send_json(send, 401, {"error": "Failed to refresh token"})
+
+    if response.status_code == 401:
+        await response.aclose()
+        return await send_json(send, 500, {"error": "Evalsone request failed: token_expired"})
+    if response.is_error:
+        error_text = await upstream_error_text(response)
+        api.log_message(f"Request failed: HTTP {response.status_code}", "error", args)
+        return await send_json(send, 500, {"error": f"Evalsone request failed: HTTP {response.status_code}: {error_text}"})
+
+    api.balance_cache.note_activity(email, model_info.get("request_cost"))
+    if request_params["stream"]:
+        frames = relay_evalsone_stream(response, model_info["model_name"], deadline)
+        return await send_stream(
+            send, receive, "ES", cache_stream(frames, sink) if sink else frames, flight,
+            model_info["model_name"], deadline.started_at
+        )
+
+    with api.trace_span("finalize"):
+        result = api.format_evalsone_response(response.json(), model_info["model_name"])
+        result = await cache_result(api.build_completion_response(result, model_info["model_name"]), sink)
+    return await send_json(send, 200, result)
+
+
+class CompressingSend:
+    """
+    ASGI send wrapper compressing response bodies for the client's
+    Accept-Encoding. The start message is held back until the first body
+    message shows whether the response is streamed; streams are flushed
+    after every message so SSE frames are not delayed.
+    """
+
+    def __init__(self, send, accept_encoding):
+        self.send = send
+        self.accept_encoding = accept_encoding
+        self.start = None
+        self.compressor = None
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body":
+            return await self.send(message)
+        if self.start is None:
+            if self.compressor:
+                body = self.compressor.compress(message.get("body", b""))
+                if not message.get("more_body"):
+                    body += self.compressor.finish()
+                message = dict(message, body=body)
+            return await self.send(message)
+
+        start, self.start = self.start, None
+        body = message.get("body", b"")
+        streamed = message.get("more_body", False)
+        headers = dict(start["headers"])
+        codec = None
+        varies = False
+        if 200 <= start["status"] and start["status"] not in (204, 304) and b"content-encoding" not in headers:
+            mimetype = headers.get(b"content-type", b"").decode("latin-1")
+            varies = api.encoding_varies(mimetype, streamed, args)
+            codec = api.response_codec(self.accept_encoding, mimetype, streamed, args)
+        if codec and not streamed and len(body) < args.compress_min_bytes:
+            codec = None
+        if codec is None:
+            if varies:
+                start = dict(start, headers=list(start["headers"]) + [(b"vary", b"Accept-Encoding")])
+            await self.send(start)
+            return await self.send(message)
+
+        headers = [
+            (key, api.weak_etag(value.decode("latin-1")).encode("latin-1") if key == b"etag" else value)
+            for key, value in start["headers"] if key != b"content-length"
+        ]
+        headers += [(b"content-encoding", codec.encode()), (b"vary", b"Accept-Encoding")]
+        if streamed:
+            self.compressor = api.StreamCompressor(codec)
+            body = self.compressor.compress(body)
+        else:
+            body = api.compress_body(body, codec)
+            headers.append((b"content-length", str(len(body)).encode()))
+        await self.send(dict(start, headers=headers))
+        await self.send(dict(message, body=body))
+
+
+class MeteredSend:
+    """ASGI send wrapper that records the request metrics of a chat completion"""
+
+    def __init__(self, send, trace=None):
+        self.send = send
+        self.trace = trace
+        self.started_at = time.monotonic()
+        self.labels = (None, None)
+        self.status = None
+        self.streamed = False
+        self.conversation_id = None
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+            headers = []
+            if self.conversation_id:
+                headers.append((api.CONVERSATION_HEADER.lower().encode(), self.conversation_id.encode()))
+            if self.trace:
+                headers.append((api.TRACE_HEADER.lower().encode(), self.trace.trace_id.encode()))
+            if headers:
+                message = dict(message, headers=list(message["headers"]) + headers)
+        elif message.get("more_body"):
+            self.streamed = True
+        await self.send(message)
+
+    def record(self):
+        # Streamed responses are timed by send_stream once the last chunk is out
+        duration = None if self.streamed else time.monotonic() - self.started_at
+        api.record_request_metrics(*self.labels, self.status or 500, duration)
+        # A relayed stream finishes its own trace once the last chunk is out
+        if self.trace and not self.trace.streaming:
+            self.trace.finish(self.status or 500)
+
+
+async def chat_completions(scope, receive, send, headers_map):
+    with api.trace_span("body_read"):
+        body = await read_body(receive)
+    if body is None:
+        return
+    if headers_map.get("content-encoding"):
+        try:
+            body = api.decode_request_body(body, headers_map["content-encoding"])
+        except api.RequestBodyError as e:
+            return await send_json(send, e.status, {"error": str(e)})
+    try:
+        with api.trace_span("body_parse"):
+            data = json.loads(body)
+    except json.JSONDecodeError as e:
+        api.log_message(f"Invalid JSON in request body: {e}", "error", args)
+        return await send_json(send, 400, {"error": "Invalid JSON in request body"})
+
+    with api.trace_span("model_lookup"):
+        parsed, parse_error = api.parse_completion_request(data, args)
+    if parse_error:
+        message, status = parse_error
+        return await send_json(send, status, {"error": message})
+    model_info, messages, request_params = parsed
+    # send is the MeteredSend of app()
+    send.labels = (model_info["provider"], model_info["model_name"])
+    conversation = None
+    cache_control = headers_map.get("cache-control")
+    if headers_map.get(api.CONVERSATION_HEADER.lower()):
+        opened, conversation_failure = await asyncio.to_thread(
+            api.open_conversation, headers_map[api.CONVERSATION_HEADER.lower()], headers_map.get("authorization"), messages, args
+        )
+        if conversation_failure:
+            body, status = conversation_failure
+            return await send_json(send, status, body)
+        conversation, messages = opened
+        send.conversation_id = conversation[0]
+        # The turn is appended by the sink of its own completion, never answered by a cache hit or another flight
+        cache_control = f"{cache_control or ''}, no-cache"
+    with api.trace_span("context_fit"):
+        messages, context_error = api.fit_context(model_info, messages, request_params, args)
+    if context_error:
+        body, status = context_error
+        return await send_json(send, status, body)
+    if send.trace:
+        send.trace.attributes.update(provider=model_info["provider"], model=model_info["model_name"], stream=bool(request_params["stream"]))
+    deadline = api.make_deadline(model_info["provider"], model_info, args, headers_map.get(api.DEADLINE_HEADER.lower()))
+
+    auth_error = api.evalsone_auth_error(model_info, headers_map.get("authorization"), args)
+    if auth_error:
+        message, status = auth_error
+        return await send_json(send, status, {"error": message})
+    lookup_key, store_key = api.cache_plan(
+        model_info, messages, request_params,
+        cache_control, headers_map.get(api.CACHE_BYPASS_HEADER.lower()), headers_map.get("authorization")
+    )
+    sink = api.completion_sink(store_key, conversation)
+    if lookup_key:
+        cached = await asyncio.to_thread(api.cached_completion, lookup_key, request_params["stream"])
+        if cached:
+            body, mimetype = cached
+            return await send_body(send, 200, body, mimetype.encode(), [(api.CACHE_STATUS_HEADER.lower().encode(), b"HIT")])
+
+    client = scope.get("client") or (None, None)
+    tenant = api.client_tenant(model_info, headers_map.get("authorization"), client[0], args)
+
+    async def dispatch(send, flight=None):
+        permit = None
+        if args.adaptive_concurrency:
+            permit, rejection = await acquire_permit(model_info, request_params, deadline, tenant)
+            if rejection:
+                message, retry_after = rejection
+                api.log_message(message, "debug", args)
+                return await send_body(
+                    send, 503, json.dumps(api.overloaded_error(message)).encode("utf-8"), b"application/json",
+                    [(b"retry-after", str(retry_after).encode())]
+                )
+        try:
+            if model_info["provider"] == "PAI":
+                return await handle_openai_provider(send, receive, "PAI", "PAI", model_info, messages, request_params, deadline, sink, flight, permit)
+            if model_info["provider"] == "DI":
+                return await handle_openai_provider(send, receive, "DI", "DeepInfra", model_info, messages, request_params, deadline, sink, flight, permit)
+            return await handle_evalsone(send, receive, headers_map, model_info, messages, request_params, deadline, sink, flight, permit)
+        finally:
+            # send_stream only returns once the relay is over, so this also covers streams
+            if permit:
+                permit.release()
+
+    flight_key = api.coalesce_key(
+        model_info, messages, request_params, headers_map.get("authorization"),
+        cache_control, headers_map.get(api.CACHE_BYPASS_HEADER.lower()), args
+    )
+    if not flight_key:
+        return await dispatch(send)
+    flight, leader = api.join_flight(flight_key, AsyncFlight)
+    if leader:
+        return await lead_flight(send, flight, dispatch)
+    if not await follow_flight(send, receive, flight, model_info["provider"], deadline, model_info["model_name"]):
+        return await dispatch(send)
+
+
+async def conversation_route(send, method, conversation_id, headers_map):
+    owner = api.credentials_owner(headers_map.get("authorization"))
+    if method == "DELETE":
+        found = await asyncio.to_thread(api.conversation_store.delete, conversation_id, owner)
+        messages = []
+    else:
+        messages = await asyncio.to_thread(api.conversation_store.load, conversation_id, owner, False)
+        found = messages is not None
+    if not found:
+        body, status = api.invalid_request_error("Conversation not found or expired", "conversation_not_found", 404)
+        return await send_json(send, status, body)
+    return await send_json(send, 200, {"id": conversation_id, "object": "conversation", "deleted": method == "DELETE", "messages": messages})
+
+
+async def batch_route(scope, receive, send, method, path, headers_map):
+    """/v1/files and /v1/batches, served by api.batch_store off the event loop"""
+    store = api.batch_store
+    if store is None:
+        body, status = api.batches_disabled()
+        return await send_json(send, status, body)
+    auth_header = headers_map.get("authorization")
+    query = {key: values[-1] for key, values in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+    parts = path.strip("/").split("/")[1:]
+    if parts[0] == "files" and len(parts) == 1 and method == "POST":
+        request_body = await read_body(receive)
+        if request_body is None:
+            return
+        body, status = await asyncio.to_thread(
+            store.upload, request_body, headers_map.get("content-type"), auth_header, query.get("purpose"), query.get("filename")
+        )
+    elif parts[0] == "files" and len(parts) in (2, 3) and method == "GET" and parts[2:] in ([], ["content"]):
+        info = await asyncio.to_thread(store.get_file, parts[1], api.credentials_owner(auth_header))
+        if info and len(parts) == 3:
+            return await send_file_content(send, store.content_path(parts[1]), info["bytes"])
+        body, status = (info, 200) if info else api.invalid_request_error("No such file", "file_not_found", 404)
+    elif parts[0] == "batches" and len(parts) == 1 and method == "POST":
+        request_body = await read_body(receive)
+        if request_body is None:
+            return
+        try:
+            data = json.loads(request_body)
+        except json.JSONDecodeError:
+            data = None
+        body, status = await asyncio.to_thread(store.create, data, auth_header)
+    elif parts[0] == "batches" and len(parts) == 1 and method == "GET":
+        try:
+            limit = min(max(int(query.get("limit", 20)), 1), 100)
+        except ValueError:
+            limit = 20
+        body, status = await asyncio.to_thread(store.list, auth_header, limit, query.get("after"))
+    elif parts[0] == "batches" and len(parts) == 2 and method == "GET":
+        body, status = await asyncio.to_thread(store.get, parts[1], auth_header)
+    elif parts[0] == "batches" and len(parts) == 3 and parts[2] == "cancel" and method == "POST":
+        body, status = await asyncio.to_thread(store.cancel, parts[1], auth_header)
+    else:
+        body, status = {"error": "Not found"}, 404
+    return await send_json(send, status, body)
+
+
+async def send_file_content(send, path, size):
+    """Send the first size bytes of a batch file, which a running batch may still be appending to"""
+    headers = [(b"content-type", b"application/jsonl"), (b"content-length", str(size).encode())] + CORS_HEADERS
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    chunks = api.file_chunks(path, size)
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def profile_route(scope, receive, send, method, headers_map):
+    """GET: collapsed stacks (or ?format=json stats), POST: start/stop/reset the profiler, both admin only"""
+    if method not in ("GET", "POST"):
+        return await send_json(send, 405, {"error": "Method not allowed"})
+    if method == "GET":
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if query.get("format") == ["json"]:
+            return await send_json(send, 200, api.profiler.get_stats())
+        label = query.get("label", [None])[0]
+        return await send_body(send, 200, api.profiler.collapsed(label).encode("utf-8"), b"text/plain")
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        options = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        options = None
+    if not isinstance(options, dict):
+        return await send_json(send, 400, {"error": "Expected a JSON object"})
+    return await send_json(send, 200, api.control_profiler(options))
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                init_async_clients()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_async_clients()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    method = scope["method"]
+    headers_map = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+
+    if method == "OPTIONS":
+        await send({"type": "http.response.start", "status": 200, "headers": CORS_HEADERS})
+        return await send({"type": "http.response.body", "body": b""})
+    if not args.no_compression:
+        # Also for clients without Accept-Encoding, whose compressible responses still get Vary
+        send = CompressingSend(send, headers_map.get("accept-encoding"))
+
+    try:
+        if path in api.ADMIN_PATHS:
+            client = scope.get("client") or (None, None)
+            if not api.is_admin_request(client[0], headers_map.get(api.ADMIN_TOKEN_HEADER.lower()), args):
+                return await send_json(send, 403, {"error": "Forbidden"})
+        if path == "/v1/chat/completions" and method == "POST":
+            metered = MeteredSend(send, api.start_trace(headers_map.get(api.TRACE_HEADER.lower())))
+            try:
+                return await chat_completions(scope, receive, metered, headers_map)
+            finally:
+                metered.record()
+        if path == "/v1/models" and method == "GET":
+            return await send_models(send, headers_map)
+        if path == "/v1/balance" and method == "GET":
+            result, status = await asyncio.to_thread(api.balance_cache.get, headers_map.get("authorization"), args)
+            return await send_json(send, status, result)
+        if path == "/v1/pools" and method == "GET":
+            return await send_json(send, 200, api.get_pool_stats())
+        if path == "/v1/streams" and method == "GET":
+            return await send_json(send, 200, api.get_stream_stats())
+        if path == "/v1/cache" and method == "GET":
+            return await send_json(send, 200, api.get_cache_stats())
+        if path == "/v1/limits" and method == "GET":
+            return await send_json(send, 200, api.concurrency.get_stats())
+        if path == "/v1/breakers" and method == "GET":
+            return await send_json(send, 200, api.breakers.get_stats())
+        if path == "/v1/conversations" and method == "GET":
+            return await send_json(send, 200, await asyncio.to_thread(api.conversation_store.get_stats))
+        if path.startswith("/v1/conversations/") and method in ("GET", "DELETE"):
+            return await conversation_route(send, method, path[len("/v1/conversations/"):], headers_map)
+        if path.startswith(("/v1/files", "/v1/batches")):
+            return await batch_route(scope, receive, send, method, path, headers_map)
+        if path == "/v1/profile":
+            return await profile_route(scope, receive, send, method, headers_map)
+        if path == "/metrics" and method == "GET":
+            return await send_body(send, 200, api.metrics.render().encode("utf-8"), b"text/plain; version=0.0.4")
+        return await send_json(send, 404, {"error": "Not found"})
+    except Exception as e:
+        api.log_message(f"Unexpected error: {e}", "error", args)
+        return await send_json(send, 500, {"error": str(e)})
+
+
+def run(run_args, port, ssl_context=None, fd=None):
+    """Serve the gateway with uvicorn, on the inherited listening socket fd of a worker if given"""
+    global args
+    import uvicorn
+
+    args = run_args
+    ssl_options = {}
+    if ssl_context:
+        ssl_options = {"ssl_certfile": ssl_context[0], "ssl_keyfile": ssl_context[1]}
+    listen = {"host": "0.0.0.0", "port": port} if fd is None else {"fd": fd}
+    uvicorn.run(
+        app,
+        **listen,
+        log_level="debug" if args.verbose else "info",
+        lifespan="on",
+        **ssl_options
+    )
@@ -0,0 +1,502 @@
+"""
+End-to-end load test of the gateway against local stub upstreams.
+
+Starts stub servers that mimic the Evalsone login/balance_info/chatcomplete
+endpoints and the DeepInfra and Pollinations OpenAI endpoints (configurable
+token rate, latency and error injection), starts api.py pointed at them with
+--upstream-url, drives it with a concurrent load generator and reports
+throughput, p50/p99 time to first token, latency added per chunk compared to
+hitting the stub directly, and the gateway's CPU time and RSS.
+
+Usage:
+    python bench_gateway.py [--modes flask,asgi] [--providers ES,DI,PAI]
+                            [--concurrency 32] [--duration 10] [--token-rate 200]
+                            [--json results.json] [--compare baseline.json]
+    python bench_gateway.py --workers 1,2,4 --client-processes 4 --stream-modes json
+
+--workers runs every mode once per worker count (api.py --workers N) and
+prints the throughput of each count relative to a single process.
+--client-processes spreads the load generator over several processes so it
+does not become the bottleneck itself.
+
+--compare exits with status 1 when throughput drops or p99 TTFT grows by more
+than --max-regression against a previous --json report.
+"""
+import argparse
+import base64
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_jwt(user_id, lifetime=3600):
+    """Unsigned JWT with the sub and exp claims api.py reads"""
+    def segment(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b"=").decode()
+    return f"{segment({'alg': 'none'})}.{segment({'sub': user_id, 'exp': int(time.time()) + lifetime})}.sig"
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response are expected under load
+        pass
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """One upstream provider: Evalsone (ES) or an OpenAI-compatible API (DI, PAI)"""
+
+    protocol_version = "HTTP/1.1"
+    # Set per server class by make_stub()
+    provider = None
+    options = None
+
+    def setup(self):
+        super().setup()
+        # Small SSE writes must not wait for delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.path == "/api/user/login":
+            return self.send_json(200, {"access_token": make_jwt(f"user-{payload.get('email')}")})
+        if self.path == "/api/balance/get_info":
+            return self.send_json(200, {"succ": 1, "info": {"balance": 100.0, "user_id": payload.get("user_id")}})
+        if self.path in ("/api/llm/chatcomplete", "/v1/openai/chat/completions", "/openai"):
+            return self.complete(payload)
+        self.send_json(404, {"error": "not found"})
+
+    def complete(self, payload):
+        options = self.options
+        time.sleep(options.latency / 1000)
+        if random.random() < options.error_rate:
+            if self.provider == "DI":
+                return self.send_json(503, {"error": {"message": "server overloaded"}})
+            return self.send_json(500, {"error": "injected failure"})
+
+        if not payload.get("stream"):
+            time.sleep(options.tokens / options.token_rate)
+            content = "tok " * options.tokens
+            if self.provider == "ES":
+                return self.send_json(200, {"choices": [{"message": {"content": content}}]})
+            return self.send_json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": options.tokens, "total_tokens": options.tokens + 1},
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        gap = 1 / options.token_rate
+        try:
+            for _ in range(options.tokens):
+                self.write_chunk(stub_frame(self.provider, "tok ", None))
+                time.sleep(gap)
+            self.write_chunk(stub_frame(self.provider, "", "stop"))
+            if self.provider != "ES":
+                self.write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def stub_frame(provider, content, finish_reason):
+    """One upstream SSE frame in the provider's own format"""
+    if provider == "ES":
+        chunk = {"choices": [{"delta": {"content": content}}], "finish_reason": finish_reason}
+    else:
+        chunk = {
+            "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0, "model": "stub",
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}],
+        }
+    return b"data: " + json.dumps(chunk).encode() + b"\n\n"
+
+
+def make_stub(provider, options):
+    """Start a stub upstream on a free port, returns (server, base URL)"""
+    handler = type(f"{provider}StubHandler", (StubHandler,), {"provider": provider, "options": options})
+    server = StubServer(("127.0.0.1", free_port()), handler)
+    threading.Thread(target=server.serve_forever, name=f"stub-{provider}", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def pick_models():
+    """First model of each provider in models.json"""
+    with open(os.path.join(HERE, "models.json")) as f:
+        models = json.load(f)
+    picked = {}
+    for model in models:
+        picked.setdefault(model["provider"], model["model_name"])
+    return picked
+
+
+class Gateway:
+    """api.py running in a subprocess, in a scratch directory so tokens.json and certs stay untouched"""
+
+    def __init__(self, mode, stub_urls, extra_args, workers=1):
+        self.port = free_port()
+        self.workdir = tempfile.mkdtemp(prefix="bench-gateway-")
+        shutil.copy(os.path.join(HERE, "models.json"), self.workdir)
+        command = [sys.executable, os.path.join(HERE, "api.py"), "--port", str(self.port), "--disable-log"]
+        for provider, url in stub_urls.items():
+            command += ["--upstream-url", f"{provider}={url}"]
+        if mode == "asgi":
+            command.append("--asgi")
+        if workers > 1:
+            command += ["--workers", str(workers)]
+        command += extra_args
+        self.process = subprocess.Popen(command, cwd=self.workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"api.py exited with status {self.process.returncode}")
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                connection.request("GET", "/v1/models")
+                if connection.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError("api.py did not start in time")
+
+    def pids(self):
+        """The gateway process and its --workers"""
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as f:
+                return [self.process.pid] + [int(pid) for pid in f.read().split()]
+        except (OSError, ValueError):
+            return [self.process.pid]
+
+    def cpu_seconds(self):
+        """utime + stime of the gateway processes, None where /proc is not available"""
+        try:
+            total = 0
+            for pid in self.pids():
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            return total / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_mb(self):
+        total = None
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total = (total or 0) + int(line.split()[1]) / 1024
+            except OSError:
+                pass
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def completion_request(provider, model, stream, direct):
+    """(path, body, headers) of one chat completion, to the gateway or straight to a stub"""
+    body = {"model": model, "messages": [{"role": "user", "content": "Say something"}], "stream": stream}
+    headers = {"Content-Type": "application/json"}
+    if direct:
+        path = {"ES": "/api/llm/chatcomplete", "DI": "/v1/openai/chat/completions", "PAI": "/openai"}[provider]
+        if provider == "ES":
+            headers["Blade-auth"] = make_jwt("direct")
+    else:
+        path = "/v1/chat/completions"
+        if provider == "ES":
+            credentials = json.dumps({"email": "bench@example.com", "password": "bench"}).encode()
+            headers["Authorization"] = "Bearer " + base64.b64encode(credentials).decode()
+    return path, json.dumps(body).encode(), headers
+
+
+def load_worker(port, request, stop_at, results):
+    """Send requests back to back on one keep-alive connection until stop_at"""
+    path, body, headers = request
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    while time.monotonic() < stop_at:
+        sample = {"ok": False, "ttft": None, "gaps": [], "chunks": 0, "bytes": 0}
+        started = time.monotonic()
+        try:
+            connection.request("POST", path, body, headers)
+            response = connection.getresponse()
+            last = None
+            while True:
+                data = response.read1(65536)
+                if not data:
+                    break
+                now = time.monotonic()
+                if last is None:
+                    sample["ttft"] = now - started
+                else:
+                    sample["gaps"].append(now - last)
+                last = now
+                sample["chunks"] += data.count(b"\n\n") or 1
+                sample["bytes"] += len(data)
+            # read1() never marks a Content-Length body as finished, read() does
+            response.read()
+            sample["ok"] = response.status == 200
+            if response.will_close:
+                connection.close()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        sample["total"] = time.monotonic() - started
+        results.append(sample)
+    connection.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def collect_samples(port, request, concurrency, duration):
+    """Samples of `concurrency` load threads running for `duration` seconds"""
+    results = []
+    stop_at = time.monotonic() + duration
+    workers = [
+        threading.Thread(target=load_worker, args=(port, request, stop_at, results), daemon=True)
+        for _ in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def load_process(port, request, concurrency, duration, results):
+    results.put(collect_samples(port, request, concurrency, duration))
+
+
+def run_load(port, request, concurrency, duration, processes=1):
+    """Drive one endpoint with `concurrency` workers for `duration` seconds and summarize"""
+    started = time.monotonic()
+    if processes <= 1:
+        results = collect_samples(port, request, concurrency, duration)
+    else:
+        context = multiprocessing.get_context("fork")
+        queue = context.Queue()
+        shares = [concurrency // processes + (index < concurrency % processes) for index in range(processes)]
+        children = [
+            context.Process(target=load_process, args=(port, request, share, duration, queue), daemon=True)
+            for share in shares if share
+        ]
+        for child in children:
+            child.start()
+        # Drain before join, a child blocks on exit until its samples are read
+        results = [sample for _ in children for sample in queue.get()]
+        for child in children:
+            child.join()
+    elapsed = time.monotonic() - started
+
+    ok = [sample for sample in results if sample["ok"]]
+    ttfts = [sample["ttft"] for sample in ok if sample["ttft"] is not None]
+    gaps = [gap for sample in ok for gap in sample["gaps"]]
+    totals = [sample["total"] for sample in ok]
+    return {
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "throughput_rps": len(ok) / elapsed,
+        "chunks_per_sec": sum(sample["chunks"] for sample in ok) / elapsed,
+        "ttft_p50_ms": (percentile(ttfts, 0.5) or 0) * 1000,
+        "ttft_p99_ms": (percentile(ttfts, 0.99) or 0) * 1000,
+        "total_p50_ms": (percentile(totals, 0.5) or 0) * 1000,
+        "gap_mean_ms": sum(gaps) / len(gaps) * 1000 if gaps else None,
+    }
+
+
+def bench_mode(mode, bench_args, stubs, models, workers=1):
+    """Results of every provider/stream combination for one serving mode"""
+    stub_urls = {provider: url for provider, (server, url) in stubs.items()}
+    gateway = Gateway(mode, stub_urls, bench_args.gateway_args, workers)
+    label = mode if workers == 1 else f"{mode}x{workers}"
+    results = {}
+    try:
+        gateway.wait_ready()
+        for provider in bench_args.providers:
+            for stream in bench_args.stream_modes:
+                name = f"{label}/{provider}/{'stream' if stream else 'json'}"
+                direct_port = stubs[provider][0].server_address[1]
+                direct = run_load(direct_port, completion_request(provider, models[provider], stream, True),
+                                  bench_args.concurrency, bench_args.direct_duration, bench_args.client_processes)
+                cpu_before = gateway.cpu_seconds()
+                result = run_load(gateway.port, completion_request(provider, models[provider], stream, False),
+                                  bench_args.concurrency, bench_args.duration, bench_args.client_processes)
+                cpu_after = gateway.cpu_seconds()
+                result["added_ttft_ms"] = result["ttft_p50_ms"] - direct["ttft_p50_ms"]
+                if result["gap_mean_ms"] is not None and direct["gap_mean_ms"] is not None:
+                    result["added_per_chunk_ms"] = result["gap_mean_ms"] - direct["gap_mean_ms"]
+                if cpu_before is not None and cpu_after is not None:
+                    result["cpu_seconds"] = cpu_after - cpu_before
+                    result["cpu_ms_per_request"] = result["cpu_seconds"] * 1000 / max(result["requests"], 1)
+                result["rss_mb"] = gateway.rss_mb()
+                results[name] = result
+                print_result(name, result)
+    finally:
+        gateway.stop()
+    return results
+
+
+def print_result(name, result):
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else "n/a"
+    print(
+        f"{name:<18} {result['throughput_rps']:8.1f} req/s  {result['chunks_per_sec']:9.0f} chunks/s  "
+        f"ttft p50 {result['ttft_p50_ms']:7.1f} ms  p99 {result['ttft_p99_ms']:7.1f} ms  "
+        f"+ttft {result['added_ttft_ms']:6.2f} ms  +chunk {fmt(result.get('added_per_chunk_ms'), '6.3f')} ms  "
+        f"cpu/req {fmt(result.get('cpu_ms_per_request'), '6.2f')} ms  rss {fmt(result.get('rss_mb'), '6.1f')} MB  "
+        f"errors {result['errors']}"
+    )
+
+
+def scaling_report(results, modes, worker_counts):
+    """Throughput of every worker count relative to one process, as printable lines"""
+    lines = []
+    for mode in modes:
+        for name, single in results.items():
+            if not name.startswith(f"{mode}/") or not single["throughput_rps"]:
+                continue
+            scenario = name[len(mode):]
+            cells = []
+            for workers in worker_counts:
+                result = results.get(f"{mode}x{workers}{scenario}" if workers > 1 else name)
+                if result:
+                    speedup = result["throughput_rps"] / single["throughput_rps"]
+                    cells.append(f"x{workers}: {result['throughput_rps']:8.1f} req/s {speedup:4.2f}x ({speedup / workers:4.0%})")
+            lines.append(f"{name:<18} " + "  ".join(cells))
+    return lines
+
+
+def compare(results, baseline_path, max_regression):
+    """Regressions against a previous --json report, as printable lines"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - max_regression):
+            regressions.append(f"{name}: throughput {before['throughput_rps']:.1f} -> {result['throughput_rps']:.1f} req/s")
+        if before["ttft_p99_ms"] and result["ttft_p99_ms"] > before["ttft_p99_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: ttft p99 {before['ttft_p99_ms']:.1f} -> {result['ttft_p99_ms']:.1f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gateway load test against local stub upstreams')
+    parser.add_argument('--modes', default='flask', help='Comma separated serving modes: flask, asgi')
+    parser.add_argument('--providers', default='ES,DI,PAI', help='Comma separated providers to load')
+    parser.add_argument('--stream-modes', default='stream,json', help='Comma separated: stream, json')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent client connections')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of load per scenario')
+    parser.add_argument('--direct-duration', type=float, default=3, help='Seconds of load straight to the stub, for the baseline')
+    parser.add_argument('--tokens', type=int, default=64, help='Tokens per stub completion')
+    parser.add_argument('--token-rate', type=float, default=200, help='Stub tokens per second per stream')
+    parser.add_argument('--latency', type=float, default=20, help='Stub delay before the response starts, in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of stub completions that fail (DI answers 503 overloaded)')
+    parser.add_argument('--workers', default='1', help='Comma separated worker counts to run every mode with, e.g. 1,2,4')
+    parser.add_argument('--client-processes', type=int, default=1, help='Processes the load generator is spread over')
+    parser.add_argument('--gateway-args', default='', help='Extra api.py arguments, e.g. "--cache --coalesce"')
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    parser.add_argument('--compare', default=None, help='Previous --json report to check for regressions')
+    parser.add_argument('--max-regression', type=float, default=0.1, help='Allowed relative regression for --compare')
+    bench_args = parser.parse_args()
+    bench_args.providers = [provider.strip().upper() for provider in bench_args.providers.split(",") if provider.strip()]
+    bench_args.stream_modes = [mode.strip() == "stream" for mode in bench_args.stream_modes.split(",") if mode.strip()]
+    bench_args.gateway_args = bench_args.gateway_args.split()
+    worker_counts = sorted({int(count) for count in bench_args.workers.split(",") if count.strip()} | {1})
+    modes = [mode.strip() for mode in bench_args.modes.split(",") if mode.strip()]
+
+    models = pick_models()
+    stubs = {provider: make_stub(provider, bench_args) for provider in bench_args.providers}
+    print(
+        f"{bench_args.concurrency} clients, {bench_args.duration}s per scenario, stub: {bench_args.tokens} tokens "
+        f"at {bench_args.token_rate}/s, {bench_args.latency} ms latency, {bench_args.error_rate:.0%} errors"
+    )
+    results = {}
+    try:
+        for mode in modes:
+            for workers in worker_counts:
+                results.update(bench_mode(mode, bench_args, stubs, models, workers))
+    finally:
+        for server, url in stubs.values():
+            server.shutdown()
+
+    if len(worker_counts) > 1:
+        print("\nScaling with worker count (speedup over one process, efficiency per worker):")
+        for line in scaling_report(results, modes, worker_counts):
+            print(line)
+
+    if bench_args.json:
+        with open(bench_args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if bench_args.compare:
+        regressions = compare(results, bench_args.compare, bench_args.max_regression)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Microbenchmark of the Evalsone stream conversion.
+
+Compares the per-token dict + json.dumps + f-string path that api.py used
+before EvalsoneTranscoder with the transcoder itself, on the same synthetic
+Evalsone SSE lines, and prints chunks/sec for both.
+
+Usage: python bench_transcoder.py [--chunks 200000] [--repeat 3]
+"""
+import argparse
+import json
+import time
+
+import api
+
+
+def make_evalsone_lines(count):
+    """Synthetic Evalsone stream: short tokens, some needing JSON escapes, then a stop chunk"""
+    tokens = ["Hello", " world", ",", " this", " is", " a", ' "quoted"', " token", "\n", " café"]
+    lines = []
+    for i in range(count - 1):
+        chunk = {"choices": [{"delta": {"content": tokens[i % len(tokens)]}}], "finish_reason": None}
+        lines.append(f"data: {json.dumps(chunk)}".encode("utf-8"))
+    lines.append(f"data: {json.dumps({'choices': [{'delta': {'content': ''}}], 'finish_reason': 'stop'})}".encode("utf-8"))
+    return lines
+
+
+def legacy_relay(lines, model_name):
+    """The previous generate() in send_evalsone_request plus the wrapper in chat_completions"""
+    stream_id = f"chatcmpl-{int(time.time())}"
+    created_time = int(time.time())
+
+    def generate():
+        for line in lines:
+            raw_data = line.decode('utf-8').strip()
+            if not raw_data.startswith("data: "):
+                continue
+            try:
+                evalsone_chunk = json.loads(raw_data[6:])
+            except json.JSONDecodeError:
+                continue
+            content = evalsone_chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
+            finish_reason = evalsone_chunk.get("finish_reason")
+            if not content and not finish_reason:
+                continue
+            target_chunk = {
+                "id": stream_id,
+                "object": "chat.completion.chunk",
+                "created": created_time,
+                "model": model_name,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": content, "tool_calls": None},
+                    "finish_reason": finish_reason,
+                    "logprobs": None
+                }],
+                "system_fingerprint": "fp_06737a9306",
+                "usage": None
+            }
+            yield f"{json.dumps(target_chunk)}\n\n"
+            if finish_reason == "stop":
+                break
+        yield "[DONE]\n\n"
+
+    for line in generate():
+        yield f"data: {line.strip()}\n\n".encode("utf-8")
+
+
+def transcoder_relay(lines, model_name):
+    """The current EvalsoneTranscoder path"""
+    transcoder = api.EvalsoneTranscoder(model_name)
+    for line in lines:
+        frame = transcoder.transcode(line)
+        if frame is not None:
+            yield frame
+            if transcoder.finished:
+                break
+    yield transcoder.final_frames()
+
+
+def run(relay, lines, repeat):
+    """Best chunks/sec over repeat runs"""
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = 0
+        for _ in relay(lines, "gpt-4o-mini"):
+            frames += 1
+        best = max(best, frames / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evalsone stream transcoder microbenchmark')
+    parser.add_argument('--chunks', type=int, default=200000, help='Evalsone lines per run')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, best one is reported')
+    bench_args = parser.parse_args()
+
+    lines = make_evalsone_lines(bench_args.chunks)
+
+    # Both paths must produce the same chunks
+    legacy_frames = [json.loads(frame[6:]) for frame in legacy_relay(lines[:50] + lines[-1:], "m") if frame != b"data: [DONE]\n\n"]
+    new_frames = [json.loads(frame[6:]) for frame in transcoder_relay(lines[:50] + lines[-1:], "m") if frame != b"data: [DONE]\n\n"]
+    for old, new in zip(legacy_frames, new_frames):
+        old.pop("id"), new.pop("id"), old.pop("created"), new.pop("created")
+        assert old == new, (old, new)
+
+    codec = "orjson" if api.orjson else "json"
+    legacy_rate = run(legacy_relay, lines, bench_args.repeat)
+    new_rate = run(transcoder_relay, lines, bench_args.repeat)
+    print(f"{bench_args.chunks} Evalsone chunks, best of {bench_args.repeat}, codec: {codec}")
+    print(f"legacy dict + json.dumps : {legacy_rate:12,.0f} chunks/sec")
+    print(f"EvalsoneTranscoder       : {new_rate:12,.0f} chunks/sec  ({new_rate / legacy_rate:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
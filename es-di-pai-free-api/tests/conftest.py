@@ -0,0 +1,56 @@
+"""
+Behavioral tests run api.py against the stub upstreams of bench_gateway.py,
+in both serving modes, and talk to it over real sockets.
+"""
+import http.client
+import json
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_gateway  # noqa: E402
+
+
+def stub_options(latency=0, tokens=3, token_rate=1000, error_rate=0):
+    """Options of a stub upstream: latency before answering (ms), reply length, tokens/s and share of failed calls"""
+    return types.SimpleNamespace(latency=latency, tokens=tokens, token_rate=token_rate, error_rate=error_rate)
+
+
+@pytest.fixture
+def start_gateway():
+    """Start api.py in a mode against a DI stub, stopped after the test"""
+    started = []
+
+    def start(mode, options, *extra_args):
+        server, url = bench_gateway.make_stub("DI", options)
+        gateway = bench_gateway.Gateway(mode, {"DI": url}, list(extra_args))
+        started.append((server, gateway))
+        gateway.wait_ready()
+        return gateway
+
+    yield start
+    for server, gateway in started:
+        gateway.stop()
+        server.shutdown()
+
+
+def request(gateway, method, path, body=None, headers=None):
+    """(status, headers, parsed JSON body) of one request to the gateway"""
+    connection = http.client.HTTPConnection("127.0.0.1", gateway.port, timeout=30)
+    try:
+        data = json.dumps(body).encode() if body is not None else None
+        connection.request(method, path, data, {"Content-Type": "application/json", **(headers or {})})
+        response = connection.getresponse()
+        payload = response.read()
+        return response.status, response.headers, json.loads(payload) if payload.startswith(b"{") else payload
+    finally:
+        connection.close()
+
+
+def completion_body(stream=False):
+    model = bench_gateway.pick_models()["DI"]
+    return {"model": model, "messages": [{"role": "user", "content": "Say something"}], "stream": stream}
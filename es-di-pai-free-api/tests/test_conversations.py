@@ -0,0 +1,41 @@
+import threading
+
+import pytest
+
+from conftest import completion_body, request, stub_options
+
+
+@pytest.mark.parametrize("mode", ["flask", "asgi"])
+@pytest.mark.parametrize("stream", [False, True])
+def test_concurrent_new_conversations_are_not_coalesced(start_gateway, mode, stream):
+    # The stub answers slowly enough for both turns to be in flight at once
+    gateway = start_gateway(mode, stub_options(latency=500), "--coalesce", "--conversations")
+    results = []
+
+    def turn():
+        results.append(request(gateway, "POST", "/v1/chat/completions", completion_body(stream), {"X-Conversation-Id": "new"}))
+
+    threads = [threading.Thread(target=turn) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    conversation_ids = {headers["X-Conversation-Id"] for status, headers, _ in results if status == 200}
+    assert [status for status, _, _ in results] == [200, 200]
+    assert len(conversation_ids) == 2
+    for conversation_id in conversation_ids:
+        status, _, body = request(gateway, "GET", f"/v1/conversations/{conversation_id}")
+        assert status == 200
+        assert [message["role"] for message in body["messages"]] == ["user", "assistant"]
+
+
+@pytest.mark.parametrize("mode", ["flask", "asgi"])
+def test_failed_first_turn_stores_no_conversation(start_gateway, mode):
+    gateway = start_gateway(mode, stub_options(error_rate=1), "--conversations")
+    status, _, _ = request(gateway, "POST", "/v1/chat/completions", completion_body(), {"X-Conversation-Id": "new"})
+    assert status != 200
+
+    status, _, stats = request(gateway, "GET", "/v1/conversations")
+    assert status == 200
+    assert stats["created"] == 0
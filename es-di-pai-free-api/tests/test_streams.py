@@ -0,0 +1,50 @@
+import http.client
+import json
+import time
+
+import pytest
+
+from conftest import completion_body, request, stub_options
+
+
+def test_unstarted_relay_is_closed_with_its_response():
+    import api
+
+    api.configure(api.parse_args(["--disable-log"]))
+    closed = []
+
+    class Upstream:
+        def close(self):
+            closed.append(True)
+
+    before = api.get_stream_stats()["DeepInfra"]
+    with api.app.test_request_context():
+        response = api.relay_stream(api.ClosingIterator(iter([b"data: {}\n\n"]), Upstream()), "DI")
+        # The client went away before the first chunk was pulled
+        response.close()
+        response.close()
+    after = api.get_stream_stats()["DeepInfra"]
+
+    assert closed == [True]
+    assert after["active"] == before["active"]
+    assert after["cancelled"] == before["cancelled"] + 1
+
+
+@pytest.mark.parametrize("mode", ["flask", "asgi"])
+def test_stream_closed_before_first_chunk_is_cancelled(start_gateway, mode):
+    # The first frame only comes after two seconds
+    gateway = start_gateway(mode, stub_options(tokens=2, token_rate=0.5))
+    connection = http.client.HTTPConnection("127.0.0.1", gateway.port, timeout=30)
+    connection.request("POST", "/v1/chat/completions", json.dumps(completion_body(stream=True)), {"Content-Type": "application/json"})
+    time.sleep(0.5)
+    connection.close()
+
+    deadline = time.monotonic() + 10
+    while True:
+        _, _, stats = request(gateway, "GET", "/v1/streams")
+        if stats["DeepInfra"]["cancelled"] or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    assert stats["DeepInfra"]["cancelled"] == 1
+    assert stats["DeepInfra"]["active"] == 0
+    assert stats["DeepInfra"]["completed"] == 0